@@ -0,0 +1,214 @@
+"""
+Микро-бенчмарк функций БД на больших синтетических данных.
+
+Строит синтетическую базу (по умолчанию 100k пользователей и 1M голосов,
+для полной проверки: --votes 10000000), прогоняет каждую функцию работы с БД из main.py,
+печатает время и EXPLAIN QUERY PLAN всех выполненных запросов.
+
+Завершается с кодом 1, если запрос к большой таблице идет полным сканированием
+без индекса — так регрессии индексов видны до продакшена. Сканирование покрывающего
+индекса (SCAN ... USING COVERING INDEX) считается допустимым, но выводится как предупреждение.
+
+    python benchmarks/db_bench.py --users 100000 --votes 10000000 --db /tmp/big.db
+"""
+import argparse
+import asyncio
+import datetime
+import io
+import os
+import random
+import re
+import sqlite3
+import sys
+import tempfile
+import time
+from pathlib import Path
+from types import SimpleNamespace
+
+parser = argparse.ArgumentParser(description="Бенчмарк функций БД")
+parser.add_argument("--users", type=int, default=100_000)
+parser.add_argument("--votes", type=int, default=1_000_000)
+parser.add_argument("--movies", type=int, default=50_000, help="разных фильмов в голосах")
+parser.add_argument("--runs", type=int, default=20, help="прогонов каждой функции")
+parser.add_argument("--db", help="путь к базе (если файл уже есть — используется как есть)")
+args = parser.parse_args()
+
+db_path = args.db or os.path.join(tempfile.mkdtemp(prefix="moviematch_dbbench_"), "bench.db")
+os.environ["DB_PATH"] = db_path
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import aiosqlite  # noqa: E402
+
+import main  # noqa: E402
+
+# Таблицы, которые в проде растут без ограничений: полный скан по ним — ошибка
+BIG_TABLES = {"users", "user_votes", "tickets"}
+
+
+def fill_database(path):
+    """Заполняет уже созданную схему синтетическими данными"""
+    conn = sqlite3.connect(path)
+    now = datetime.datetime.now()
+
+    def ts(max_days):
+        return (now - datetime.timedelta(seconds=random.randint(0, max_days * 86400))).strftime("%Y-%m-%d %H:%M:%S")
+
+    print(f"Генерируем {args.users} пользователей...")
+    conn.executemany(
+        "INSERT OR IGNORE INTO users (user_id, username, first_name, joined_date, last_active, is_blocked, language_code) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?)",
+        ((uid, f"user{uid}", f"Имя{uid}", ts(365), ts(30), 1 if random.random() < 0.01 else 0, "ru")
+         for uid in range(1, args.users + 1))
+    )
+
+    print(f"Генерируем {args.votes} голосов...")
+    batch = 200_000
+    for start in range(0, args.votes, batch):
+        rows = []
+        for _ in range(min(batch, args.votes - start)):
+            # Популярные фильмы встречаются чаще (примерно как в реальной выдаче)
+            movie_id = int(random.paretovariate(1.2)) % args.movies + 1
+            rows.append((random.randint(1, args.users), str(movie_id), f"Фильм {movie_id}",
+                         1 if random.random() < 0.4 else 0, ts(180)))
+        conn.executemany(
+            "INSERT INTO user_votes (user_id, movie_id, movie_title, is_like, added_at) VALUES (?, ?, ?, ?, ?)", rows
+        )
+        conn.commit()
+
+    conn.executemany(
+        "INSERT INTO tickets (user_id, message, status, created_at) VALUES (?, ?, ?, ?)",
+        ((random.randint(1, args.users), "Помогите", random.choice(["open", "closed"]), ts(60)) for _ in range(5000))
+    )
+    conn.commit()
+    conn.execute("ANALYZE")
+    conn.close()
+
+
+def fake_callback():
+    """Минимальный CallbackQuery для хендлеров админки"""
+
+    async def noop(*a, **kw):
+        return None
+
+    return SimpleNamespace(
+        from_user=SimpleNamespace(id=main.SUPER_ADMIN_ID),
+        message=SimpleNamespace(edit_text=noop, answer=noop, photo=None),
+        answer=noop,
+    )
+
+
+def benchmarks():
+    """(название, фабрика корутины) — каждая функция БД из main.py"""
+    uid = lambda: random.randint(1, args.users)  # noqa: E731
+    movies = [{"id": random.randint(1, args.movies)} for _ in range(20)]
+    return [
+        ("get_user_stats", lambda: main.get_user_stats(uid())),
+        ("get_vote_counts", lambda: main.get_vote_counts(uid())),
+        ("is_admin", lambda: main.is_admin(uid())),
+        ("is_user_blocked", lambda: main.is_user_blocked(uid())),
+        # Кеш сбрасываем, чтобы мерить чтение из БД (первое обращение к пользователю еще и строит массив)
+        ("get_user_seen", lambda: (main.seen_cache.clear(), main.get_user_seen(uid()))[1]),
+        ("filter_seen_movies", lambda: main.filter_seen_movies(uid(), movies)),
+        ("get_full_likes", lambda: main.get_full_likes(uid())),
+        ("get_full_likes(10)", lambda: main.get_full_likes(uid(), 10)),
+        ("get_likes_count", lambda: main.get_likes_count(uid())),
+        ("get_likes_page", lambda: main.get_likes_page(uid())),
+        ("get_likes_page(after)", lambda: main.get_likes_page(uid(), after=random.randint(1, args.votes))),
+        ("get_likes_page(before)", lambda: main.get_likes_page(uid(), before=random.randint(1, args.votes))),
+        ("write_votes_export(csv)", lambda: main.write_votes_export(uid(), "csv", io.StringIO())),
+        ("get_global_top", lambda: main.get_global_top()),
+        ("get_targeted_user_ids(all)", lambda: main.get_targeted_user_ids("all")),
+        ("get_targeted_user_ids(new)", lambda: main.get_targeted_user_ids("new")),
+        ("get_targeted_user_ids(active)", lambda: main.get_targeted_user_ids("active")),
+        ("search_users", lambda: main.search_users(before=uid())),
+        ("search_users(query)", lambda: main.search_users(f"user{random.randint(1, 999)}")),
+        ("render_user_profile", lambda: main.render_user_profile(uid())),
+        ("get_open_tickets_count", lambda: (main.open_tickets_cache.update(count=None),
+                                            main.get_open_tickets_count())[1]),
+        ("get_tickets_page(open)", lambda: main.get_tickets_page("open")),
+        ("get_tickets_page(closed, before)", lambda: main.get_tickets_page("closed", ("2100-01-01", 10 ** 9))),
+        ("rollup_day", lambda: main.rollup_day(datetime.date.today().isoformat())),
+        ("get_daily_trend(30)", lambda: main.get_daily_trend(30)),
+        ("rank_deck", lambda: main.rank_deck(uid(), movies)),
+        ("admin_stats_pro", lambda: main.admin_stats_pro(fake_callback())),
+    ]
+
+
+def check_plan(conn, sql, params):
+    """Возвращает (строки плана, ошибки, предупреждения)"""
+    plan = [row[3] for row in conn.execute("EXPLAIN QUERY PLAN " + sql, params or ())]
+    errors, warnings = [], []
+    for line in plan:
+        m = re.match(r"SCAN (\w+)", line)
+        if not m or m.group(1) not in BIG_TABLES:
+            continue
+        if "INDEX" in line:
+            warnings.append(line)
+        else:
+            errors.append(line)
+    return plan, errors, warnings
+
+
+async def run():
+    build = not os.path.exists(db_path)
+
+    main.db = await aiosqlite.connect(db_path)
+    main.db.row_factory = aiosqlite.Row
+    await main.init_db()  # Схема и индексы ровно как в боте
+    if build:
+        await main.db.close()
+        fill_database(db_path)
+        main.db = await aiosqlite.connect(db_path)
+        main.db.row_factory = aiosqlite.Row
+        await main.init_db()
+
+    # Записываем все SQL, которые выполняют функции
+    captured = []
+    original_execute = main.db.execute
+
+    def recording_execute(sql, parameters=None):
+        captured.append((sql, parameters))
+        return original_execute(sql, parameters)
+
+    main.db.execute = recording_execute
+
+    plan_conn = sqlite3.connect(db_path)
+    failed = False
+    print(f"\nБаза: {db_path}\n")
+    print(f"{'функция':32} {'avg, мс':>10} {'max, мс':>10}")
+    reports = []
+    for name, factory in benchmarks():
+        captured.clear()
+        timings = []
+        for _ in range(args.runs):
+            start = time.perf_counter()
+            await factory()
+            timings.append((time.perf_counter() - start) * 1000)
+        print(f"{name:32} {sum(timings) / len(timings):10.2f} {max(timings):10.2f}")
+
+        seen_sql = {}
+        for sql, params in captured:
+            seen_sql.setdefault(" ".join(sql.split()), params)
+        for sql, params in seen_sql.items():
+            plan, errors, warnings = check_plan(plan_conn, sql, params)
+            reports.append((name, sql, plan, errors, warnings))
+            failed = failed or bool(errors)
+
+    print("\nEXPLAIN QUERY PLAN:")
+    for name, sql, plan, errors, warnings in reports:
+        mark = "❌" if errors else ("⚠️" if warnings else "✅")
+        print(f"\n{mark} [{name}] {sql[:150]}")
+        for line in plan:
+            print(f"     {line}")
+
+    plan_conn.close()
+    await main.db.close()
+
+    if failed:
+        print("\n❌ Есть запросы с полным сканированием больших таблиц без индекса")
+        sys.exit(1)
+    print("\n✅ Полных сканирований больших таблиц нет")
+
+
+if __name__ == "__main__":
+    asyncio.run(run())
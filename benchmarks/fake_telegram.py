@@ -0,0 +1,73 @@
+"""
+Записывающая заглушка Telegram Bot API для нагрузочных тестов.
+
+RecordingSession подменяет сетевую сессию aiogram: каждый вызов API записывается,
+а в ответ возвращается правдоподобный объект (Message или True) без похода в сеть.
+"""
+import asyncio
+import datetime
+import itertools
+import time
+import typing
+from aiogram import Bot
+from aiogram.client.session.base import BaseSession
+from aiogram.types import Chat, Message
+
+FAKE_TOKEN = "42:FAKE-TOKEN-FOR-BENCHMARKS"
+
+
+class RecordingSession(BaseSession):
+    def __init__(self, latency=0.0):
+        super().__init__()
+        self.latency = latency
+        self.calls = []  # [(время, метод, chat_id)]
+        self.last_text = {}  # {chat_id: текст/подпись последнего сообщения}
+        self.last_buttons = {}  # {chat_id: callback_data кнопок последней клавиатуры}
+        self.waiters = {}  # {chat_id: Future} — ждут следующего вызова API в этот чат
+        self._message_ids = itertools.count(1000)
+
+    async def make_request(self, bot, method, timeout=None):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        chat_id = getattr(method, "chat_id", None)
+        self.calls.append((time.perf_counter(), type(method).__name__, chat_id))
+
+        text = getattr(method, "text", None) or getattr(method, "caption", None)
+        media = getattr(method, "media", None)
+        if media is not None and getattr(media, "caption", None):
+            text = media.caption
+        if chat_id is not None:
+            if text:
+                self.last_text[chat_id] = text
+            markup = getattr(method, "reply_markup", None)
+            if markup is not None and hasattr(markup, "inline_keyboard"):
+                self.last_buttons[chat_id] = [b.callback_data for row in markup.inline_keyboard for b in row
+                                              if b.callback_data]
+            waiter = self.waiters.pop(chat_id, None)
+            if waiter and not waiter.done():
+                waiter.set_result(type(method).__name__)
+
+        returning = method.__returning__
+        if returning is Message or Message in typing.get_args(returning):
+            return Message(
+                message_id=next(self._message_ids),
+                date=datetime.datetime.now(),
+                chat=Chat(id=chat_id if isinstance(chat_id, int) else 0, type="private"),
+                text=text,
+            )
+        return True
+
+    async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+        yield b""
+
+    async def close(self):
+        pass
+
+    def count(self, method_name=None):
+        return sum(1 for _, name, _ in self.calls if method_name is None or name == method_name)
+
+
+def create_fake_bot(latency=0.0):
+    """Bot с записывающей сессией вместо сети"""
+    return Bot(token=FAKE_TOKEN, session=RecordingSession(latency))
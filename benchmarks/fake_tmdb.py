@@ -0,0 +1,94 @@
+"""
+Локальная заглушка TMDB для нагрузочных тестов.
+
+Отдает детерминированные ответы для /discover/movie, /movie/{id} и /movie/{id}/videos
+с настраиваемой задержкой. Можно запустить отдельно:
+
+    python benchmarks/fake_tmdb.py --port 8900 --latency 0.05
+
+и указать боту TMDB_API_URL=http://127.0.0.1:8900
+"""
+import argparse
+import asyncio
+from aiohttp import web
+
+PAGE_SIZE = 20
+TOTAL_PAGES = 500
+
+
+def make_movie(movie_id, genre_id=None):
+    return {
+        "id": movie_id,
+        "title": f"Фильм {movie_id}",
+        "overview": f"Описание фильма {movie_id}. " * 5,
+        "poster_path": f"/poster_{movie_id}.jpg",
+        "release_date": "2020-01-01",
+        "vote_average": round(5 + (movie_id % 50) / 10, 1),
+        "genre_ids": [int(genre_id)] if genre_id else [18],
+    }
+
+
+def make_videos(movie_id):
+    return {"id": movie_id, "results": [
+        {"iso_639_1": "en", "site": "YouTube", "type": "Trailer", "key": f"trailer{movie_id}"},
+    ]}
+
+
+def create_app(latency=0.0):
+    """aiohttp-приложение с фейковым TMDB. app["stats"] — счетчик запросов по эндпоинтам"""
+    app = web.Application()
+    app["stats"] = {"discover": 0, "movie": 0, "videos": 0}
+
+    async def delay():
+        if latency:
+            await asyncio.sleep(latency)
+
+    async def discover(request):
+        app["stats"]["discover"] += 1
+        await delay()
+        page = int(request.query.get("page", 1))
+        genre_id = request.query.get("with_genres")
+        # Разные жанры дают разные, но пересекающиеся выдачи
+        base = (int(genre_id) if genre_id else 0) * 10 + (page - 1) * PAGE_SIZE
+        results = [make_movie(base + i + 1, genre_id) for i in range(PAGE_SIZE)] if page <= TOTAL_PAGES else []
+        return web.json_response({"page": page, "results": results, "total_pages": TOTAL_PAGES})
+
+    async def movie(request):
+        app["stats"]["movie"] += 1
+        await delay()
+        movie_id = int(request.match_info["movie_id"])
+        data = make_movie(movie_id)
+        if "videos" in request.query.get("append_to_response", ""):
+            data["videos"] = make_videos(movie_id)
+        if "translations" in request.query.get("append_to_response", ""):
+            data["translations"] = {"translations": [
+                {"iso_639_1": "ru", "iso_3166_1": "RU", "data": {"title": data["title"], "overview": data["overview"]}},
+            ]}
+        return web.json_response(data)
+
+    async def videos(request):
+        app["stats"]["videos"] += 1
+        await delay()
+        return web.json_response(make_videos(int(request.match_info["movie_id"])))
+
+    app.router.add_get("/discover/movie", discover)
+    app.router.add_get("/movie/{movie_id:\\d+}", movie)
+    app.router.add_get("/movie/{movie_id:\\d+}/videos", videos)
+    return app
+
+
+async def start_fake_tmdb(port=8900, latency=0.0):
+    """Запускает заглушку в текущем event loop. Возвращает (runner, app)"""
+    app = create_app(latency)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", port).start()
+    return runner, app
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Фейковый TMDB для нагрузочных тестов")
+    parser.add_argument("--port", type=int, default=8900)
+    parser.add_argument("--latency", type=float, default=0.0, help="задержка ответа, сек")
+    args = parser.parse_args()
+    web.run_app(create_app(args.latency), host="127.0.0.1", port=args.port)
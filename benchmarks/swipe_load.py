@@ -0,0 +1,214 @@
+"""
+Нагрузочный тест свайпов: N одновременных пользователей гоняют карточки через dp бота.
+
+TMDB и Telegram подменены локальными заглушками (fake_tmdb.py, fake_telegram.py),
+апдейты собираются вручную и скармливаются в dp.feed_update. В конце печатается
+p50/p99 задержки «голос -> следующая карточка», апдейтов в секунду и коммитов БД в секунду.
+
+    python benchmarks/swipe_load.py --solo 800 --duo-pairs 100 --swipes 20 --tmdb-latency 0.05
+"""
+import argparse
+import asyncio
+import datetime
+import itertools
+import os
+import random
+import re
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+parser = argparse.ArgumentParser(description="Нагрузочный тест свайпов")
+parser.add_argument("--solo", type=int, default=800, help="пользователей в соло-режиме")
+parser.add_argument("--duo-pairs", type=int, default=100, help="пар в режиме «Вдвоем»")
+parser.add_argument("--swipes", type=int, default=20, help="свайпов на пользователя")
+parser.add_argument("--tmdb-latency", type=float, default=0.05, help="задержка фейкового TMDB, сек")
+parser.add_argument("--tg-latency", type=float, default=0.02, help="задержка фейкового Telegram, сек")
+parser.add_argument("--tmdb-port", type=int, default=8900)
+parser.add_argument("--real-limits", action="store_true",
+                    help="оставить боевые лимиты Telegram (иначе меряем сам бот, а не очередь отправки)")
+parser.add_argument("--metrics", action="store_true", help="в конце напечатать метрики в формате Prometheus")
+args = parser.parse_args()
+
+# Конфигурация бота читается при импорте main, поэтому окружение готовим заранее
+tmp_dir = tempfile.mkdtemp(prefix="moviematch_bench_")
+os.environ["DB_PATH"] = os.path.join(tmp_dir, "bench.db")
+os.environ["TMDB_API_URL"] = f"http://127.0.0.1:{args.tmdb_port}"
+os.environ.setdefault("TMDB_RATE", "100000")
+if not args.real_limits:
+    os.environ["TG_GLOBAL_RATE"] = "100000"
+    os.environ["TG_CHAT_RATE"] = "100000"
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+import aiohttp  # noqa: E402
+import aiosqlite  # noqa: E402
+from aiogram import types  # noqa: E402
+
+import main  # noqa: E402
+from fake_telegram import create_fake_bot  # noqa: E402
+from fake_tmdb import start_fake_tmdb  # noqa: E402
+
+update_ids = itertools.count(1)
+message_ids = itertools.count(1)
+vote_latencies = []
+stats = {"updates": 0, "errors": 0, "commits": 0}
+
+
+def make_user(uid):
+    return types.User(id=uid, is_bot=False, first_name=f"user{uid}", username=f"user{uid}", language_code="ru")
+
+
+def make_message(uid, text=None):
+    return types.Message(
+        message_id=next(message_ids),
+        date=datetime.datetime.now(),
+        chat=types.Chat(id=uid, type="private"),
+        from_user=make_user(uid),
+        text=text,
+    )
+
+
+async def feed(update):
+    stats["updates"] += 1
+    try:
+        await main.dp.feed_update(main.bot, update)
+    except Exception as e:
+        stats["errors"] += 1
+        if stats["errors"] <= 5:
+            print(f"Ошибка обработки апдейта: {e!r}")
+
+
+async def send_text(uid, text):
+    await feed(types.Update(update_id=next(update_ids), message=make_message(uid, text)))
+
+
+async def press(uid, data):
+    query = types.CallbackQuery(
+        id=str(next(update_ids)),
+        from_user=make_user(uid),
+        chat_instance=str(uid),
+        data=data,
+        message=make_message(uid),
+    )
+    await feed(types.Update(update_id=next(update_ids), callback_query=query))
+
+
+def current_card(uid):
+    """callback_data кнопки ❤️ на последней карточке пользователя"""
+    buttons = main.bot.session.last_buttons.get(uid, [])
+    return next((b for b in buttons if b.startswith("like_")), None)
+
+
+async def swipe(uid, count):
+    for _ in range(count):
+        card = current_card(uid)
+        if not card:
+            return
+        act = "like" if random.random() < 0.4 else "dislike"
+        start = time.perf_counter()
+        await press(uid, f"{act}_{card.split('_')[1]}")
+        vote_latencies.append(time.perf_counter() - start)
+
+
+async def solo_user(uid, genre_id):
+    await send_text(uid, "/start")
+    await press(uid, f"genre_{genre_id}")
+    await swipe(uid, args.swipes)
+
+
+async def duo_pair(creator, partner, genre_id):
+    await send_text(creator, "/start")
+    await send_text(partner, "/start")
+    await press(creator, f"duogenre_{genre_id}")
+    match = re.search(r"<code>(\d+)</code>", main.bot.session.last_text.get(creator, ""))
+    if not match:
+        stats["errors"] += 1
+        return
+    await press(partner, "duo_join")
+    await send_text(partner, match.group(1))
+    await asyncio.gather(swipe(creator, args.swipes), swipe(partner, args.swipes))
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+async def run():
+    tmdb_runner, tmdb_app = await start_fake_tmdb(args.tmdb_port, args.tmdb_latency)
+
+    # Та же инициализация, что и в main.main(), но без polling и с заглушками
+    main.db = await aiosqlite.connect(main.DB_PATH)
+    main.db.row_factory = aiosqlite.Row
+    main.db = main.TimedConnection(main.db)
+    main.http_client = aiohttp.ClientSession()
+    main.bot = create_fake_bot(args.tg_latency)
+    main.bot.session.middleware(main.telegram_timing_middleware)
+    main.outbound_queue = asyncio.PriorityQueue()
+    main.tmdb_queue = asyncio.PriorityQueue()
+    workers = [
+        asyncio.create_task(main.rate_limit_worker(main.outbound_queue, main.global_bucket)),
+        asyncio.create_task(main.rate_limit_worker(main.tmdb_queue, main.tmdb_bucket)),
+    ]
+    await main.init_db()
+
+    # Считаем коммиты БД
+    original_commit = main.db.commit
+
+    async def counting_commit():
+        stats["commits"] += 1
+        return await original_commit()
+
+    main.db.commit = counting_commit
+
+    genres = list(main.GENRES.keys())
+    uid = 10_000
+    jobs = []
+    for i in range(args.solo):
+        uid += 1
+        jobs.append(solo_user(uid, genres[i % len(genres)]))
+    for i in range(args.duo_pairs):
+        uid += 2
+        jobs.append(duo_pair(uid - 1, uid, genres[i % len(genres)]))
+
+    print(f"Пользователей: {args.solo + args.duo_pairs * 2}, свайпов на каждого: {args.swipes}")
+    start = time.perf_counter()
+    commits_before = stats["commits"]
+    await asyncio.gather(*jobs)
+    elapsed = time.perf_counter() - start
+
+    session = main.bot.session
+    print(f"Время прогона:          {elapsed:.2f} сек")
+    print(f"Апдейтов:               {stats['updates']} ({stats['updates'] / elapsed:.1f}/сек), ошибок: {stats['errors']}")
+    print(f"Голосов:                {len(vote_latencies)}")
+    print(f"Голос -> карточка p50:  {percentile(vote_latencies, 0.50) * 1000:.1f} мс")
+    print(f"Голос -> карточка p99:  {percentile(vote_latencies, 0.99) * 1000:.1f} мс")
+    if vote_latencies:
+        print(f"Голос -> карточка avg:  {statistics.mean(vote_latencies) * 1000:.1f} мс")
+    print(f"Коммитов БД:            {stats['commits'] - commits_before} "
+          f"({(stats['commits'] - commits_before) / elapsed:.1f}/сек)")
+    print(f"Вызовов Telegram API:   {session.count()} "
+          f"({session.count() / max(len(vote_latencies), 1):.2f} на голос)")
+    print(f"Запросов к TMDB:        {tmdb_app['stats']}")
+    if args.metrics:
+        print("\n" + main.render_metrics())
+
+    for task in workers:
+        task.cancel()
+    # Фоновые таймеры комнат нам больше не нужны
+    for task in asyncio.all_tasks():
+        if task is not asyncio.current_task():
+            task.cancel()
+    await main.http_client.close()
+    await main.db.close()
+    await tmdb_runner.cleanup()
+
+
+if __name__ == "__main__":
+    asyncio.run(run())
@@ -1,25 +1,52 @@
 import asyncio
 import random
+import time
+import itertools
+import bisect
+import re
 import aiosqlite
+import sqlite3
+import gzip
 import datetime
-from urllib.parse import quote
+import json
+import csv
+import io
+import tempfile
+import hashlib
+import hmac
+import contextvars
+from array import array
+from urllib.parse import quote, urlencode, parse_qsl
+from collections import OrderedDict, deque, defaultdict
 from aiogram import Bot, Dispatcher, F, types, html
 from aiogram.filters import Command
+from aiogram.dispatcher.flags import get_flag
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.context import FSMContext
+from aiogram.fsm.storage.base import BaseStorage, StorageKey, StateType
 from aiogram.utils.keyboard import InlineKeyboardBuilder
-from aiogram.types import BotCommand, BotCommandScopeDefault
-from aiogram.exceptions import TelegramBadRequest
-from typing import Union, Optional # Optional тоже полезен для типов с None
+from aiogram.types import BotCommand, BotCommandScopeDefault, FSInputFile
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+from typing import Union, Optional, Any, Dict # Optional тоже полезен для типов с None
 from aiohttp_socks import ProxyConnector
 from aiogram.client.session.aiohttp import AiohttpSession
 from aiogram.client.default import DefaultBotProperties
 from aiogram.enums import ParseMode
+from aiogram.methods import GetUpdates
 import os
+import mmap
 import aiohttp
+from aiohttp import web
+from aiosqlite.context import contextmanager
 from pathlib import Path
 from dotenv import load_dotenv
 
+try:
+    import numpy as np
+    from scipy import sparse
+except ImportError:  # Рекомендации необязательны: без numpy/scipy колода идет просто по популярности
+    np = sparse = None
+
 
 # Находим путь к папке, где лежит текущий файл main.py
 current_dir = Path(__file__).resolve().parent
@@ -40,13 +67,245 @@ raw_admin_id = os.getenv('SUPER_ADMIN_ID', '0').strip()
 SUPER_ADMIN_ID = int(raw_admin_id) if raw_admin_id.isdigit() else 0
 
 DB_PATH = os.getenv('DB_PATH', 'movies_bot.db').strip()
+DB_BUSY_TIMEOUT = 30  # сек ожидания чужой блокировки записи (архивация, бэкап, индексы) вместо "database is locked"
 MAIN_MENU_IMAGE = 'https://i.pinimg.com/736x/d5/93/bb/d593bb09053d11c90156aff633ebf2a2.jpg'
 
+# Смена карточки редактированием старого сообщения (edit_message_media) вместо delete + send_photo.
+# 0 — вернуть старое поведение
+CARD_EDIT_MODE = os.getenv('CARD_EDIT_MODE', '1').strip() != '0'
+
+# Лимиты исходящих запросов к Telegram (см. очередь исходящих ниже)
+TG_GLOBAL_RATE = float(os.getenv('TG_GLOBAL_RATE', '25'))  # запросов в секунду на весь бот
+TG_CHAT_RATE = float(os.getenv('TG_CHAT_RATE', '1'))  # запросов в секунду в один чат
+TG_CHAT_BURST = 3  # сколько запросов в один чат можно отправить подряд без ожидания
+TG_MAX_RETRIES = 3  # повторов после 429 (retry_after)
+BROADCAST_CONCURRENCY = 10  # параллельных отправок в рассылке
+COMMAND_SYNC_CONCURRENCY = 5  # параллельных set_my_commands при синхронизации меню на старте
+
+# Защита от флуда: апдейты одного пользователя обрабатываются строго по очереди
+USER_UPDATE_RATE = 3  # апдейтов в секунду от одного пользователя
+USER_UPDATE_BURST = 6  # сколько можно прислать подряд, прежде чем лишнее начнет отбрасываться
+CALLBACK_DEDUP_WINDOW = 2  # сек: повторное нажатие той же кнопки на том же сообщении игнорируется
+
+# Слой доступа к TMDB (кеш, склейка запросов, лимит, предохранитель)
+TMDB_API_URL = os.getenv('TMDB_API_URL', 'https://api.themoviedb.org/3').strip().rstrip('/')
+TMDB_RATE = float(os.getenv('TMDB_RATE', '40'))  # запросов в секунду (лимит TMDB ~50)
+TMDB_TIMEOUT = 5  # сек на один запрос
+TMDB_CACHE_TTL = 6 * 3600  # сек, сколько ответ считается свежим
+TMDB_CACHE_MAX = 5000  # ответов в памяти (LRU)
+TMDB_BREAKER_THRESHOLD = 5  # ошибок подряд, после которых TMDB считается лежащим
+TMDB_BREAKER_COOLDOWN = 30  # сек не ходим в TMDB после срабатывания предохранителя
+
+# Языки выдачи TMDB: language_code пользователя из Telegram -> локаль TMDB.
+# Страницы discover общие для всех языков, тексты берутся из переводов в карточке фильма
+TMDB_LANGUAGES = {"ru": "ru-RU", "en": "en-US", "uk": "uk-UA", "be": "ru-RU", "kk": "ru-RU",
+                  "de": "de-DE", "es": "es-ES", "fr": "fr-FR", "it": "it-IT", "pt": "pt-BR", "tr": "tr-TR"}
+TMDB_DEFAULT_LANGUAGE = os.getenv('TMDB_DEFAULT_LANGUAGE', 'ru-RU').strip()  # для неизвестных языков
+USER_LANGUAGE_CACHE_MAX = 10000  # пользователей в кеше языка (LRU)
+
+# Фоновый прогрев каталога (первые страницы каждого жанра + карточки фильмов)
+CATALOG_PAGES = int(os.getenv('CATALOG_PAGES', '3'))  # страниц discover на жанр
+CATALOG_REQUEST_BUDGET = int(os.getenv('CATALOG_REQUEST_BUDGET', '1000'))  # запросов к TMDB за один проход
+CATALOG_REFRESH_HOURS = float(os.getenv('CATALOG_REFRESH_HOURS', '4'))  # как часто повторять проход
+
+# Архив старых голосов: дизлайки старше VOTE_ARCHIVE_DAYS переезжают в помесячные файлы
+VOTE_ARCHIVE_DAYS = int(os.getenv('VOTE_ARCHIVE_DAYS', '180'))  # 0 — не архивировать
+VOTE_ARCHIVE_DIR = os.getenv('VOTE_ARCHIVE_DIR', os.path.join(os.path.dirname(os.path.abspath(DB_PATH)), 'archive'))
+VOTE_ARCHIVE_BATCH = 5000  # строк за одну транзакцию (короткие блокировки записи)
+VOTE_ARCHIVE_HOURS = 24  # как часто запускать архивацию
+VACUUM_PAGES = 500  # страниц, возвращаемых ОС за один шаг incremental_vacuum (короткая блокировка записи)
+
+# Онлайн-бэкапы базы (сжатые снимки с ротацией)
+BACKUP_DIR = os.getenv('BACKUP_DIR', os.path.join(os.path.dirname(os.path.abspath(DB_PATH)), 'backups'))
+BACKUP_KEEP = int(os.getenv('BACKUP_KEEP', '7'))  # сколько последних снимков хранить
+BACKUP_HOURS = float(os.getenv('BACKUP_HOURS', '24'))  # 0 — только вручную из админки
+BACKUP_STEP_PAGES = 256  # страниц за один шаг backup API
+BACKUP_STEP_SLEEP = 0.005  # пауза между шагами, сек
+
+# Дневные сводки для аналитики (daily_stats, daily_genre_likes)
+ROLLUP_INTERVAL_MIN = 10  # как часто пересчитывать текущий день
+ROLLUP_BACKFILL_DAYS = 30  # за сколько дней собрать сводки при первом запуске
+
+# Рекомендации item-item: похожие фильмы по общим лайкам, колода сортируется по ним
+RECS_UPDATE_MIN = int(os.getenv('RECS_UPDATE_MIN', '30'))  # как часто досчитывать индекс; 0 — выключить
+RECS_FULL_REBUILD_HOURS = 24  # полный пересчет (инкрементальный учитывает только новые лайки)
+RECS_TOP_K = 50  # похожих фильмов на фильм в индексе
+RECS_MIN_COLIKES = 2  # меньше общих лайков — совпадение считаем случайным
+RECS_PROFILE_LIKES = 50  # последних лайков пользователя, по которым строится рейтинг колоды
+RECS_BLOCK = 512  # фильмов за одно умножение матриц (ограничивает память)
+
+# Метрики в формате Prometheus (только локально). 0 — не поднимать HTTP-сервер
+METRICS_PORT = int(os.getenv('METRICS_PORT', '9100'))
+SLOW_UPDATE_MS = float(os.getenv('SLOW_UPDATE_MS', '1000'))  # апдейты дольше этого пишем в лог
+
+# API для Mini App (index.html): колода карточек пачкой и голоса пачкой. 0 — не поднимать
+WEBAPP_PORT = int(os.getenv('WEBAPP_PORT', '8080'))
+WEBAPP_HOST = os.getenv('WEBAPP_HOST', '127.0.0.1').strip()  # наружу — через туннель/реверс-прокси
+WEBAPP_AUTH_TTL = 24 * 3600  # сек, сколько действителен initData
+WEBAPP_DECK_MAX = 30  # карточек за один запрос колоды
+WEBAPP_DECK_PAGES = 5  # страниц TMDB, которые можно пролистать ради одной колоды
+WEBAPP_VOTES_MAX = 200  # голосов в одном POST
+WEBAPP_SERVED_MAX = 300  # выданных, но еще не оцененных карточек, которые помним на пользователя
+WEBAPP_SERVED_USERS_MAX = 10000  # пользователей Mini App, чьи выданные карточки держим в памяти (LRU)
+
+# Кеш постеров для Mini App: уменьшенные копии TMDB на диске, вытеснение по LRU
+TMDB_IMAGE_URL = os.getenv('TMDB_IMAGE_URL', 'https://image.tmdb.org/t/p').strip().rstrip('/')
+POSTER_SIZES = ("w185", "w342", "w500")  # готовые размеры TMDB: списки / превью / карточка
+POSTER_CACHE_DIR = os.getenv('POSTER_CACHE_DIR', os.path.join(os.path.dirname(os.path.abspath(DB_PATH)), 'posters'))
+POSTER_CACHE_MB = int(os.getenv('POSTER_CACHE_MB', '200'))
+POSTER_TIMEOUT = 10  # сек на скачивание одного постера
+
+# Постраничные списки и кеши в памяти
+LIKES_PAGE_SIZE = 5  # фильмов на странице «Мои лайки»
+LIKES_COUNT_CACHE_MAX = 10000  # пользователей в кеше числа лайков (LRU)
+SEEN_CACHE_MAX = 5000  # пользователей, чьи просмотренные фильмы держим в памяти (LRU)
+USERS_PAGE_SIZE = 10  # пользователей на странице поиска в админке
+TICKETS_PAGE_SIZE = 10  # тикетов на странице очереди поддержки
+
+EXPORT_CHUNK_ROWS = 500  # строк выгрузки, читаемых из БД и записываемых в файл за раз
+
+# Буферизованная запись логов ошибок и действий админов
+LOG_BUFFER_SIZE = 1000  # записей в памяти до сброса в БД (при переполнении вытесняются самые старые)
+LOG_FLUSH_INTERVAL = 2  # сек между сбросами
+LOG_DEDUP_WINDOW = 60  # сек, в течение которых одинаковые ошибки склеиваются в одну запись
+LOG_RETENTION_DAYS = int(os.getenv('LOG_RETENTION_DAYS', '30'))
+ADMIN_LOG_RETENTION_DAYS = int(os.getenv('ADMIN_LOG_RETENTION_DAYS', '180'))
+
+# Хранилище FSM в SQLite (состояния переживают перезапуск)
+FSM_FLUSH_DELAY = 0.5  # сек: изменения за это время уходят в БД одной транзакцией
+FSM_CACHE_MAX = 5000  # ключей в памяти (LRU)
+FSM_STATE_TTL_HOURS = int(os.getenv('FSM_STATE_TTL_HOURS', '72'))  # брошенные состояния старше этого удаляются
+
+
+# --- ХРАНИЛИЩЕ FSM ---
+
+class SQLiteStorage(BaseStorage):
+    """
+    FSM-хранилище aiogram поверх таблицы fsm_storage. Чтение — из LRU-кеша в памяти,
+    запись — отложенная: все изменения за FSM_FLUSH_DELAY сбрасываются одним коммитом.
+    Использует общее соединение db, поэтому работает только после init_db.
+    """
+
+    def __init__(self):
+        self.cache = OrderedDict()  # {ключ: {"state": str | None, "data": dict, "touched": время записи}}
+        self.dirty = set()
+        self.flush_task: Optional[asyncio.Task] = None
+        self.last_gc = 0.0
+
+    @staticmethod
+    def make_key(key: StorageKey):
+        return ":".join(str(part) if part is not None else "" for part in (
+            key.bot_id, key.chat_id, key.user_id, key.thread_id,
+            getattr(key, "business_connection_id", None), key.destiny
+        ))
+
+    async def load(self, key: StorageKey):
+        skey = self.make_key(key)
+        entry = self.cache.get(skey)
+        if entry is None:
+            async with db.execute("SELECT state, data, updated_at FROM fsm_storage WHERE key = ?", (skey,)) as c:
+                row = await c.fetchone()
+            # Пока ждали БД, запись могла появиться в кеше — она свежее
+            entry = self.cache.setdefault(skey, {"state": row[0] if row else None,
+                                                 "data": json.loads(row[1]) if row and row[1] else {},
+                                                 "touched": row[2] if row else time.time()})
+            self.evict()
+        self.cache.move_to_end(skey)
+        return skey, entry
+
+    def evict(self):
+        # Несохраненные ключи не вытесняем, иначе изменение потеряется
+        for skey in list(self.cache):
+            if len(self.cache) <= FSM_CACHE_MAX:
+                break
+            if skey not in self.dirty:
+                del self.cache[skey]
+
+    def mark_dirty(self, skey):
+        self.dirty.add(skey)
+        if self.flush_task is None or self.flush_task.done():
+            self.flush_task = asyncio.create_task(self.flush_later())
+
+    async def flush_later(self):
+        # Изменения, пришедшие во время записи, уходят следующим проходом
+        while self.dirty:
+            await asyncio.sleep(FSM_FLUSH_DELAY)
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f"Ошибка записи FSM: {e}")
+                return
+
+    async def flush(self):
+        """Пишет накопленные изменения одной транзакцией и подчищает кеш"""
+        keys, self.dirty = self.dirty, set()
+        upserts, deletes = [], []
+        for skey in keys:
+            entry = self.cache.get(skey)
+            if entry is None:
+                continue
+            if entry["state"] is None and not entry["data"]:
+                deletes.append((skey,))
+            else:
+                entry["touched"] = time.time()
+                upserts.append((skey, entry["state"], json.dumps(entry["data"], ensure_ascii=False), entry["touched"]))
+
+        if upserts:
+            await db.executemany(
+                """INSERT INTO fsm_storage (key, state, data, updated_at) VALUES (?, ?, ?, ?)
+                   ON CONFLICT(key) DO UPDATE SET state = excluded.state, data = excluded.data,
+                   updated_at = excluded.updated_at""",
+                upserts
+            )
+        if deletes:
+            await db.executemany("DELETE FROM fsm_storage WHERE key = ?", deletes)
+        collect = time.monotonic() - self.last_gc >= 3600
+        if collect:
+            # Брошенные на полпути диалоги (рассылка, ответ на тикет, код комнаты)
+            cutoff = time.time() - FSM_STATE_TTL_HOURS * 3600
+            await db.execute("DELETE FROM fsm_storage WHERE updated_at < ?", (cutoff,))
+            for skey in [k for k, entry in self.cache.items() if entry["touched"] < cutoff and k not in self.dirty]:
+                del self.cache[skey]
+            self.last_gc = time.monotonic()
+        if upserts or deletes or collect:
+            await db.commit()
+        self.evict()
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        skey, entry = await self.load(key)
+        entry["state"] = state.state if isinstance(state, State) else state
+        self.mark_dirty(skey)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        _, entry = await self.load(key)
+        return entry["state"]
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        skey, entry = await self.load(key)
+        entry["data"] = dict(data)
+        self.mark_dirty(skey)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        _, entry = await self.load(key)
+        return dict(entry["data"])
+
+    async def close(self) -> None:
+        # Отложенную запись дожидаемся, а не отменяем: иначе можно потерять ключи посреди flush
+        if self.flush_task and not self.flush_task.done():
+            await self.flush_task
+        if self.dirty:
+            await self.flush()
+
+
+fsm_storage = SQLiteStorage()
+
 # Глобальные переменные
 http_client: aiohttp.ClientSession = None
 db: aiosqlite.Connection = None # Глобальная переменная для БД
 bot: Bot = None
-dp = Dispatcher()
+dp = Dispatcher(storage=fsm_storage)
+outbound_queue: asyncio.PriorityQueue = None  # Очередь на глобальные слоты отправки (создается в main)
+tmdb_queue: asyncio.PriorityQueue = None  # Очередь на слоты запросов к TMDB (создается в main)
 
 
 
@@ -56,6 +315,215 @@ def get_now():
     return datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
 
+# --- МЕТРИКИ ---
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)  # сек
+histograms = {}  # {(метрика, метка): {"buckets": [...], "sum": float, "count": int}}
+counters = {}  # {(метрика, метка): int}
+sql_labels = {}  # {sql: "select user_votes"} — чтобы не гонять регулярку на каждый запрос
+
+
+def observe(metric, label, seconds):
+    """Добавляет замер в гистограмму задержек"""
+    hist = histograms.get((metric, label))
+    if hist is None:
+        hist = histograms[(metric, label)] = {"buckets": [0] * (len(LATENCY_BUCKETS) + 1), "sum": 0.0, "count": 0}
+    hist["buckets"][bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+    hist["sum"] += seconds
+    hist["count"] += 1
+
+
+def inc_counter(metric, label="", value=1):
+    counters[(metric, label)] = counters.get((metric, label), 0) + value
+
+
+def sql_label(sql):
+    """Короткая метка запроса: операция + таблица"""
+    label = sql_labels.get(sql)
+    if label is None:
+        verb = sql.split(None, 1)[0].lower() if sql.strip() else "?"
+        table = re.search(r"\b(?:FROM|INTO|UPDATE|TABLE|ON)\s+(?:IF\s+NOT\s+EXISTS\s+)?(\w+)", sql, re.IGNORECASE)
+        label = f"{verb} {table.group(1)}" if table else verb
+        if len(sql_labels) < 1000:
+            sql_labels[sql] = label
+    return label
+
+
+class TimedConnection:
+    """Обертка над соединением aiosqlite: замеряет время execute/executemany/commit для метрик"""
+
+    def __init__(self, conn):
+        self._conn = conn
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    @contextmanager
+    async def execute(self, sql, parameters=None):
+        start = time.perf_counter()
+        try:
+            return await self._conn.execute(sql, parameters)
+        finally:
+            observe("moviematch_db_seconds", sql_label(sql), time.perf_counter() - start)
+
+    @contextmanager
+    async def executemany(self, sql, parameters):
+        start = time.perf_counter()
+        try:
+            return await self._conn.executemany(sql, parameters)
+        finally:
+            observe("moviematch_db_seconds", sql_label(sql), time.perf_counter() - start)
+
+    async def commit(self):
+        start = time.perf_counter()
+        try:
+            return await self._conn.commit()
+        finally:
+            observe("moviematch_db_seconds", "commit", time.perf_counter() - start)
+
+
+async def telegram_timing_middleware(make_request, bot, method):
+    """Миддлварь сессии бота: время каждого запроса к Telegram API по имени метода"""
+    start = time.perf_counter()
+    try:
+        return await make_request(bot, method)
+    except Exception:
+        inc_counter("moviematch_telegram_errors_total", type(method).__name__)
+        raise
+    finally:
+        observe("moviematch_telegram_seconds", type(method).__name__, time.perf_counter() - start)
+
+
+def render_metrics():
+    """Все метрики в текстовом формате Prometheus"""
+
+    def esc(value):
+        return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+    label_names = {
+        "moviematch_update_seconds": "handler", "moviematch_db_seconds": "query",
+        "moviematch_tmdb_seconds": "endpoint", "moviematch_telegram_seconds": "method",
+        "moviematch_updates_total": "handler", "moviematch_update_errors_total": "handler",
+        "moviematch_telegram_errors_total": "method", "moviematch_webapp_seconds": "path",
+        "moviematch_poster_requests_total": "result",
+    }
+    lines = []
+    typed = set()
+    for (metric, label), hist in sorted(histograms.items()):
+        if metric not in typed:
+            lines.append(f"# TYPE {metric} histogram")
+            typed.add(metric)
+        lbl = f'{label_names.get(metric, "label")}="{esc(label)}"'
+        total = 0
+        for bound, count in zip(LATENCY_BUCKETS + ("+Inf",), hist["buckets"]):
+            total += count
+            lines.append(f'{metric}_bucket{{{lbl},le="{bound}"}} {total}')
+        lines.append(f"{metric}_sum{{{lbl}}} {hist['sum']:.6f}")
+        lines.append(f"{metric}_count{{{lbl}}} {hist['count']}")
+
+    for (metric, label), value in sorted(counters.items()):
+        if metric not in typed:
+            lines.append(f"# TYPE {metric} counter")
+            typed.add(metric)
+        lbl = f'{{{label_names.get(metric, "label")}="{esc(label)}"}}' if label else ""
+        lines.append(f"{metric}{lbl} {value}")
+
+    # Счетчики слоя TMDB, журналов и размеры структур в памяти
+    for key, value in log_stats.items():
+        lines.append(f"# TYPE moviematch_logs_{key}_total counter")
+        lines.append(f"moviematch_logs_{key}_total {value}")
+    for key, value in tmdb_stats.items():
+        lines.append(f"# TYPE moviematch_tmdb_{key}_total counter")
+        lines.append(f"moviematch_tmdb_{key}_total {value}")
+    for key, value in flood_stats.items():
+        lines.append(f"# TYPE moviematch_updates_{key}_total counter")
+        lines.append(f"moviematch_updates_{key}_total {value}")
+    lines.append("# TYPE moviematch_rooms gauge")
+    lines.append(f"moviematch_rooms {len(rooms)}")
+    lines.append("# TYPE moviematch_users_in_rooms gauge")
+    lines.append(f"moviematch_users_in_rooms {len(user_to_room)}")
+    return "\n".join(lines) + "\n"
+
+
+# --- СОСТОЯНИЕ ПРОЦЕССА ---
+
+runtime_stats = {"loop_lag_ms": 0.0, "loop_lag_max_ms": 0.0, "started_at": time.time()}
+
+
+async def loop_lag_monitor():
+    """Раз в секунду меряет, насколько event loop опаздывает с пробуждением"""
+    while True:
+        start = time.monotonic()
+        await asyncio.sleep(1)
+        lag_ms = max(0.0, (time.monotonic() - start - 1) * 1000)
+        runtime_stats["loop_lag_ms"] = lag_ms
+        # Максимум плавно «забывается», чтобы один старый всплеск не висел вечно
+        runtime_stats["loop_lag_max_ms"] = max(lag_ms, runtime_stats["loop_lag_max_ms"] * 0.98)
+
+
+def get_rss_mb():
+    """Текущая резидентная память процесса в МБ"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024 / 1024
+    except (OSError, ValueError, AttributeError):
+        import resource  # Не Linux: берем пиковое значение
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def get_health_snapshot():
+    """Дешевый срез состояния процесса: только счетчики и размеры, без запросов к БД"""
+    tasks = asyncio.all_tasks()
+    task_names = [getattr(t.get_coro(), "__name__", "") for t in tasks]
+
+    tmdb_lookups = tmdb_stats["cache_hits"] + tmdb_stats["coalesced"] + tmdb_stats["requests"]
+    tx_queue = getattr(db, "_tx", None) if db else None
+
+    return {
+        "loop_lag_ms": runtime_stats["loop_lag_ms"],
+        "loop_lag_max_ms": runtime_stats["loop_lag_max_ms"],
+        "tasks": len(tasks),
+        "room_watchers": task_names.count("watch_room_inactivity") + task_names.count("auto_close_room"),
+        "broadcasts": len(active_broadcasts),
+        "rooms": len(rooms),
+        "users_in_rooms": len(user_to_room),
+        "tmdb_hit_rate": (tmdb_stats["cache_hits"] + tmdb_stats["coalesced"]) / tmdb_lookups * 100 if tmdb_lookups else 0.0,
+        "tmdb_error_rate": tmdb_stats["errors"] / tmdb_stats["requests"] * 100 if tmdb_stats["requests"] else 0.0,
+        "tmdb_breaker_open": time.monotonic() < tmdb_breaker["open_until"],
+        "tmdb_cache_size": len(tmdb_cache),
+        "db_queue": tx_queue.qsize() if tx_queue is not None else 0,
+        "log_queue": len(admin_log_buffer) + sum(1 for e in pending_errors.values() if not e["written"]),
+        "logs_dropped": log_stats["dropped"],
+        "tg_queue": outbound_queue.qsize() if outbound_queue else 0,
+        "tmdb_queue": tmdb_queue.qsize() if tmdb_queue else 0,
+        "rss_mb": get_rss_mb(),
+        "uptime_h": (time.time() - runtime_stats["started_at"]) / 3600,
+    }
+
+
+async def metrics_handler(request):
+    return web.Response(text=render_metrics(), content_type="text/plain")
+
+
+async def start_metrics_server():
+    """Поднимает /metrics на 127.0.0.1:METRICS_PORT. Возвращает runner (или None, если выключено)"""
+    if not METRICS_PORT:
+        return None
+    app = web.Application()
+    app.router.add_get("/metrics", metrics_handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, "127.0.0.1", METRICS_PORT).start()
+    except OSError as e:
+        # Порт занят (например, node_exporter) — бот работает и без метрик
+        print(f"Метрики не запущены (порт {METRICS_PORT}): {e}")
+        await runner.cleanup()
+        return None
+    print(f"Метрики: http://127.0.0.1:{METRICS_PORT}/metrics")
+    return runner
+
+
 # --- СОСТОЯНИЯ ---
 class AdminStates(StatesGroup):
     waiting_for_broadcast_content = State()
@@ -90,11 +558,23 @@ GENRES = {
 
 ENABLED_GENRES = list(GENRES.keys())
 
+# Все жанры TMDB (для аналитики: в выдаче у фильмов бывают и те, что не в меню)
+TMDB_GENRE_NAMES = {
+    '28': 'Боевик', '12': 'Приключения', '16': 'Мультфильм', '35': 'Комедия',
+    '80': 'Криминал', '99': 'Документальный', '18': 'Драма', '10751': 'Семейный',
+    '14': 'Фэнтези', '36': 'История', '27': 'Ужасы', '10402': 'Музыка',
+    '9648': 'Детектив', '10749': 'Мелодрама', '878': 'Фантастика', '10770': 'ТВ фильм',
+    '53': 'Триллер', '10752': 'Военный', '37': 'Вестерн', None: 'Все жанры'
+}
+
 
 # --- РАБОТА С БАЗОЙ ДАННЫХ ---
 
 async def init_db():
 
+    # WAL: читатели (бэкап, архивация) не блокируют запись голосов
+    await db.execute("PRAGMA journal_mode=WAL")
+
     # 1. Создаем таблицу пользователей (базовая структура)
     await db.execute('''CREATE TABLE IF NOT EXISTS users 
                         (user_id INTEGER PRIMARY KEY, username TEXT, first_name TEXT, 
@@ -161,20 +641,130 @@ async def init_db():
     await db.commit()
 
     await db.execute("CREATE INDEX IF NOT EXISTS idx_user_votes_lookup ON user_votes (user_id, movie_id)")
+
+    # Индексы под аналитику и рассылки (проверяются benchmarks/db_bench.py)
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_user_votes_likes_by_movie ON user_votes (is_like, movie_id, movie_title)")
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_user_votes_added_at ON user_votes (added_at)")
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_users_blocked ON users (is_blocked)")
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_users_joined ON users (joined_date)")
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_users_last_active ON users (last_active)")
+    # Очередь тикетов: страница по ключу (created_at, id) внутри статуса, id индекс хранит неявно
+    async with db.execute("SELECT 1 FROM sqlite_master WHERE name = 'idx_tickets_status_created'") as c:
+        tickets_index_exists = await c.fetchone() is not None
+    if not tickets_index_exists:
+        # Разово: у старых тикетов created_at мог остаться NULL — такие строки не попали бы ни на одну
+        # страницу. Новые тикеты create_ticket всегда пишет с датой
+        await db.execute("UPDATE tickets SET created_at = '' WHERE created_at IS NULL")
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_tickets_status_created ON tickets (status, created_at)")
+    # Лайки конкретного пользователя (без него планировщик берет индекс по is_like и читает все лайки базы)
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_user_votes_user_likes ON user_votes (user_id, is_like)")
+
+    # Локальный каталог: сохраненные ответы TMDB и сводка по фильмам
+    await db.execute('''CREATE TABLE IF NOT EXISTS tmdb_cache 
+                        (cache_key TEXT PRIMARY KEY, payload TEXT, fetched_at REAL)''')
+    await db.execute('''CREATE TABLE IF NOT EXISTS movie_catalog 
+                        (movie_id TEXT PRIMARY KEY, title TEXT, overview TEXT, poster_path TEXT,
+                         release_date TEXT, vote_average REAL, genre_ids TEXT, trailer_url TEXT,
+                         updated_at TIMESTAMP)''')
+
+    # Просмотренные фильмы: отсортированный массив uint32 movie_id одной строкой на пользователя
+    await db.execute('''CREATE TABLE IF NOT EXISTS user_seen 
+                        (user_id INTEGER PRIMARY KEY, ids BLOB)''')
+
+    # Сколько голосов пользователя уехало в архив (для статистики профиля) и в какие файлы (для /export)
+    await db.execute('''CREATE TABLE IF NOT EXISTS user_vote_archive 
+                        (user_id INTEGER PRIMARY KEY, dislikes INTEGER DEFAULT 0, archived_at TIMESTAMP,
+                         months TEXT)''')
+    cursor = await db.execute("PRAGMA table_info(user_vote_archive)")
+    if 'months' not in [row[1] for row in await cursor.fetchall()]:
+        # NULL — архивировано до появления колонки: /export просмотрит все файлы архива
+        await db.execute("ALTER TABLE user_vote_archive ADD COLUMN months TEXT")
+
+    # Дневные сводки: пересчитываются фоновой задачей, экраны трендов читают только их
+    await db.execute('''CREATE TABLE IF NOT EXISTS daily_stats 
+                        (day TEXT PRIMARY KEY, new_users INTEGER DEFAULT 0, active_users INTEGER DEFAULT 0,
+                         votes INTEGER DEFAULT 0, likes INTEGER DEFAULT 0, matches INTEGER DEFAULT 0)''')
+    await db.execute('''CREATE TABLE IF NOT EXISTS daily_genre_likes 
+                        (day TEXT, genre_id TEXT, likes INTEGER, PRIMARY KEY (day, genre_id))''')
+
+    # Индекс рекомендаций: для каждого фильма RECS_TOP_K похожих (косинус по лайкам)
+    await db.execute('''CREATE TABLE IF NOT EXISTS movie_similar 
+                        (movie_id TEXT, similar_id TEXT, score REAL, PRIMARY KEY (movie_id, similar_id)) WITHOUT ROWID''')
+    await db.execute('''CREATE TABLE IF NOT EXISTS recommender_state 
+                        (id INTEGER PRIMARY KEY CHECK (id = 1), last_rowid INTEGER, full_built_at REAL)''')
+
+    # Последнее примененное меню команд по чатам (chat_id = 0 — меню по умолчанию)
+    await db.execute('''CREATE TABLE IF NOT EXISTS command_sync 
+                        (chat_id INTEGER PRIMARY KEY, commands_hash TEXT, updated_at TIMESTAMP)''')
+
+    # Состояния FSM (SQLiteStorage): ключ — бот, чат, пользователь, тред; data — JSON
+    await db.execute('''CREATE TABLE IF NOT EXISTS fsm_storage 
+                        (key TEXT PRIMARY KEY, state TEXT, data TEXT, updated_at REAL)''')
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_fsm_storage_updated ON fsm_storage (updated_at)")
+
+    # Поиск пользователей в админке: FTS5 по username и имени, контент берется из самой users
+    async with db.execute("SELECT 1 FROM sqlite_master WHERE name = 'users_fts'") as c:
+        fts_exists = await c.fetchone() is not None
+    await db.execute('''CREATE VIRTUAL TABLE IF NOT EXISTS users_fts 
+                        USING fts5(username, first_name, content='users', content_rowid='user_id')''')
+    await db.execute('''CREATE TRIGGER IF NOT EXISTS users_fts_insert AFTER INSERT ON users BEGIN
+                            INSERT INTO users_fts (rowid, username, first_name)
+                            VALUES (new.user_id, new.username, new.first_name);
+                        END''')
+    await db.execute('''CREATE TRIGGER IF NOT EXISTS users_fts_delete AFTER DELETE ON users BEGIN
+                            INSERT INTO users_fts (users_fts, rowid, username, first_name)
+                            VALUES ('delete', old.user_id, old.username, old.first_name);
+                        END''')
+    # Срабатывает только при смене имени, а не на каждое обновление last_active
+    await db.execute('''CREATE TRIGGER IF NOT EXISTS users_fts_update AFTER UPDATE OF username, first_name ON users
+                        WHEN old.username IS NOT new.username OR old.first_name IS NOT new.first_name BEGIN
+                            INSERT INTO users_fts (users_fts, rowid, username, first_name)
+                            VALUES ('delete', old.user_id, old.username, old.first_name);
+                            INSERT INTO users_fts (rowid, username, first_name)
+                            VALUES (new.user_id, new.username, new.first_name);
+                        END''')
+    if not fts_exists:
+        await db.execute("INSERT INTO users_fts (users_fts) VALUES ('rebuild')")
+
+    # Сводка голосов пользователя (с учетом архива): обновляется в add_vote/delete_like
+    await db.execute('''CREATE TABLE IF NOT EXISTS user_stats 
+                        (user_id INTEGER PRIMARY KEY, votes INTEGER DEFAULT 0, likes INTEGER DEFAULT 0)''')
     await db.commit()
 
 
+async def get_archived_votes(user_id):
+    async with db.execute("SELECT dislikes FROM user_vote_archive WHERE user_id = ?", (user_id,)) as c:
+        row = await c.fetchone()
+        return row[0] if row else 0
+
+
+async def get_vote_counts(user_id):
+    """(всего голосов, лайков) из user_stats. При первом обращении строка строится по истории голосов"""
+    async with db.execute("SELECT votes, likes FROM user_stats WHERE user_id = ?", (user_id,)) as c:
+        row = await c.fetchone()
+    if row is None:
+        # Одним запросом, чтобы параллельный голос или архивация не попали между подсчетами.
+        # Старые дизлайки лежат в архиве, но в статистике учитываются
+        await db.execute(
+            """INSERT OR IGNORE INTO user_stats (user_id, votes, likes)
+               SELECT ?, COUNT(*) + COALESCE((SELECT dislikes FROM user_vote_archive WHERE user_id = ?), 0),
+                      COALESCE(SUM(is_like), 0)
+               FROM user_votes WHERE user_id = ?""",
+            (user_id, user_id, user_id)
+        )
+        await db.commit()
+        async with db.execute("SELECT votes, likes FROM user_stats WHERE user_id = ?", (user_id,)) as c:
+            row = await c.fetchone()
+    return row[0], row[1]
+
+
 async def get_user_stats(user_id):
 
-    async with db.execute("SELECT COUNT(*) FROM user_votes WHERE user_id = ?", (user_id,)) as c:
-        total_votes = (await c.fetchone())[0]
+    total_votes, likes = await get_vote_counts(user_id)
 
     if total_votes == 0:
         return None
 
-    async with db.execute("SELECT COUNT(*) FROM user_votes WHERE user_id = ? AND is_like = 1", (user_id,)) as c:
-        likes = (await c.fetchone())[0]
-
     async with db.execute("SELECT joined_date FROM users WHERE user_id = ?", (user_id,)) as c:
         user_data = await c.fetchone()
 
@@ -224,11 +814,18 @@ async def get_user_stats(user_id):
 
 # --- Остальные функции без изменений ---
 
-async def log_admin_action(admin_id, action, details=""):
+# --- ЖУРНАЛЫ (пишутся пачками в фоне) ---
 
-    await db.execute("INSERT INTO admin_logs (admin_id, action, details, timestamp) VALUES (?, ?, ?, ?)",
-                     (admin_id, action, details, get_now()))
-    await db.commit()
+admin_log_buffer = deque(maxlen=LOG_BUFFER_SIZE)  # [(admin_id, action, details, timestamp)]
+pending_errors = {}  # {текст: {"time", "repeats", "since", "written"}}
+log_stats = {"written": 0, "dropped": 0, "deduped": 0}
+
+
+async def log_admin_action(admin_id, action, details=""):
+    # Не пишем в БД сразу: запись уйдет пачкой в log_flusher
+    if len(admin_log_buffer) == admin_log_buffer.maxlen:
+        log_stats["dropped"] += 1  # deque сама вытеснит самую старую запись
+    admin_log_buffer.append((admin_id, action, details, get_now()))
 
 
 async def is_admin(user_id):
@@ -238,11 +835,75 @@ async def is_admin(user_id):
 
 
 async def log_error(error_text):
+    text = str(error_text)
+    entry = pending_errors.get(text)
+    if entry:
+        # Такая ошибка уже была недавно — только считаем повторы
+        entry["repeats"] += 1
+        log_stats["deduped"] += 1
+        return
+    if len(pending_errors) >= LOG_BUFFER_SIZE:
+        # Свежие ошибки важнее: вытесняем самую старую (dict хранит порядок добавления)
+        oldest = next(iter(pending_errors))
+        if not pending_errors.pop(oldest)["written"]:
+            log_stats["dropped"] += 1
+    pending_errors[text] = {"time": get_now(), "repeats": 0, "since": time.monotonic(), "written": False}
+
+
+async def flush_logs():
+    """Сбрасывает накопленные логи в БД одной транзакцией"""
+    error_rows = []
+    now = time.monotonic()
+    for text, entry in list(pending_errors.items()):
+        if not entry["written"]:
+            error_rows.append((text, entry["time"]))
+            entry["written"] = True
+        if now - entry["since"] >= LOG_DEDUP_WINDOW:
+            # Окно склейки закрыто: одной строкой пишем, сколько раз ошибка повторилась
+            if entry["repeats"]:
+                error_rows.append((f"{text} (повторов за {LOG_DEDUP_WINDOW} сек: {entry['repeats']})", get_now()))
+            del pending_errors[text]
+
+    admin_rows = list(admin_log_buffer)
+    admin_log_buffer.clear()
+
+    if not error_rows and not admin_rows:
+        return
     try:
-        await db.execute("INSERT INTO logs (error, time) VALUES (?, ?)", (str(error_text), get_now()))
+        if error_rows:
+            await db.executemany("INSERT INTO logs (error, time) VALUES (?, ?)", error_rows)
+        if admin_rows:
+            await db.executemany(
+                "INSERT INTO admin_logs (admin_id, action, details, timestamp) VALUES (?, ?, ?, ?)", admin_rows
+            )
         await db.commit()
-    except:
-        pass
+    except Exception:
+        # Пачка уже вынута из буферов — учитываем ее как потерянную
+        log_stats["dropped"] += len(error_rows) + len(admin_rows)
+        raise
+    log_stats["written"] += len(error_rows) + len(admin_rows)
+
+
+async def prune_logs():
+    """Удаляет логи старше срока хранения"""
+    await db.execute("DELETE FROM logs WHERE time < datetime('now', ?, 'localtime')", (f"-{LOG_RETENTION_DAYS} days",))
+    await db.execute("DELETE FROM admin_logs WHERE timestamp < datetime('now', ?, 'localtime')",
+                     (f"-{ADMIN_LOG_RETENTION_DAYS} days",))
+    await db.commit()
+
+
+async def log_flusher():
+    """Фоновая запись логов: сброс каждые LOG_FLUSH_INTERVAL сек, чистка старых записей раз в час"""
+    last_prune = 0.0
+    while True:
+        await asyncio.sleep(LOG_FLUSH_INTERVAL)
+        try:
+            await flush_logs()
+            if time.monotonic() - last_prune >= 3600:
+                await prune_logs()
+                last_prune = time.monotonic()
+        except Exception as e:
+            print(f"Ошибка записи логов: {e}")
 
 
 async def is_user_blocked(user_id):
@@ -274,23 +935,129 @@ async def register_user(user_id, username, first_name, lang_code):
         (user_id, username, first_name, now, now, lang_code)
     )
     await db.commit()
+    user_languages.pop(user_id, None)
+
+
+user_languages = OrderedDict()  # {user_id: локаль TMDB} — LRU
+
+
+def tmdb_language(lang_code):
+    """Локаль TMDB по language_code из Telegram ("en", "pt-br", "unknown"...)"""
+    return TMDB_LANGUAGES.get((lang_code or "").split("-")[0].lower(), TMDB_DEFAULT_LANGUAGE)
+
+
+async def get_user_language(user_id):
+    language = user_languages.get(user_id)
+    if language is None:
+        async with db.execute("SELECT language_code FROM users WHERE user_id = ?", (user_id,)) as c:
+            row = await c.fetchone()
+        language = tmdb_language(row[0] if row else None)
+        user_languages[user_id] = language
+        while len(user_languages) > USER_LANGUAGE_CACHE_MAX:
+            user_languages.popitem(last=False)
+    user_languages.move_to_end(user_id)
+    return language
 
 
 async def add_vote(user_id, movie_id, title, is_like):
+    await record_vote(user_id, movie_id, title, is_like)
+    await db.commit()
+    if is_like:
+        likes_count_cache.pop(user_id, None)
+
+
+async def add_votes(user_id, votes):
+    """Пачка голосов [(movie_id, title, is_like)] одной транзакцией. Фильмы, за которые уже голосовали,
+    пропускаются — повторная отправка той же пачки ничего не задвоит. Возвращает число записанных голосов"""
+    seen_ids = await get_user_seen(user_id)
+    added = 0
+    for movie_id, title, is_like in votes:
+        if str(movie_id).isdigit() and is_seen(seen_ids, movie_id):
+            continue
+        await record_vote(user_id, movie_id, title, is_like)
+        added += 1
+    await db.commit()
+    likes_count_cache.pop(user_id, None)
+    return added
 
+
+async def record_vote(user_id, movie_id, title, is_like):
+    """Голос, отметка «просмотрено» и счетчики user_stats. Коммит — на вызывающем"""
     # Обновлено использование movie_title вместо title для соответствия запросу статистики
     await db.execute(
         "INSERT INTO user_votes (user_id, movie_id, movie_title, is_like, added_at) VALUES (?, ?, ?, ?, ?)",
         (user_id, str(movie_id), title, is_like, get_now())
     )
-    await db.commit()
+    await mark_seen(user_id, movie_id)  # В той же транзакции, что и голос
+    # Строки еще нет — ее построит get_vote_counts, уже с этим голосом
+    await db.execute(
+        "UPDATE user_stats SET votes = votes + 1, likes = likes + ? WHERE user_id = ?",
+        (1 if is_like else 0, user_id)
+    )
+
+
+# --- ПРОСМОТРЕННЫЕ ФИЛЬМЫ ---
+# Вместо чтения всех строк user_votes храним id фильмов пользователя упакованным
+# отсортированным массивом (4 байта на фильм) в user_seen: загрузка — одна строка, проверка — бинарный поиск.
 
+seen_cache = OrderedDict()  # {user_id: array('I')} — LRU
 
-async def get_user_seen_ids(user_id):
 
-    async with db.execute("SELECT movie_id FROM user_votes WHERE user_id = ?", (user_id,)) as cursor:
+async def get_user_seen(user_id):
+    """Отсортированный array('I') id фильмов, за которые пользователь уже голосовал"""
+    ids = seen_cache.get(user_id)
+    if ids is not None:
+        seen_cache.move_to_end(user_id)
+        return ids
+
+    # Один запрос — один снимок: либо готовый массив, либо (при первом обращении) вся история голосов.
+    # Двумя запросами архиватор мог бы между ними перенести голоса, и в кеш попал бы неполный массив
+    async with db.execute(
+        """SELECT 1, ids FROM user_seen WHERE user_id = ?
+           UNION ALL
+           SELECT 0, movie_id FROM user_votes
+           WHERE user_id = ? AND NOT EXISTS (SELECT 1 FROM user_seen WHERE user_id = ?)""",
+        (user_id, user_id, user_id)
+    ) as cursor:
         rows = await cursor.fetchall()
-        return {row[0] for row in rows}
+
+    if rows and rows[0][0] == 1:
+        ids = array('I')
+        ids.frombytes(rows[0][1] or b"")
+    else:
+        # Первое обращение: собираем массив из истории голосов и сохраняем
+        ids = array('I', sorted({int(r[1]) for r in rows if str(r[1]).isdigit()}))
+        await db.execute("INSERT OR IGNORE INTO user_seen (user_id, ids) VALUES (?, ?)", (user_id, ids.tobytes()))
+        await db.commit()
+
+    # Пока мы ждали БД, массив мог загрузить параллельный запрос — работаем с одним объектом
+    ids = seen_cache.setdefault(user_id, ids)
+    seen_cache.move_to_end(user_id)
+    while len(seen_cache) > SEEN_CACHE_MAX:
+        seen_cache.popitem(last=False)
+    return ids
+
+
+def is_seen(seen_ids, movie_id):
+    movie_id = int(movie_id)
+    i = bisect.bisect_left(seen_ids, movie_id)
+    return i < len(seen_ids) and seen_ids[i] == movie_id
+
+
+async def mark_seen(user_id, movie_id):
+    """Добавляет фильм в массив просмотренных. Коммит — на вызывающем"""
+    if not str(movie_id).isdigit():
+        return
+    ids = await get_user_seen(user_id)
+    movie_id = int(movie_id)
+    i = bisect.bisect_left(ids, movie_id)
+    if i < len(ids) and ids[i] == movie_id:
+        return
+    ids.insert(i, movie_id)
+    await db.execute(
+        "INSERT INTO user_seen (user_id, ids) VALUES (?, ?) ON CONFLICT(user_id) DO UPDATE SET ids = excluded.ids",
+        (user_id, ids.tobytes())
+    )
 
 
 async def get_full_likes(user_id, limit=None):
@@ -311,13 +1078,65 @@ async def get_full_likes(user_id, limit=None):
         return await cursor.fetchall()
 
 
+likes_count_cache = OrderedDict()  # {user_id: число лайков} — LRU, сбрасывается при изменении лайков
+
+
+async def get_likes_count(user_id):
+    if user_id in likes_count_cache:
+        likes_count_cache.move_to_end(user_id)
+        return likes_count_cache[user_id]
+
+    async with db.execute(
+        """SELECT COUNT(*) FROM user_votes
+           WHERE user_id = ? AND is_like = 1 AND movie_title IS NOT NULL AND movie_title != ''""",
+        (user_id,)
+    ) as cursor:
+        count = (await cursor.fetchone())[0]
+
+    likes_count_cache[user_id] = count
+    while len(likes_count_cache) > LIKES_COUNT_CACHE_MAX:
+        likes_count_cache.popitem(last=False)
+    return count
+
+
+async def get_likes_page(user_id, after=0, before=None, limit=LIKES_PAGE_SIZE):
+    """Страница лайков по ключу rowid (idx_user_votes_user_likes): after — строго после, before — строго до.
+    Возвращает [(rowid, movie_id, movie_title)] в порядке добавления"""
+    if before is not None:
+        query = """
+            SELECT rowid, movie_id, movie_title FROM user_votes
+            WHERE user_id = ? AND is_like = 1 AND rowid < ?
+              AND movie_title IS NOT NULL AND movie_title != ''
+            ORDER BY rowid DESC LIMIT ?
+        """
+        params = (user_id, before, limit)
+    else:
+        query = """
+            SELECT rowid, movie_id, movie_title FROM user_votes
+            WHERE user_id = ? AND is_like = 1 AND rowid > ?
+              AND movie_title IS NOT NULL AND movie_title != ''
+            ORDER BY rowid LIMIT ?
+        """
+        params = (user_id, after, limit)
+
+    async with db.execute(query, params) as cursor:
+        rows = await cursor.fetchall()
+    if before is not None:
+        rows = rows[::-1]
+    return rows
+
+
 async def delete_like(user_id, movie_id):
 
-    await db.execute(
-        "UPDATE user_votes SET is_like = 0 WHERE user_id = ? AND movie_id = ?",
+    cursor = await db.execute(
+        "UPDATE user_votes SET is_like = 0 WHERE user_id = ? AND movie_id = ? AND is_like = 1",
         (user_id, str(movie_id))
     )
+    if cursor.rowcount > 0:
+        await db.execute("UPDATE user_stats SET likes = MAX(likes - ?, 0) WHERE user_id = ?",
+                         (cursor.rowcount, user_id))
     await db.commit()
+    likes_count_cache.pop(user_id, None)
 
 
 async def get_global_top():
@@ -350,64 +1169,1266 @@ async def get_targeted_user_ids(target_type):
         return [row[0] for row in rows]
 
 
+def users_fts_query(text):
+    """Запрос FTS5 из ввода админа: каждое слово ищется по префиксу, спецсимволы FTS отбрасываются"""
+    words = re.findall(r"\w+", text.lower())
+    return " ".join(f'"{w}"*' for w in words)
+
+
+async def search_users(text=None, before=None, limit=USERS_PAGE_SIZE):
+    """Пользователи по убыванию user_id: все или найденные по username/имени (users_fts).
+    before — keyset-якорь (строго меньше user_id). Возвращает [(user_id, username, first_name)]"""
+    params = []
+    if text:
+        match = users_fts_query(text)
+        if not match:
+            return []
+        query = """
+            SELECT u.user_id, u.username, u.first_name FROM users_fts
+            JOIN users u ON u.user_id = users_fts.rowid
+            WHERE users_fts MATCH ?
+        """
+        params.append(match)
+        key = "users_fts.rowid"
+    else:
+        query = "SELECT user_id, username, first_name FROM users WHERE 1"
+        key = "user_id"
+    if before is not None:
+        query += f" AND {key} < ?"
+        params.append(before)
+    query += f" ORDER BY {key} DESC LIMIT ?"
+    params.append(limit)
+
+    async with db.execute(query, params) as cursor:
+        return await cursor.fetchall()
+
+
+# --- ТИКЕТЫ ---
+
+open_tickets_cache = {"count": None}  # Число открытых тикетов; None — пересчитать при следующем запросе
+
+
+async def get_open_tickets_count():
+    if open_tickets_cache["count"] is None:
+        async with db.execute("SELECT COUNT(*) FROM tickets WHERE status = 'open'") as c:
+            open_tickets_cache["count"] = (await c.fetchone())[0]
+    return open_tickets_cache["count"]
+
+
+async def get_tickets_page(status, before=None, limit=TICKETS_PAGE_SIZE):
+    """Тикеты со статусом status, новые первыми (idx_tickets_status_created).
+    before — keyset-якорь (created_at, id): строго старше него. Возвращает [(id, user_id, message, created_at)]"""
+    query = "SELECT id, user_id, message, created_at FROM tickets WHERE status = ?"
+    params = [status]
+    if before is not None:
+        query += " AND (created_at, id) < (?, ?)"
+        params.extend(before)
+    query += " ORDER BY created_at DESC, id DESC LIMIT ?"
+    params.append(limit)
+
+    async with db.execute(query, params) as cursor:
+        return await cursor.fetchall()
+
+
+async def create_ticket(user_id, text):
+    await db.execute(
+        "INSERT INTO tickets (user_id, message, status, created_at) VALUES (?, ?, ?, ?)",
+        (user_id, text, "open", datetime.datetime.now().strftime("%Y-%m-%d %H:%M"))
+    )
+    await db.commit()
+    open_tickets_cache["count"] = None
+
+
+async def close_ticket(ticket_id):
+    """Закрывает тикет. Возвращает False, если он уже был закрыт или не найден"""
+    cursor = await db.execute("UPDATE tickets SET status = 'closed' WHERE id = ? AND status = 'open'", (ticket_id,))
+    await db.commit()
+    if cursor.rowcount > 0:
+        open_tickets_cache["count"] = None
+    return cursor.rowcount > 0
+
+
+# --- ОЧЕРЕДЬ ИСХОДЯЩИХ ЗАПРОСОВ TELEGRAM ---
+
+# Приоритеты: чем меньше число, тем раньше запрос получит глобальный слот
+PRIORITY_INTERACTIVE = 0  # ответы на действия пользователя (карточки, меню)
+PRIORITY_NOTIFY = 1  # уведомления (мэтчи, закрытие комнат, ответы поддержки)
+PRIORITY_BROADCAST = 2  # рассылки
+
+outbound_seq = itertools.count()  # Порядок FIFO внутри одного приоритета
+chat_buckets = {}  # {chat_id: TokenBucket}
+in_tg_call = contextvars.ContextVar("in_tg_call", default=False)  # запрос уже идет через tg_call
+
+
+class TokenBucket:
+    """Токен-бакет: rate токенов в секунду, не больше burst подряд"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self):
+        """Забирает токен и возвращает, сколько секунд нужно подождать перед запросом"""
+        self._refill()
+        self.tokens -= 1
+        return 0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def pause(self, seconds):
+        """Ничего не выдавать ближайшие seconds секунд (после 429)"""
+        self._refill()
+        self.tokens = min(self.tokens, -seconds * self.rate)
+
+    def try_take(self):
+        """Забирает токен, если он есть, без ожидания"""
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def is_idle(self):
+        self._refill()
+        return self.tokens >= self.burst
+
+
+global_bucket = TokenBucket(TG_GLOBAL_RATE, TG_GLOBAL_RATE)
+
+
+def get_chat_bucket(chat_id):
+    bucket = chat_buckets.get(chat_id)
+    if bucket is None:
+        # Чистим бакеты чатов, которые давно ничего не получали
+        if len(chat_buckets) > 10000:
+            for cid in [c for c, b in chat_buckets.items() if b.is_idle()]:
+                del chat_buckets[cid]
+        bucket = chat_buckets[chat_id] = TokenBucket(TG_CHAT_RATE, TG_CHAT_BURST)
+    return bucket
+
+
+async def rate_limit_worker(queue, bucket):
+    """Раздает слоты из бакета ожидающим в очереди в порядке приоритета"""
+    while True:
+        priority, _, fut = await queue.get()
+        if fut.done():
+            continue
+        wait = bucket.reserve()
+        if wait > 0:
+            await asyncio.sleep(wait)
+        if not fut.done():
+            fut.set_result(None)
+
+
+async def wait_for_slot(queue, priority):
+    """Встает в очередь и ждет, пока rate_limit_worker выдаст слот"""
+    if queue is None:
+        return
+    fut = asyncio.get_running_loop().create_future()
+    queue.put_nowait((priority, next(outbound_seq), fut))
+    await fut
+
+
+async def tg_call(chat_id, make_call, priority=PRIORITY_INTERACTIVE):
+    """
+    Выполняет запрос к Telegram с учетом лимитов на чат и на весь бот.
+    make_call — функция без аргументов, возвращающая корутину (например lambda: bot.send_message(...)).
+    chat_id=None — запрос без чата (answerCallbackQuery и т.п.): только общий лимит.
+    При 429 ждет retry_after и повторяет, остальные ошибки пробрасывает вызывающему.
+    """
+    for attempt in range(TG_MAX_RETRIES + 1):
+        if chat_id is not None:
+            wait = get_chat_bucket(chat_id).reserve()
+            if wait > 0:
+                await asyncio.sleep(wait)
+
+        await wait_for_slot(outbound_queue, priority)
+
+        token = in_tg_call.set(True)
+        try:
+            return await make_call()
+        except TelegramRetryAfter as e:
+            if attempt == TG_MAX_RETRIES:
+                raise
+            print(f"Telegram 429 для {chat_id}, повтор через {e.retry_after} сек.")
+            if chat_id is not None:
+                get_chat_bucket(chat_id).pause(e.retry_after)
+            # 429 — сигнал, что бот в целом шлет слишком много: притормаживаем все запросы
+            global_bucket.pause(e.retry_after)
+        finally:
+            in_tg_call.reset(token)
+
+
+async def telegram_budget_middleware(make_request, bot, method):
+    """
+    Миддлварь сессии бота: обычные ответы хендлеров (message.answer, edit_text, callback.answer...)
+    тоже идут через tg_call — с лимитами чата и общего бюджета и с повтором после 429
+    """
+    if in_tg_call.get() or isinstance(method, GetUpdates):
+        return await make_request(bot, method)
+    chat_id = getattr(method, "chat_id", None)
+    return await tg_call(chat_id if isinstance(chat_id, int) else None, lambda: make_request(bot, method))
+
+
 # --- ФУНКЦИИ TMDB ---
 
-# Важно: http_client должен быть определен глобально и инициализирован в main()
-async def fetch_movies_page(page=1, genre_id=None):
-    global http_client  # <--- ОБЯЗАТЕЛЬНО ДОБАВИТЬ ЭТУ СТРОКУ
+# Приоритеты запросов к TMDB: пользователь ждет ответа / фоновая подгрузка
+TMDB_PRIORITY_INTERACTIVE = 0
+TMDB_PRIORITY_PREFETCH = 1
 
-    url = f"https://api.themoviedb.org/3/discover/movie?api_key={TMDB_API_KEY}&language=ru-RU&sort_by=popularity.desc&page={page}"
-    if genre_id:
-        url += f"&with_genres={genre_id}"
+tmdb_cache = OrderedDict()  # {ключ запроса: (время загрузки, json)} — LRU
+tmdb_inflight = {}  # {ключ запроса: Future} — запросы, которые уже летят в TMDB
+tmdb_bucket = TokenBucket(TMDB_RATE, TMDB_RATE)
+tmdb_breaker = {"failures": 0, "open_until": 0.0}
+tmdb_stats = {"requests": 0, "errors": 0, "cache_hits": 0, "stale_hits": 0, "coalesced": 0}
 
+
+def tmdb_cache_put(key, data):
+    tmdb_cache[key] = (time.time(), data)
+    tmdb_cache.move_to_end(key)
+    while len(tmdb_cache) > TMDB_CACHE_MAX:
+        tmdb_cache.popitem(last=False)
+
+
+def tmdb_failure():
+    """Учитывает ошибку TMDB и при необходимости размыкает предохранитель"""
+    tmdb_stats["errors"] += 1
+    tmdb_breaker["failures"] += 1
+    if tmdb_breaker["failures"] >= TMDB_BREAKER_THRESHOLD:
+        tmdb_breaker["open_until"] = time.monotonic() + TMDB_BREAKER_COOLDOWN
+        print(f"TMDB недоступен, предохранитель разомкнут на {TMDB_BREAKER_COOLDOWN} сек.")
+
+
+# Важно: http_client должен быть определен глобально и инициализирован в main()
+async def tmdb_request(path, params, priority):
+    """Один реальный запрос к TMDB. Возвращает json или None при ошибке"""
+    await wait_for_slot(tmdb_queue, priority)
+
+    tmdb_stats["requests"] += 1
+    start = time.perf_counter()
     try:
-        # Теперь Python поймет, что http_client — это наша общая сессия
-        async with http_client.get(url, timeout=10) as response:
+        async with http_client.get(
+                f"{TMDB_API_URL}{path}",
+                params={**params, "api_key": TMDB_API_KEY},
+                timeout=aiohttp.ClientTimeout(total=TMDB_TIMEOUT)
+        ) as response:
             if response.status == 200:
-                data = await response.json()
-                return data.get('results', [])
-            return []
+                tmdb_breaker["failures"] = 0
+                return await response.json()
+            if response.status == 404:
+                # Фильма нет — это нормальный ответ, а не поломка TMDB
+                tmdb_breaker["failures"] = 0
+                return {}
+            if response.status == 429:
+                tmdb_bucket.pause(float(response.headers.get("Retry-After", 1)))
+            print(f"Ошибка TMDB {path}: HTTP {response.status}")
     except Exception as e:
-        print(f"Ошибка TMDB: {e}")
-        return []
+        print(f"Ошибка TMDB {path}: {e}")
+    finally:
+        observe("moviematch_tmdb_seconds", re.sub(r"/\d+", "/{id}", path), time.perf_counter() - start)
+    tmdb_failure()
+    return None
+
+
+async def tmdb_get(path, params=None, priority=TMDB_PRIORITY_INTERACTIVE, ttl=TMDB_CACHE_TTL):
+    """
+    GET к TMDB через общий слой: кеш, склейка одинаковых запросов в один, лимит запросов
+    с приоритетами и предохранитель. Если TMDB не отвечает — отдает устаревшие данные из кеша.
+    Возвращает json или None, если данных нет совсем.
+    """
+    params = dict(params or {})
+    key = path + "?" + urlencode(sorted(params.items()))
+
+    cached = tmdb_cache.get(key)
+    if cached and time.time() - cached[0] < ttl:
+        tmdb_cache.move_to_end(key)
+        tmdb_stats["cache_hits"] += 1
+        return cached[1]
+    stale = cached[1] if cached else None
+
+    # Предохранитель разомкнут — не ждем таймаутов, отдаем то, что есть
+    if time.monotonic() < tmdb_breaker["open_until"]:
+        if stale is not None:
+            tmdb_stats["stale_hits"] += 1
+        return stale
+
+    # Такой же запрос уже в полете — ждем его результат
+    if key in tmdb_inflight:
+        tmdb_stats["coalesced"] += 1
+        return await asyncio.shield(tmdb_inflight[key])
+
+    fut = asyncio.get_running_loop().create_future()
+    tmdb_inflight[key] = fut
+    result = stale
+    try:
+        data = await tmdb_request(path, params, priority)
+        if data is not None:
+            result = data
+            tmdb_cache_put(key, data)
+        elif stale is not None:
+            tmdb_stats["stale_hits"] += 1
+        return result
+    finally:
+        del tmdb_inflight[key]
+        if not fut.done():
+            fut.set_result(result)
+
+
+async def fetch_movies_page(page=1, genre_id=None, priority=TMDB_PRIORITY_INTERACTIVE, ttl=TMDB_CACHE_TTL):
+    """
+    Страница discover (порядок, id, постеры, жанры) — одна на все языки, тексты на TMDB_DEFAULT_LANGUAGE.
+    Перевод делается только для карточек, которые реально показываются: send_next_movie
+    и localize_movies берут его из общей карточки фильма (fetch_movie_details)
+    """
+    params = {"language": TMDB_DEFAULT_LANGUAGE, "sort_by": "popularity.desc", "page": page}
+    if genre_id:
+        params["with_genres"] = genre_id
+
+    data = await tmdb_get("/discover/movie", params, priority, ttl)
+    movies = data.get('results', []) if data else []
+
+    # Каждый показанный фильм попадает в каталог: по его genre_ids rollup_day считает лайки жанров
+    # (crawl_catalog обходит только первые страницы, а лайкать можно и с дальних)
+    new_movies = [m for m in movies if m['id'] not in catalog_ids]
+    if new_movies:
+        await save_catalog_movies(new_movies)
+        await db.commit()
+    return movies
+
+
+async def localize_movies(movies, language, priority=TMDB_PRIORITY_INTERACTIVE):
+    """
+    Копии фильмов с названием и описанием на языке language из общей карточки фильма.
+    Для языка по умолчанию карточка нужна только фильмам без описания (его подставит en-US).
+    Общую страницу в кеше не трогаем
+    """
+    todo = [m for m in movies if language != TMDB_DEFAULT_LANGUAGE or not m.get('overview')]
+    if not todo:
+        return movies
+    details = await asyncio.gather(*(fetch_movie_details(m['id'], priority, language=language) for m in todo))
+    localized = {m['id']: dict(m, title=d.get('title') or m.get('title'),
+                               overview=d.get('overview') or m.get('overview', ''))
+                 for m, d in zip(todo, details)}
+    return [localized.get(m['id'], m) for m in movies]
 
 async def filter_seen_movies(user_id, movies_list):
     """Оставляет только те фильмы, которые пользователь еще не оценивал"""
 
     # Получаем все ID фильмов, которые юзер уже свайпал
-    async with db.execute("SELECT movie_id FROM user_votes WHERE user_id = ?", (user_id,)) as c:
-        seen_ids = [str(r[0]) for r in await c.fetchall()]
+    seen_ids = await get_user_seen(user_id)
 
     # Возвращаем только те фильмы, ID которых нет в списке просмотренных
-    return [m for m in movies_list if str(m['id']) not in seen_ids]
+    return [m for m in movies_list if not is_seen(seen_ids, m['id'])]
 
 
-async def get_trailer_url(movie_id):
-    global http_client
+# Видео всех поддерживаемых языков приходят в одном ответе, поэтому ключ кеша у карточки один на все языки
+TMDB_VIDEO_LANGUAGES = ",".join(sorted({lang.split("-")[0] for lang in TMDB_LANGUAGES.values()}))
 
-    url = f"https://api.themoviedb.org/3/movie/{movie_id}/videos?api_key={TMDB_API_KEY}&language=ru-RU"
 
-    # Используем глобальный http_client, инициализированный в main()
+async def fetch_movie_details(movie_id, priority=TMDB_PRIORITY_INTERACTIVE, ttl=TMDB_CACHE_TTL,
+                              language=TMDB_DEFAULT_LANGUAGE):
+    """
+    Карточка фильма на языке language. С TMDB берется одна общая для всех языков запись
+    (en-US + переводы + видео, один запрос), а название и описание подставляются из перевода.
+    Возвращает dict (пустой при ошибке)
+    """
+    params = {"append_to_response": "videos,translations", "include_video_language": TMDB_VIDEO_LANGUAGES}
+    details = await tmdb_get(f"/movie/{movie_id}", params, priority, ttl)
+    return localize_details(details, language) if details else {}
+
+
+def localize_details(details, language):
+    """Копия карточки с текстами на языке language; чего нет в переводе — остается из en-US"""
+    lang, _, country = language.partition("-")
+    best = None
+    for tr in details.get('translations', {}).get('translations', []):
+        if tr.get('iso_639_1') == lang:
+            # Точная локаль (pt-BR) лучше просто языка (pt-PT)
+            if best is None or tr.get('iso_3166_1') == country:
+                best = tr.get('data', {})
+    localized = dict(details, language=language)
+    for field in ("title", "overview", "tagline"):
+        if best and best.get(field):
+            localized[field] = best[field]
+    return localized
+
+
+def pick_trailer(details):
+    """Лучший трейлер из details['videos']: на языке карточки, если нет — английский"""
+    videos = details.get('videos', {}).get('results', [])
+    preferred = details.get('language', TMDB_DEFAULT_LANGUAGE).split("-")[0]
+    for lang in dict.fromkeys((preferred, "en")):
+        for video in videos:
+            if video.get('iso_639_1') == lang and video['site'] == 'YouTube' and video['type'] in ['Trailer', 'Teaser']:
+                return f"https://www.youtube.com/watch?v={video['key']}"
+    return None
+
+
+# --- ЛОКАЛЬНЫЙ КАТАЛОГ ---
+
+tmdb_cache_saved_at = 0.0  # Время последнего сохранения кеша TMDB в БД
+catalog_ids = set()  # movie_id (int), которые уже есть в movie_catalog
+
+
+async def load_tmdb_cache():
+    """Поднимает сохраненные ответы TMDB в память (после рестарта кеш сразу теплый)"""
+    global tmdb_cache_saved_at
+    async with db.execute(
+            "SELECT cache_key, payload, fetched_at FROM tmdb_cache ORDER BY fetched_at DESC LIMIT ?",
+            (TMDB_CACHE_MAX,)
+    ) as c:
+        rows = await c.fetchall()
+
+    # Идем от старых к новым, чтобы свежие оказались в конце LRU
+    for key, payload, fetched_at in reversed(rows):
+        tmdb_cache[key] = (fetched_at, json.loads(payload))
+    tmdb_cache_saved_at = time.time()
+    print(f"Каталог: загружено {len(rows)} ответов TMDB")
+
+    async with db.execute("SELECT movie_id FROM movie_catalog") as c:
+        catalog_ids.update(int(r[0]) for r in await c.fetchall() if str(r[0]).isdigit())
+
+
+async def save_tmdb_cache():
+    """Сохраняет в БД ответы TMDB, полученные после прошлого сохранения"""
+    global tmdb_cache_saved_at
+    rows = [(key, json.dumps(data, ensure_ascii=False), fetched_at)
+            for key, (fetched_at, data) in tmdb_cache.items() if fetched_at > tmdb_cache_saved_at]
+    tmdb_cache_saved_at = time.time()
+    if not rows:
+        return
+
+    await db.executemany("INSERT OR REPLACE INTO tmdb_cache (cache_key, payload, fetched_at) VALUES (?, ?, ?)", rows)
+    # Старые ответы все равно перезапросим, хранить их незачем
+    await db.execute("DELETE FROM tmdb_cache WHERE fetched_at < ?", (time.time() - 7 * 86400,))
+    await db.commit()
+
+
+async def save_catalog_movies(movies):
+    """Записывает фильмы из выдачи discover в movie_catalog"""
+    now = get_now()
+    await db.executemany(
+        """INSERT INTO movie_catalog 
+               (movie_id, title, overview, poster_path, release_date, vote_average, genre_ids, updated_at)
+           VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+           ON CONFLICT(movie_id) DO UPDATE SET 
+           title = excluded.title,
+           overview = excluded.overview,
+           poster_path = excluded.poster_path,
+           release_date = excluded.release_date,
+           vote_average = excluded.vote_average,
+           genre_ids = excluded.genre_ids,
+           updated_at = excluded.updated_at""",
+        [(str(m['id']), m.get('title'), m.get('overview'), m.get('poster_path'), m.get('release_date'),
+          m.get('vote_average'), json.dumps(m.get('genre_ids', [])), now) for m in movies]
+    )
+    catalog_ids.update(m['id'] for m in movies)
+
+
+async def crawl_catalog():
+    """
+    Один проход прогрева: первые CATALOG_PAGES страниц каждого жанра (и «Любые»)
+    плюс карточки с трейлерами всех найденных фильмов. Не тратит больше CATALOG_REQUEST_BUDGET запросов.
+    Запросы идут с фоновым приоритетом, поэтому пользователей не тормозят.
+    """
+    budget = CATALOG_REQUEST_BUDGET
+    movie_ids = []
+    for gid in [None] + list(GENRES.keys()):
+        for page in range(1, CATALOG_PAGES + 1):
+            if budget <= 0:
+                break
+            budget -= 1
+            # ttl=0 — всегда берем свежую выдачу, а не то, что уже лежит в кеше
+            movies = await fetch_movies_page(page, gid, TMDB_PRIORITY_PREFETCH, ttl=0)
+            if not movies:
+                break
+            await save_catalog_movies(movies)
+            movie_ids.extend(str(m['id']) for m in movies)
+    await db.commit()
+
+    # Карточки и трейлеры (одинаковые фильмы из разных жанров качаем один раз)
+    movie_ids = list(dict.fromkeys(movie_ids))[:max(budget, 0)]
+    for i in range(0, len(movie_ids), 20):
+        chunk = movie_ids[i:i + 20]
+        details = await asyncio.gather(*(fetch_movie_details(m_id, TMDB_PRIORITY_PREFETCH, ttl=0) for m_id in chunk))
+        await db.executemany(
+            "UPDATE movie_catalog SET trailer_url = ? WHERE movie_id = ?",
+            [(pick_trailer(d), m_id) for m_id, d in zip(chunk, details) if d]
+        )
+    await db.commit()
+
+    await save_tmdb_cache()
+    print(f"Каталог прогрет: {len(movie_ids)} фильмов")
+
+
+async def catalog_crawler():
+    """Прогрев каталога при старте и затем по расписанию"""
+    while True:
+        try:
+            await crawl_catalog()
+        except Exception as e:
+            print(f"Ошибка прогрева каталога: {e}")
+            await log_error(f"catalog_crawler: {e}")
+        await asyncio.sleep(CATALOG_REFRESH_HOURS * 3600)
+
+
+# --- АРХИВ ГОЛОСОВ ---
+# Лайки остаются в user_votes (на них живут список лайков, топ и выгрузка), а старые дизлайки
+# переносятся в файлы archive/votes_YYYY_MM.db. Для подбора фильмов они уже не нужны: все id
+# остаются в user_seen, а их число — в user_vote_archive. Работает в отдельном потоке со своим
+# соединением и короткими транзакциями, чтобы не держать event loop и блокировку записи.
+
+def archive_votes_batch(cutoff):
+    """Переносит до VOTE_ARCHIVE_BATCH дизлайков старше cutoff. Возвращает число перенесенных строк"""
+    conn = sqlite3.connect(DB_PATH, timeout=DB_BUSY_TIMEOUT)
     try:
-        async with http_client.get(url, timeout=5) as response:
-            if response.status == 200:
-                data = await response.json()
-                for video in data.get('results', []):
-                    if video['site'] == 'YouTube' and video['type'] in ['Trailer', 'Teaser']:
-                        return f"https://www.youtube.com/watch?v={video['key']}"
-
-            # Если на русском нет, пробуем на английском
-            url_en = f"https://api.themoviedb.org/3/movie/{movie_id}/videos?api_key={TMDB_API_KEY}&language=en-US"
-            async with http_client.get(url_en, timeout=5) as response_en:
-                if response_en.status == 200:
-                    data_en = await response_en.json()
-                    for video in data_en.get('results', []):
-                        if video['site'] == 'YouTube' and video['type'] in ['Trailer', 'Teaser']:
-                            return f"https://www.youtube.com/watch?v={video['key']}"
-            return None
+        rows = conn.execute(
+            """SELECT rowid, user_id, movie_id, movie_title, is_like, added_at FROM user_votes
+               WHERE added_at < ? AND is_like = 0 LIMIT ?""",
+            (cutoff, VOTE_ARCHIVE_BATCH)
+        ).fetchall()
+        if not rows:
+            return 0
+
+        # Сначала пишем архив: строки с тем же rowid игнорируются, поэтому повтор после сбоя безопасен
+        by_month = defaultdict(list)
+        for row in rows:
+            by_month[row[5][:7].replace("-", "_")].append(row)
+        os.makedirs(VOTE_ARCHIVE_DIR, exist_ok=True)
+        for month, month_rows in by_month.items():
+            archive = sqlite3.connect(os.path.join(VOTE_ARCHIVE_DIR, f"votes_{month}.db"))
+            try:
+                archive.execute('''CREATE TABLE IF NOT EXISTS user_votes 
+                                   (id INTEGER PRIMARY KEY, user_id INTEGER, movie_id TEXT, movie_title TEXT,
+                                    is_like INTEGER, added_at TIMESTAMP)''')
+                archive.execute("CREATE INDEX IF NOT EXISTS idx_user_votes_user ON user_votes(user_id)")
+                archive.executemany("INSERT OR IGNORE INTO user_votes VALUES (?, ?, ?, ?, ?, ?)", month_rows)
+                archive.commit()
+            finally:
+                archive.close()
+
+        conn.execute("BEGIN IMMEDIATE")
+        # У кого еще нет user_seen — строим его до удаления, пока вся история на месте
+        per_user = defaultdict(int)
+        user_months = defaultdict(set)
+        for row in rows:
+            per_user[row[1]] += 1
+            user_months[row[1]].add(row[5][:7].replace("-", "_"))
+        for user_id in per_user:
+            if conn.execute("SELECT 1 FROM user_seen WHERE user_id = ?", (user_id,)).fetchone():
+                continue
+            ids = array('I', sorted({int(r[0]) for r in conn.execute(
+                "SELECT movie_id FROM user_votes WHERE user_id = ?", (user_id,)) if str(r[0]).isdigit()}))
+            conn.execute("INSERT INTO user_seen (user_id, ids) VALUES (?, ?)", (user_id, ids.tobytes()))
+
+        conn.executemany("DELETE FROM user_votes WHERE rowid = ?", [(row[0],) for row in rows])
+        archive_rows = []
+        for user_id, count in per_user.items():
+            old = conn.execute("SELECT dislikes, months FROM user_vote_archive WHERE user_id = ?", (user_id,)).fetchone()
+            if old and old[0] and old[1] is None:
+                months = None  # Старые файлы пользователя неизвестны — оставляем «смотреть все»
+            else:
+                months = ",".join(sorted(user_months[user_id] | set(old[1].split(",") if old and old[1] else [])))
+            archive_rows.append((user_id, count, get_now(), months))
+        conn.executemany(
+            """INSERT INTO user_vote_archive (user_id, dislikes, archived_at, months) VALUES (?, ?, ?, ?)
+               ON CONFLICT(user_id) DO UPDATE SET dislikes = dislikes + excluded.dislikes,
+               archived_at = excluded.archived_at, months = excluded.months""",
+            archive_rows
+        )
+        conn.commit()
+        return len(rows)
+    finally:
+        conn.close()
+
+
+def enable_incremental_vacuum():
+    """
+    Разово переводит базу в auto_vacuum=INCREMENTAL. Нужен полный VACUUM, который держит блокировку
+    записи все время перестройки, поэтому вызывается только до старта polling
+    """
+    conn = sqlite3.connect(DB_PATH, timeout=DB_BUSY_TIMEOUT)
+    try:
+        if conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+            return
+        print("Перевожу базу в auto_vacuum=INCREMENTAL (разовый VACUUM, бот стартует после него)...")
+        start = time.perf_counter()
+        conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        conn.execute("VACUUM")
+        print(f"VACUUM завершен за {time.perf_counter() - start:.1f} сек")
+    finally:
+        conn.close()
+
+
+def vacuum_step():
+    """Один короткий шаг incremental_vacuum. Возвращает, сколько свободных страниц осталось"""
+    conn = sqlite3.connect(DB_PATH, timeout=DB_BUSY_TIMEOUT)
+    try:
+        if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            return 0  # База еще не переведена (см. enable_incremental_vacuum)
+        # executescript шагает оператор до конца; через execute освобождается только одна страница
+        conn.executescript(f"PRAGMA incremental_vacuum({VACUUM_PAGES});")
+        return conn.execute("PRAGMA freelist_count").fetchone()[0]
+    finally:
+        conn.close()
+
+
+async def vacuum_free_pages():
+    """Возвращает ОС освободившееся место маленькими шагами, пропуская между ними запись бота"""
+    while await asyncio.to_thread(vacuum_step):
+        await asyncio.sleep(0.1)
+
+
+async def archive_old_votes():
+    cutoff = (datetime.datetime.now() - datetime.timedelta(days=VOTE_ARCHIVE_DAYS)).strftime("%Y-%m-%d %H:%M:%S")
+    total = 0
+    while True:
+        moved = await asyncio.to_thread(archive_votes_batch, cutoff)
+        total += moved
+        if moved < VOTE_ARCHIVE_BATCH:
+            break
+        await asyncio.sleep(0.1)  # Даем боту записать свои голоса между пачками
+    await vacuum_free_pages()
+    if total:
+        print(f"В архив перенесено голосов: {total}")
+    return total
+
+
+async def vote_archiver():
+    """Архивация и incremental_vacuum раз в VOTE_ARCHIVE_HOURS"""
+    while True:
+        await asyncio.sleep(600)  # Не мешаем старту бота
+        try:
+            await archive_old_votes()
+        except Exception as e:
+            print(f"Ошибка архивации голосов: {e}")
+            await log_error(f"vote_archiver: {e}")
+        await asyncio.sleep(VOTE_ARCHIVE_HOURS * 3600 - 600)
+
+
+# --- БЭКАПЫ ---
+
+backup_state = {"running": False, "progress": 0.0, "last_file": None, "last_at": None, "last_error": None}
+
+
+def run_backup():
+    """
+    Снимок базы через backup API небольшими шагами, затем gzip и ротация. Выполняется в отдельном потоке.
+    Исходное соединение держит читающую транзакцию: в WAL она не мешает писателям, а бэкап копирует
+    один согласованный снимок и не перезапускается с начала от каждого нового голоса.
+    """
+    os.makedirs(BACKUP_DIR, exist_ok=True)
+    name = f"{Path(DB_PATH).stem}_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}"
+    raw_path = os.path.join(BACKUP_DIR, f"{name}.db.tmp")
+    gz_path = os.path.join(BACKUP_DIR, f"{name}.db.gz")
+
+    def on_progress(status, remaining, total):
+        # Копирование страниц — первые 80% прогресса, сжатие — остальные 20%
+        backup_state["progress"] = 0.8 * (total - remaining) / total if total else 0.8
+
+    src = sqlite3.connect(DB_PATH, timeout=DB_BUSY_TIMEOUT)
+    dst = sqlite3.connect(raw_path)
+    try:
+        src.execute("BEGIN")
+        src.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()
+        src.backup(dst, pages=BACKUP_STEP_PAGES, progress=on_progress, sleep=BACKUP_STEP_SLEEP)
+        src.rollback()
+    finally:
+        src.close()
+        dst.close()
+
+    try:
+        raw_size = os.path.getsize(raw_path)
+        done = 0
+        with open(raw_path, "rb") as f_in, gzip.open(gz_path + ".tmp", "wb", compresslevel=6) as f_out:
+            while chunk := f_in.read(1024 * 1024):
+                f_out.write(chunk)
+                done += len(chunk)
+                backup_state["progress"] = 0.8 + 0.2 * done / max(raw_size, 1)
+        os.replace(gz_path + ".tmp", gz_path)
+    finally:
+        os.remove(raw_path)
+
+    # Ротация: оставляем BACKUP_KEEP самых свежих (имена сортируются по времени)
+    snapshots = sorted(f for f in os.listdir(BACKUP_DIR) if f.startswith(f"{Path(DB_PATH).stem}_") and f.endswith(".db.gz"))
+    for old in snapshots[:-BACKUP_KEEP]:
+        os.remove(os.path.join(BACKUP_DIR, old))
+    return gz_path
+
+
+async def backup_database():
+    """Делает бэкап, если он еще не идет. Возвращает путь к снимку"""
+    if backup_state["running"]:
+        raise RuntimeError("бэкап уже выполняется")
+    backup_state.update(running=True, progress=0.0)
+    try:
+        path = await asyncio.to_thread(run_backup)
+        backup_state.update(last_file=path, last_at=get_now(), last_error=None)
+        print(f"Бэкап готов: {path}")
+        return path
     except Exception as e:
-        print(f"Ошибка get_trailer_url: {e}")
+        backup_state["last_error"] = str(e)
+        await log_error(f"backup: {e}")
+        raise
+    finally:
+        backup_state["running"] = False
+
+
+async def backup_scheduler():
+    """Бэкап по расписанию раз в BACKUP_HOURS"""
+    while True:
+        await asyncio.sleep(BACKUP_HOURS * 3600)
+        try:
+            await backup_database()
+        except Exception as e:
+            print(f"Ошибка бэкапа: {e}")
+
+
+# --- ДНЕВНЫЕ СВОДКИ ---
+
+pending_matches = defaultdict(int)  # {день: мэтчей} — мэтчи нигде не хранятся, копим до следующего пересчета
+
+
+async def rollup_day(day):
+    """Пересчитывает сводку за день по диапазонам added_at/joined_date (индексы, только строки этого дня)"""
+    start = f"{day} 00:00:00"
+    end = (datetime.date.fromisoformat(day) + datetime.timedelta(days=1)).isoformat() + " 00:00:00"
+
+    async with db.execute("SELECT COUNT(*) FROM users WHERE joined_date >= ? AND joined_date < ?", (start, end)) as c:
+        new_users = (await c.fetchone())[0]
+    async with db.execute(
+        "SELECT COUNT(*), COALESCE(SUM(is_like), 0), COUNT(DISTINCT user_id) FROM user_votes "
+        "INDEXED BY idx_user_votes_added_at WHERE added_at >= ? AND added_at < ?",
+        (start, end)
+    ) as c:
+        votes, likes, active_users = await c.fetchone()
+    # Жанры берем из локального каталога; фильмы, которых в нем нет, в разбивку не попадают
+    async with db.execute(
+        """SELECT g.value, COUNT(*) FROM user_votes v INDEXED BY idx_user_votes_added_at
+           JOIN movie_catalog c ON c.movie_id = v.movie_id, json_each(c.genre_ids) g
+           WHERE v.added_at >= ? AND v.added_at < ? AND v.is_like = 1
+           GROUP BY g.value""",
+        (start, end)
+    ) as c:
+        genre_rows = await c.fetchall()
+
+    await db.execute(
+        """INSERT INTO daily_stats (day, new_users, active_users, votes, likes) VALUES (?, ?, ?, ?, ?)
+           ON CONFLICT(day) DO UPDATE SET new_users = excluded.new_users, active_users = excluded.active_users,
+           votes = excluded.votes, likes = excluded.likes""",
+        (day, new_users, active_users, votes, likes)
+    )
+    await db.execute("DELETE FROM daily_genre_likes WHERE day = ?", (day,))
+    await db.executemany("INSERT INTO daily_genre_likes (day, genre_id, likes) VALUES (?, ?, ?)",
+                         [(day, str(g), n) for g, n in genre_rows])
+
+
+async def update_rollups():
+    """Пересчитывает незакрытые дни (вчера и сегодня) и дописывает накопленные мэтчи"""
+    today = datetime.date.today()
+    async with db.execute("SELECT MAX(day) FROM daily_stats") as c:
+        last = (await c.fetchone())[0]
+    # Вчерашний день пересчитываем еще раз: между прошлым проходом и полуночью могли прийти голоса
+    first = (datetime.date.fromisoformat(last) - datetime.timedelta(days=1)) if last \
+        else today - datetime.timedelta(days=ROLLUP_BACKFILL_DAYS - 1)
+
+    day = first
+    while day <= today:
+        await rollup_day(day.isoformat())
+        day += datetime.timedelta(days=1)
+
+    matches = list(pending_matches.items())
+    await db.executemany(
+        """INSERT INTO daily_stats (day, matches) VALUES (?, ?)
+           ON CONFLICT(day) DO UPDATE SET matches = matches + excluded.matches""",
+        matches
+    )
+    await db.commit()
+    # Мэтчи, случившиеся во время записи, остаются до следующего прохода
+    for day, n in matches:
+        pending_matches[day] -= n
+        if pending_matches[day] <= 0:
+            del pending_matches[day]
+
+
+async def rollup_worker():
+    """Фоновое обновление дневных сводок раз в ROLLUP_INTERVAL_MIN"""
+    while True:
+        try:
+            await update_rollups()
+        except Exception as e:
+            print(f"Ошибка пересчета сводок: {e}")
+        await asyncio.sleep(ROLLUP_INTERVAL_MIN * 60)
+
+
+async def get_daily_trend(days):
+    """Сводки за последние days дней (старые первыми) и лайки по жанрам за период"""
+    since = (datetime.date.today() - datetime.timedelta(days=days - 1)).isoformat()
+    async with db.execute(
+        "SELECT day, new_users, active_users, votes, likes, matches FROM daily_stats WHERE day >= ? ORDER BY day",
+        (since,)
+    ) as c:
+        rows = await c.fetchall()
+    async with db.execute(
+        "SELECT genre_id, SUM(likes) AS n FROM daily_genre_likes WHERE day >= ? GROUP BY genre_id ORDER BY n DESC LIMIT 5",
+        (since,)
+    ) as c:
+        genres = await c.fetchall()
+    return rows, genres
+
+
+# --- РЕКОМЕНДАЦИИ ---
+# Матрица пользователь × фильм из лайков (scipy.sparse), косинусная близость фильмов по общим лайкам,
+# RECS_TOP_K лучших соседей каждого фильма — в movie_similar. Колода сессии сортируется по сумме
+# близостей кандидатов к последним лайкам пользователя: то, что он скорее лайкнет, идет первым.
+
+def similarity_rows(X, movies, targets):
+    """Строки индекса [(movie_id, similar_id, score)] для фильмов с индексами столбцов targets"""
+    norms = np.sqrt(np.asarray(X.sum(axis=0)).ravel())
+    Xc = X.tocsc()
+    out = []
+    for start in range(0, len(targets), RECS_BLOCK):
+        cols = targets[start:start + RECS_BLOCK]
+        # Число общих лайков каждого фильма блока со всеми фильмами — одно разреженное умножение
+        co = (Xc[:, cols].T @ X).tocsr()
+        for r, i in enumerate(cols):
+            js = co.indices[co.indptr[r]:co.indptr[r + 1]]
+            counts = co.data[co.indptr[r]:co.indptr[r + 1]]
+            mask = (js != i) & (counts >= RECS_MIN_COLIKES)
+            js, counts = js[mask], counts[mask]
+            if not len(js):
+                continue
+            scores = counts / (norms[i] * norms[js])
+            top = np.argsort(-scores)[:RECS_TOP_K]
+            out.extend((str(movies[i]), str(movies[js[t]]), float(scores[t])) for t in top)
+    return out
+
+
+def update_similarity_index():
+    """
+    Досчитывает movie_similar в отдельном потоке. Полный пересчет — раз в RECS_FULL_REBUILD_HOURS,
+    между ними пересчитываются только фильмы, лайкнутые пользователями с новыми лайками
+    (у остальных фильмов соседи почти не меняются; неточность исправит ближайший полный пересчет).
+    Возвращает число пересчитанных фильмов
+    """
+    conn = sqlite3.connect(DB_PATH, timeout=DB_BUSY_TIMEOUT)
+    try:
+        state = conn.execute("SELECT last_rowid, full_built_at FROM recommender_state WHERE id = 1").fetchone()
+        full = state is None or time.time() - state[1] >= RECS_FULL_REBUILD_HOURS * 3600
+
+        # Чтение — одним снимком (в WAL не мешает записи голосов)
+        conn.execute("BEGIN")
+        last_rowid = conn.execute("SELECT COALESCE(MAX(rowid), 0) FROM user_votes").fetchone()[0]
+        if not full and last_rowid == state[0]:
+            conn.rollback()
+            return 0
+        likes = [(u, int(m)) for u, m in conn.execute(
+            "SELECT user_id, movie_id FROM user_votes WHERE is_like = 1 AND rowid <= ?", (last_rowid,)
+        ) if str(m).isdigit()]
+        fresh_users = set() if full else {r[0] for r in conn.execute(
+            "SELECT DISTINCT user_id FROM user_votes WHERE rowid > ? AND rowid <= ? AND is_like = 1",
+            (state[0], last_rowid)
+        )}
+        conn.rollback()
+
+        if likes:
+            users, u_idx = np.unique(np.array([u for u, _ in likes]), return_inverse=True)
+            movies, m_idx = np.unique(np.array([m for _, m in likes]), return_inverse=True)
+            X = sparse.csr_matrix((np.ones(len(likes), dtype=np.float32), (u_idx, m_idx)),
+                                  shape=(len(users), len(movies)))
+            X.sum_duplicates()
+            X.data[:] = 1  # Повторный лайк того же фильма не усиливает связь
+            if full:
+                targets = np.arange(len(movies))
+            else:
+                # Фильмы, которые лайкали авторы новых лайков: их соседи могли измениться
+                rows = [r for r, u in enumerate(users.tolist()) if u in fresh_users]
+                targets = np.unique(X[rows].indices) if rows else np.array([], dtype=np.int64)
+            index_rows = similarity_rows(X, movies, targets)
+            target_ids = [(str(movies[i]),) for i in targets]
+        else:
+            index_rows, target_ids = [], []
+
+        conn.execute("BEGIN IMMEDIATE")
+        if full:
+            conn.execute("DELETE FROM movie_similar")
+        else:
+            conn.executemany("DELETE FROM movie_similar WHERE movie_id = ?", target_ids)
+        conn.executemany("INSERT INTO movie_similar (movie_id, similar_id, score) VALUES (?, ?, ?)", index_rows)
+        conn.execute(
+            """INSERT INTO recommender_state (id, last_rowid, full_built_at) VALUES (1, ?, ?)
+               ON CONFLICT(id) DO UPDATE SET last_rowid = excluded.last_rowid,
+               full_built_at = COALESCE(?, full_built_at)""",
+            (last_rowid, time.time(), time.time() if full else None)
+        )
+        conn.commit()
+        return len(target_ids)
+    finally:
+        conn.close()
+
+
+async def recommender_worker():
+    """Фоновое обновление индекса рекомендаций раз в RECS_UPDATE_MIN"""
+    if np is None:
+        print("numpy/scipy не установлены — рекомендации выключены, колода идет по популярности")
+        return
+    while True:
+        try:
+            start = time.perf_counter()
+            updated = await asyncio.to_thread(update_similarity_index)
+            if updated:
+                print(f"Индекс рекомендаций: пересчитано фильмов {updated} за {time.perf_counter() - start:.1f} сек")
+        except Exception as e:
+            print(f"Ошибка индекса рекомендаций: {e}")
+        await asyncio.sleep(RECS_UPDATE_MIN * 60)
+
+
+async def rank_deck(user_id, movies):
+    """Сортирует кандидатов по близости к последним лайкам пользователя (idx PK movie_similar).
+    Фильмы без оценки остаются в исходном порядке популярности после оцененных"""
+    if len(movies) < 2:
+        return movies
+    async with db.execute(
+        "SELECT movie_id FROM user_votes WHERE user_id = ? AND is_like = 1 ORDER BY rowid DESC LIMIT ?",
+        (user_id, RECS_PROFILE_LIKES)
+    ) as c:
+        liked = [r[0] for r in await c.fetchall()]
+    if not liked:
+        return movies
+
+    candidates = list(dict.fromkeys(str(m['id']) for m in movies))
+    async with db.execute(
+        f"""SELECT similar_id, SUM(score) FROM movie_similar
+            WHERE movie_id IN ({",".join("?" * len(liked))}) AND similar_id IN ({",".join("?" * len(candidates))})
+            GROUP BY similar_id""",
+        liked + candidates
+    ) as c:
+        scores = dict(await c.fetchall())
+    if not scores:
+        return movies
+    inc_counter("moviematch_decks_ranked_total")
+    # sorted устойчив: среди равных сохраняется порядок популярности TMDB
+    return sorted(movies, key=lambda m: -scores.get(str(m['id']), 0.0))
+
+
+# --- API ДЛЯ MINI APP ---
+# Mini App берет колоду на несколько десятков карточек одним запросом, листает ее локально
+# и отправляет накопленные голоса одним POST. Пользователь определяется по initData из Telegram.
+
+def check_webapp_init_data(init_data):
+    """Проверяет подпись initData (HMAC по токену бота). Возвращает user_id или None"""
+    params = dict(parse_qsl(init_data or "", keep_blank_values=True))
+    received_hash = params.pop("hash", "")
+    if not received_hash or "user" not in params:
+        return None
+    check_string = "\n".join(f"{k}={v}" for k, v in sorted(params.items()))
+    secret = hmac.new(b"WebAppData", TELEGRAM_TOKEN.encode(), hashlib.sha256).digest()
+    expected = hmac.new(secret, check_string.encode(), hashlib.sha256).hexdigest()
+    if not hmac.compare_digest(expected, received_hash):
+        return None
+    if not params.get("auth_date", "").isdigit() or time.time() - int(params["auth_date"]) > WEBAPP_AUTH_TTL:
         return None
+    try:
+        return int(json.loads(params["user"])["id"])
+    except (ValueError, KeyError, TypeError):
+        return None
+
+
+WEBAPP_PUBLIC_PATHS = {"/api/poster"}  # без initData
+
+
+@web.middleware
+async def webapp_middleware(request, handler):
+    """CORS для страницы Mini App и проверка initData (заголовок Authorization: tma <initData>)"""
+    cors = {
+        "Access-Control-Allow-Origin": "*",
+        "Access-Control-Allow-Headers": "Authorization, Content-Type, Bypass-Tunnel-Reminder",
+        "Access-Control-Allow-Methods": "GET, POST, OPTIONS",
+    }
+    if request.method == "OPTIONS":
+        return web.Response(headers=cors)
+    if request.path in WEBAPP_PUBLIC_PATHS:
+        # <img> не умеет слать заголовки, а постеры и так публичные
+        response = await handler(request)
+        if not response.prepared:
+            response.headers.update(cors)
+        return response
+
+    auth = request.headers.get("Authorization", "")
+    uid = check_webapp_init_data(auth[4:] if auth.startswith("tma ") else "")
+    if uid is None:
+        response = web.json_response({"error": "unauthorized"}, status=401)
+    elif await is_user_blocked(uid):
+        response = web.json_response({"error": "blocked"}, status=403)
+    else:
+        request["user_id"] = uid
+        start = time.perf_counter()
+        try:
+            response = await handler(request)
+        finally:
+            observe("moviematch_webapp_seconds", request.path, time.perf_counter() - start)
+    response.headers.update(cors)
+    return response
+
+
+webapp_served = OrderedDict()  # {user_id: OrderedDict {movie_id: title}} — карточки, выданные в /api/deck (LRU)
+
+
+def remember_served(user_id, cards):
+    """Голоса принимаются только за выданные карточки: и id, и название берем с сервера, а не от клиента"""
+    served = webapp_served.pop(user_id, None) or OrderedDict()
+    for card in cards:
+        served[str(card["id"])] = card["title"]
+        served.move_to_end(str(card["id"]))
+    while len(served) > WEBAPP_SERVED_MAX:
+        served.popitem(last=False)
+    webapp_served[user_id] = served
+    while len(webapp_served) > WEBAPP_SERVED_USERS_MAX:
+        webapp_served.popitem(last=False)
+
+
+def webapp_card(movie):
+    return {
+        "id": movie['id'],
+        "title": movie.get('title', ''),
+        "overview": (movie.get('overview') or '')[:350],
+        "poster": movie.get('poster_path'),
+        "rating": movie.get('vote_average'),
+        "release_date": movie.get('release_date'),
+    }
+
+
+async def webapp_deck(request):
+    """GET /api/deck?count=N&page=P&genre=G — до N карточек, которые пользователь еще не видел.
+    next_page — курсор для следующего запроса"""
+    uid = request["user_id"]
+    q = request.query
+    count = min(int(q["count"]), WEBAPP_DECK_MAX) if q.get("count", "").isdigit() else WEBAPP_DECK_MAX
+    page = max(int(q["page"]), 1) if q.get("page", "").isdigit() else 1
+    genre_id = q.get("genre") if q.get("genre") in GENRES else None
+
+    language = await get_user_language(uid)
+
+    picked, ids = [], set()
+    last_page = page + WEBAPP_DECK_PAGES
+    while len(picked) < count and page < last_page:
+        movies = await fetch_movies_page(page, genre_id)
+        if not movies:
+            break
+        for m in await filter_seen_movies(uid, movies):
+            if m['id'] not in ids and len(picked) < count:
+                ids.add(m['id'])
+                picked.append(m)
+        page += 1
+    picked = await rank_deck(uid, picked)
+    # В голоса (и Топ-10) идет общее название со страницы, а переводим только выданные карточки
+    remember_served(uid, picked)
+    cards = [webapp_card(m) for m in await localize_movies(picked, language)]
+
+    # Карточки колоды открываются почти сразу: прогреваем кеш деталей (трейлеры) в фоне
+    for card in cards[:5]:
+        asyncio.create_task(fetch_movie_details(card["id"], TMDB_PRIORITY_PREFETCH))
+    await update_user_activity(uid)
+    return web.json_response({"cards": cards, "next_page": page})
+
+
+async def webapp_votes(request):
+    """POST /api/votes {"votes": [{"movie_id": 1, "like": true}, ...]} — одна транзакция.
+    Голоса за фильмы, которых не было в выданной пользователю колоде, отбрасываются"""
+    uid = request["user_id"]
+    try:
+        payload = await request.json()
+        raw = [(str(int(v["movie_id"])), 1 if v.get("like") else 0) for v in payload["votes"][:WEBAPP_VOTES_MAX]]
+    except (ValueError, KeyError, TypeError):
+        return web.json_response({"error": "bad request"}, status=400)
+
+    served = webapp_served.get(uid, {})
+    votes = [(movie_id, served[movie_id], is_like) for movie_id, is_like in raw if movie_id in served]
+    if len(votes) < len(raw):
+        inc_counter("moviematch_webapp_votes_rejected_total", value=len(raw) - len(votes))
+    added = await add_votes(uid, votes) if votes else 0
+    # Карточки забываем только после записи: если БД упала, повтор клиента пройдет
+    for movie_id, _, _ in votes:
+        served.pop(movie_id, None)
+    inc_counter("moviematch_webapp_votes_total", value=added)
+    return web.json_response({"accepted": added})
+
+
+# --- КЕШ ПОСТЕРОВ ---
+
+poster_index = None  # OrderedDict {имя файла: {"bytes": int, "etag": str | None}} — LRU, строится при первом запросе
+poster_inflight = {}  # {имя файла: Task} — один скачиваемый постер на всех, кто его ждет
+POSTER_PATH_RE = re.compile(r"^/[A-Za-z0-9_-]+\.(?:jpg|jpeg|png|webp)$")
+
+
+def load_poster_index():
+    """Собирает индекс кеша с диска: давно не открытые файлы — первыми на вытеснение"""
+    os.makedirs(POSTER_CACHE_DIR, exist_ok=True)
+    files = []
+    for entry in os.scandir(POSTER_CACHE_DIR):
+        if entry.is_file() and not entry.name.endswith(".tmp"):
+            st = entry.stat()
+            files.append((st.st_atime, entry.name, st.st_size))
+    return OrderedDict((name, {"bytes": size, "etag": None}) for _, name, size in sorted(files))
+
+
+def evict_posters(keep):
+    """Вытесняет из индекса самые старые постеры сверх POSTER_CACHE_MB, кроме keep (его только что скачали
+    для ждущих запросов — даже если он один больше лимита). Возвращает имена файлов на удаление"""
+    total = sum(e["bytes"] for e in poster_index.values())
+    evicted = []
+    for name in list(poster_index):
+        if total <= POSTER_CACHE_MB * 1024 * 1024:
+            break
+        if name != keep:
+            total -= poster_index.pop(name)["bytes"]
+            evicted.append(name)
+    return evicted
+
+
+def remove_posters(names):
+    for name in names:
+        try:
+            os.remove(os.path.join(POSTER_CACHE_DIR, name))
+        except FileNotFoundError:
+            pass
+
+
+def file_etag(fileno):
+    """Сильный ETag — хеш содержимого открытого файла"""
+    with mmap.mmap(fileno, 0, access=mmap.ACCESS_READ) as mm:
+        return f'"{hashlib.sha256(mm).hexdigest()[:32]}"'
+
+
+def write_poster(name, content):
+    """Атомарно кладет постер в кеш. Возвращает его ETag"""
+    tmp_path = os.path.join(POSTER_CACHE_DIR, name + ".tmp")
+    with open(tmp_path, "wb") as f:
+        f.write(content)
+    os.replace(tmp_path, os.path.join(POSTER_CACHE_DIR, name))
+    return f'"{hashlib.sha256(content).hexdigest()[:32]}"'
+
+
+async def download_poster(size, path, name):
+    async with http_client.get(f"{TMDB_IMAGE_URL}/{size}{path}",
+                               timeout=aiohttp.ClientTimeout(total=POSTER_TIMEOUT)) as response:
+        if response.status != 200:
+            return False
+        content = await response.read()
+    if not content:
+        return False
+    etag = await asyncio.to_thread(write_poster, name, content)
+    poster_index[name] = {"bytes": len(content), "etag": etag}
+    evicted = evict_posters(keep=name)
+    if evicted:
+        await asyncio.to_thread(remove_posters, evicted)
+    return content, etag
+
+
+def open_cached_poster(name):
+    """Открытый файл постера из кеша или None. Открытый файл дочитается, даже если его вытеснят во время отдачи"""
+    if name not in poster_index:
+        return None
+    try:
+        f = open(os.path.join(POSTER_CACHE_DIR, name), "rb")
+    except FileNotFoundError:
+        poster_index.pop(name, None)
+        return None
+    poster_index.move_to_end(name)
+    return f
+
+
+async def webapp_poster(request):
+    """GET /api/poster?size=w342&path=/abc.jpg — постер из локального кеша (при промахе качается с TMDB)"""
+    global poster_index
+    size, path = request.query.get("size", "w500"), request.query.get("path", "")
+    if size not in POSTER_SIZES or not POSTER_PATH_RE.match(path):
+        return web.json_response({"error": "bad request"}, status=400)
+    if poster_index is None:
+        poster_index = await asyncio.to_thread(load_poster_index)
+
+    name = f"{size}_{path[1:]}"
+    f = open_cached_poster(name)
+    inc_counter("moviematch_poster_requests_total", "hit" if f else "miss")
+    if f is None:
+        task = poster_inflight.get(name)
+        if task is None:
+            task = poster_inflight[name] = asyncio.create_task(download_poster(size, path, name))
+            task.add_done_callback(lambda _: poster_inflight.pop(name, None))
+        try:
+            downloaded = await asyncio.shield(task)
+        except Exception as e:
+            print(f"Ошибка загрузки постера {path}: {e}")
+            downloaded = False
+        if not downloaded:
+            return web.json_response({"error": "not found"}, status=502)
+        f = open_cached_poster(name)
+        if f is None:
+            # Пока ждали, постер уже вытеснили другие загрузки — отдаем скачанные байты
+            content, etag = downloaded
+            headers = {"ETag": etag, "Cache-Control": "public, max-age=31536000, immutable"}
+            return web.Response(body=content, headers=headers, content_type=poster_content_type(path))
+
+    with f:
+        entry = poster_index.get(name)
+        etag = entry["etag"] if entry else None
+        if etag is None:
+            # Хеш файлов, найденных на диске при старте, считаем один раз и в потоке
+            etag = await asyncio.to_thread(file_etag, f.fileno())
+            if entry:
+                entry["etag"] = etag
+        headers = {
+            "ETag": etag,
+            # Имя файла TMDB меняется вместе с картинкой, поэтому ответ можно кешировать навсегда
+            "Cache-Control": "public, max-age=31536000, immutable",
+        }
+        if request.headers.get("If-None-Match") == etag:
+            return web.Response(status=304, headers=headers)
+        return await send_poster(request, f, headers, path)
+
+
+def poster_content_type(path):
+    return "image/png" if path.endswith(".png") else "image/webp" if path.endswith(".webp") else "image/jpeg"
+
+
+async def send_poster(request, f, headers, path):
+    # Отдаем через mmap: страницы файла берутся из page cache ОС без чтения в буфер Python
+    response = web.StreamResponse(headers=headers)
+    response.content_type = poster_content_type(path)
+    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        response.content_length = len(mm)
+        await response.prepare(request)
+        # Срезы mmap — копии по 64 КБ: транспорт может держать буфер дольше, чем открыт файл
+        for offset in range(0, len(mm), 64 * 1024):
+            await response.write(mm[offset:offset + 64 * 1024])
+    await response.write_eof()
+    return response
+
+
+async def start_webapp_server():
+    """Поднимает API Mini App на WEBAPP_HOST:WEBAPP_PORT. Возвращает runner (или None, если выключено)"""
+    if not WEBAPP_PORT:
+        return None
+    app = web.Application(middlewares=[webapp_middleware], client_max_size=256 * 1024)
+    app.router.add_get("/api/deck", webapp_deck)
+    app.router.add_post("/api/votes", webapp_votes)
+    app.router.add_get("/api/poster", webapp_poster)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, WEBAPP_HOST, WEBAPP_PORT).start()
+    except OSError as e:
+        # Порт занят — бот в Telegram работает и без Mini App
+        print(f"API Mini App не запущен ({WEBAPP_HOST}:{WEBAPP_PORT}): {e}")
+        await runner.cleanup()
+        return None
+    print(f"API Mini App: http://{WEBAPP_HOST}:{WEBAPP_PORT}/api")
+    return runner
 
 
 # --- КЛАВИАТУРЫ ---
@@ -436,13 +2457,111 @@ def get_admin_kb(is_super):
     builder.button(text="📜 Логи действий", callback_data="admin_logs_actions")
     builder.button(text="⚠️ Логи ошибок", callback_data="admin_logs_errors")
     builder.button(text="🗑 Очистка мусора", callback_data="admin_cleanup_menu")
+    builder.button(text="🩺 Здоровье системы", callback_data="admin_health")
+    builder.button(text="💾 Бэкап сейчас", callback_data="admin_backup")
     if is_super:
         builder.button(text="👑 Управление составом", callback_data="super_admin_menu")
     builder.adjust(2)
     return builder.as_markup()
 
 
-# --- МИДДЛВАРЬ ---
+# --- МИДДЛВАРЬ ---
+@dp.update.outer_middleware()
+async def metrics_middleware(handler, event, data):
+    """Замеряет полное время обработки апдейта и раскладывает его по имени хендлера"""
+    info = data["metrics_info"] = {"handler": "unhandled"}
+    start = time.perf_counter()
+    try:
+        return await handler(event, data)
+    except Exception:
+        inc_counter("moviematch_update_errors_total", info["handler"])
+        raise
+    finally:
+        elapsed = time.perf_counter() - start
+        observe("moviematch_update_seconds", info["handler"], elapsed)
+        inc_counter("moviematch_updates_total", info["handler"])
+        if elapsed * 1000 >= SLOW_UPDATE_MS:
+            user = data.get('event_from_user')
+            print(f"Медленный апдейт: {info['handler']} — {elapsed * 1000:.0f} мс (user {user.id if user else '-'})")
+
+
+@dp.message.middleware()
+@dp.callback_query.middleware()
+async def handler_name_middleware(handler, event, data):
+    """Сообщает metrics_middleware, какой хендлер выбран для апдейта"""
+    info = data.get("metrics_info")
+    if info is not None:
+        info["handler"] = data["handler"].callback.__name__
+    return await handler(event, data)
+
+
+# --- ОЧЕРЕДЬ АПДЕЙТОВ ПОЛЬЗОВАТЕЛЯ ---
+
+user_buckets = {}  # {user_id: TokenBucket} — лимит апдейтов от пользователя
+user_locks = {}  # {user_id: [asyncio.Lock, сколько апдейтов ждут или держат]}
+recent_callbacks = {}  # {(user_id, message_id, data): monotonic-время нажатия}
+flood_stats = {"throttled": 0, "duplicates": 0}
+
+
+def is_duplicate_callback(user_id, callback: types.CallbackQuery):
+    now = time.monotonic()
+    if len(recent_callbacks) > 10000:
+        for k in [k for k, t in recent_callbacks.items() if now - t > CALLBACK_DEDUP_WINDOW]:
+            del recent_callbacks[k]
+    key = (user_id, callback.message.message_id if callback.message else None, callback.data)
+    last = recent_callbacks.get(key)
+    recent_callbacks[key] = now
+    return last is not None and now - last < CALLBACK_DEDUP_WINDOW
+
+
+@dp.message.outer_middleware()
+@dp.callback_query.outer_middleware()
+async def flood_middleware(handler, event, data):
+    """Отбрасывает двойные нажатия и флуд до фильтров и запросов к БД"""
+    user = data.get('event_from_user')
+    if not user:
+        return await handler(event, data)
+
+    if isinstance(event, types.CallbackQuery) and is_duplicate_callback(user.id, event):
+        flood_stats["duplicates"] += 1
+        return await event.answer()
+
+    bucket = user_buckets.get(user.id)
+    if bucket is None:
+        if len(user_buckets) > 10000:
+            for uid in [u for u, b in user_buckets.items() if b.is_idle()]:
+                del user_buckets[uid]
+        bucket = user_buckets[user.id] = TokenBucket(USER_UPDATE_RATE, USER_UPDATE_BURST)
+    if not bucket.try_take():
+        flood_stats["throttled"] += 1
+        if isinstance(event, types.CallbackQuery):
+            await event.answer("⏳ Не так быстро")
+        return
+    return await handler(event, data)
+
+
+@dp.message.middleware()
+@dp.callback_query.middleware()
+async def user_serial_middleware(handler, event, data):
+    """Апдейты одного пользователя выполняются по очереди: следующий ждет, пока закончится предыдущий.
+    Хендлеры с флагом long_running (рассылка, бэкап, выгрузка) идут мимо очереди, чтобы не держать ее"""
+    user = data.get('event_from_user')
+    if not user or get_flag(data, "long_running"):
+        return await handler(event, data)
+
+    entry = user_locks.get(user.id)
+    if entry is None:
+        entry = user_locks[user.id] = [asyncio.Lock(), 0]
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            return await handler(event, data)
+    finally:
+        entry[1] -= 1
+        if not entry[1]:
+            del user_locks[user.id]
+
+
 @dp.message.outer_middleware()
 @dp.callback_query.outer_middleware()
 async def blacklist_middleware(handler, event, data):
@@ -456,13 +2575,25 @@ async def blacklist_middleware(handler, event, data):
     return await handler(event, data)
 
 
-async def send_next_movie(uid):
+async def drop_card(card_message: Optional[types.Message]):
+    """Удаляет старую карточку (если она есть), ошибки игнорируем"""
+    if not card_message:
+        return
+    try:
+        await card_message.delete()
+    except:
+        pass
+
+
+async def send_next_movie(uid, card_message: Optional[types.Message] = None):
+    # card_message — карточка, по которой только что свайпнули.
+    # В режиме CARD_EDIT_MODE мы меняем её содержимое на месте (1 запрос к API вместо 2)
     await update_user_activity(uid)
     rid = user_to_room.get(uid)
     if not rid: return
     room = rooms[rid]
     u_data = room["users"][uid]
-    seen_ids = await get_user_seen_ids(uid)
+    seen_ids = await get_user_seen(uid)
 
     while True:
         idx = u_data["idx"]
@@ -471,17 +2602,23 @@ async def send_next_movie(uid):
             # Исправление №1: Добавили await
             new_m = await fetch_movies_page(room["last_page"], room["genre_id"])
             if not new_m:
-                return await bot.send_message(uid, "Фильмы закончились!")
+                await drop_card(card_message)
+                return await tg_call(uid, lambda: bot.send_message(uid, "Фильмы закончились!"))
+            if room.get("is_solo"):
+                new_m = await rank_deck(uid, new_m)
             room["movies"].extend(new_m)
 
         movie = room["movies"][idx]
-        if str(movie['id']) in seen_ids:
+        if is_seen(seen_ids, movie['id']):
             u_data["idx"] += 1
             continue
         break
 
-    m_title = html.quote(movie.get('title', ''))
-    m_desc = html.quote(movie.get('overview', ''))[:350] + "..."
+    # Тексты — на языке этого пользователя (в комнате вдвоем у участников он может быть разным).
+    # Карточка с переводами общая для всех языков и все равно нужна ради трейлера
+    details = await fetch_movie_details(movie['id'], language=await get_user_language(uid))
+    m_title = html.quote(details.get('title') or movie.get('title', ''))
+    m_desc = html.quote(details.get('overview') or movie.get('overview', ''))[:350] + "..."
 
     # Проверка постера
     poster_path = movie.get('poster_path')
@@ -494,8 +2631,7 @@ async def send_next_movie(uid):
     builder.button(text="❤️", callback_data=f"like_{movie['id']}")
     builder.button(text="❌", callback_data=f"dislike_{movie['id']}")
 
-    # Исправление №2: Добавили await для получения трейлера
-    trailer = await get_trailer_url(movie['id'])
+    trailer = pick_trailer(details)
 
     if trailer:
         builder.button(text="📺 Трейлер", url=trailer)
@@ -518,23 +2654,38 @@ async def send_next_movie(uid):
 
     caption_text = f"🎬 <b>{m_title}</b>\n⭐ {movie.get('vote_average')}\n\n{m_desc}"
 
+    # --- СМЕНА КАРТОЧКИ НА МЕСТЕ ---
+    # Если редактирование не удалось (старая карточка без фото, сообщение удалено и т.д.) —
+    # откатываемся на удаление + отправку новой карточки
+    if card_message and CARD_EDIT_MODE:
+        try:
+            await tg_call(uid, lambda: card_message.edit_media(
+                media=types.InputMediaPhoto(media=poster, caption=caption_text, parse_mode="HTML"),
+                reply_markup=builder.as_markup()
+            ))
+            return
+        except Exception as e:
+            print(f"Ошибка edit_media ({movie['id']}): {e}")
+
+    await drop_card(card_message)
+
     try:
-        await bot.send_photo(
+        await tg_call(uid, lambda: bot.send_photo(
             uid,
             poster,
             caption=caption_text,
             reply_markup=builder.as_markup(),
             parse_mode="HTML"
-        )
+        ))
     except Exception as e:
         print(f"Ошибка фото ({movie['id']}): {e}")
         try:
-            await bot.send_message(
+            await tg_call(uid, lambda: bot.send_message(
                 uid,
                 text=f"🖼 <i>(Постер недоступен)</i>\n\n{caption_text}",
                 reply_markup=builder.as_markup(),
                 parse_mode="HTML"
-            )
+            ))
         except Exception as e2:
             print(f"Критическая ошибка отправки: {e2}")
 
@@ -632,16 +2783,10 @@ async def user_support_start(callback: types.CallbackQuery, state: FSMContext):
 
 @dp.message(UserStates.waiting_for_ticket)
 async def user_support_send(message: types.Message, state: FSMContext):
-    current_time = datetime.datetime.now().strftime("%Y-%m-%d %H:%M")
-
     # ИСПРАВЛЕНИЕ: берем текст или описание фото, если текста нет
     ticket_content = message.text or message.caption or "[Изображение без текста]"
 
-    await db.execute(
-        "INSERT INTO tickets (user_id, message, status, created_at) VALUES (?, ?, ?, ?)",
-        (message.from_user.id, ticket_content, "open", current_time)
-    )
-    await db.commit()
+    await create_ticket(message.from_user.id, ticket_content)
 
     await message.answer("✅ Ваше обращение отправлено администрации! Мы ответим вам в ближайшее время.")
     await state.clear()
@@ -679,11 +2824,10 @@ async def reply_ticket_send(message: types.Message, state: FSMContext):
                 f"<b>Ваш вопрос:</b> <i>{user_msg}</i>\n\n"
                 f"<b>Ответ:</b> {admin_reply}"
             )
-            await bot.send_message(user_id, text_to_user, parse_mode="HTML")
+            await tg_call(user_id, lambda: bot.send_message(user_id, text_to_user, parse_mode="HTML"), PRIORITY_NOTIFY)
 
             # Закрываем тикет после ответа
-            await db.execute("UPDATE tickets SET status = 'closed' WHERE id = ?", (ticket_id,))
-            await db.commit()
+            await close_ticket(ticket_id)
 
             await message.answer(f"✅ Ответ отправлен пользователю {user_id}, тикет закрыт.")
             await log_admin_action(message.from_user.id, "REPLY_TICKET", f"Ticket ID: {ticket_id}")
@@ -749,11 +2893,11 @@ async def auto_close_room(rid, creator_id):
                 del user_to_room[creator_id]
 
             try:
-                await bot.send_message(
+                await tg_call(creator_id, lambda: bot.send_message(
                     creator_id,
                     "⏰ <b>Время вышло!</b>\nНикто не подключился к комнате за 5 минут, она автоматически закрыта.",
                     parse_mode="HTML"
-                )
+                ), PRIORITY_NOTIFY)
             except:
                 pass
 
@@ -777,8 +2921,9 @@ async def watch_room_inactivity(rid):
             for u in uids:
                 if u in user_to_room: del user_to_room[u]
                 try:
-                    await bot.send_message(u, "🔔 <b>Комната закрыта!</b>\nВы бездействовали более 10 минут.",
-                                           parse_mode="HTML")
+                    await tg_call(u, lambda: bot.send_message(
+                        u, "🔔 <b>Комната закрыта!</b>\nВы бездействовали более 10 минут.", parse_mode="HTML"
+                    ), PRIORITY_NOTIFY)
                 except:
                     pass
             break
@@ -813,7 +2958,9 @@ async def finish_create(callback: types.CallbackQuery):
                 # Если кто-то остался, уведомляем его
                 for partner_id in rooms[old_rid]["users"]:
                     try:
-                        await bot.send_message(partner_id, "🚪 Ваш партнер покинул комнату. Сессия завершена.")
+                        await tg_call(partner_id, lambda: bot.send_message(
+                            partner_id, "🚪 Ваш партнер покинул комнату. Сессия завершена."
+                        ), PRIORITY_NOTIFY)
                         # Очищаем привязку партнера, так как вдвоем играть больше нельзя
                         if partner_id in user_to_room:
                             del user_to_room[partner_id]
@@ -839,18 +2986,19 @@ async def finish_create(callback: types.CallbackQuery):
 
     # Логика фильтрации (оставляем твою рабочую версию)
     # Используем глобальную db, которую открыли в main()
-    async with db.execute("SELECT movie_id FROM user_votes WHERE user_id = ?", (uid,)) as c:
-        rows = await c.fetchall()
-        seen_ids = {str(r[0]) for r in rows}
+    seen_ids = await get_user_seen(uid)
+    language = await get_user_language(uid)  # Выдача комнаты — на языке создателя
 
     final_movies = []
     current_page = 1
     while len(final_movies) < 15 and current_page <= 5:
         movies_list = await fetch_movies_page(current_page, gid)
         if not movies_list: break
-        filtered = [m for m in movies_list if str(m['id']) not in seen_ids]
+        filtered = [m for m in movies_list if not is_seen(seen_ids, m['id'])]
         final_movies.extend(filtered)
         current_page += 1
+    # Общая лента комнаты — по вкусу создателя
+    final_movies = await rank_deck(uid, final_movies)
 
     rooms[rid] = {
         "movies": final_movies,
@@ -858,6 +3006,7 @@ async def finish_create(callback: types.CallbackQuery):
         "is_solo": False,
         "last_page": current_page - 1,
         "genre_id": gid,
+        "language": language,
         "last_action": datetime.datetime.now()
     }
     user_to_room[uid] = rid
@@ -936,9 +3085,11 @@ async def exit_room_handler(callback: types.CallbackQuery):
         if u in user_to_room: del user_to_room[u]
         try:
             if u == uid:
-                await bot.send_message(u, "🚪 Вы вышли из комнаты. Сессия завершена.")
+                await tg_call(u, lambda: bot.send_message(u, "🚪 Вы вышли из комнаты. Сессия завершена."))
             else:
-                await bot.send_message(u, "🚪 Ваш партнер покинул комнату. Сессия завершена.")
+                await tg_call(u, lambda: bot.send_message(
+                    u, "🚪 Ваш партнер покинул комнату. Сессия завершена."
+                ), PRIORITY_NOTIFY)
         except:
             pass
 
@@ -975,59 +3126,112 @@ async def ad_team_rem_proc(message: types.Message, state: FSMContext):
     await state.clear()
 
 # --- ВСПОМОГАТЕЛЬНАЯ ФУНКЦИЯ ДЛЯ ОБНОВЛЕНИЯ МЕНЮ (добавь её в код) ---
-async def refresh_admin_commands(user_id, is_adding=True):
+def get_chat_commands(is_admin_menu):
     # Общие команды для всех
     base_cmds = [
         types.BotCommand(command="start", description="🏠 Главное меню"),
-        types.BotCommand(command="profile", description="👤 Профиль")
+        types.BotCommand(command="profile", description="👤 Профиль"),
+        types.BotCommand(command="export", description="📤 Выгрузить мои голоса")
     ]
-
-    if is_adding:
+    if is_admin_menu:
         # Админ получает базу + команду admin
-        admin_cmds = base_cmds + [types.BotCommand(command="admin", description="⚙️ Админка")]
-        await bot.set_my_commands(admin_cmds, scope=types.BotCommandScopeChat(chat_id=user_id))
-    else:
-        # Обычный юзер получает только базу
-        await bot.set_my_commands(base_cmds, scope=types.BotCommandScopeChat(chat_id=user_id))
+        return base_cmds + [types.BotCommand(command="admin", description="⚙️ Админка")]
+    # Обычный юзер получает только базу
+    return base_cmds
+
+
+def get_default_commands():
+    return [
+        BotCommand(command='/start', description='🏠 Главное меню'),
+        BotCommand(command='/export', description='📤 Выгрузить мои голоса')
+    ]
+
+
+async def apply_commands(chat_id, commands, scope):
+    """
+    Ставит меню команд, только если оно отличается от последнего примененного в этом чате
+    (хеш хранится в command_sync). Возвращает True, если был запрос к Telegram.
+    """
+    commands_hash = hashlib.sha1(
+        json.dumps([(c.command, c.description) for c in commands], ensure_ascii=False).encode()
+    ).hexdigest()
+    async with db.execute("SELECT commands_hash FROM command_sync WHERE chat_id = ?", (chat_id,)) as cursor:
+        row = await cursor.fetchone()
+    if row and row[0] == commands_hash:
+        return False
+
+    await tg_call(chat_id, lambda: bot.set_my_commands(commands, scope=scope), PRIORITY_NOTIFY)
+    await db.execute(
+        """INSERT INTO command_sync (chat_id, commands_hash, updated_at) VALUES (?, ?, ?)
+           ON CONFLICT(chat_id) DO UPDATE SET commands_hash = excluded.commands_hash, updated_at = excluded.updated_at""",
+        (chat_id, commands_hash, get_now())
+    )
+    await db.commit()
+    return True
+
+
+async def refresh_admin_commands(user_id, is_adding=True):
+    await apply_commands(user_id, get_chat_commands(is_adding), types.BotCommandScopeChat(chat_id=user_id))
+
+
+async def sync_startup_commands():
+    """
+    Фоновая синхронизация меню после старта: общее меню, меню админов и сброс меню у бывших админов.
+    Чаты с неизменившимся меню пропускаются, остальные обновляются параллельно (не больше COMMAND_SYNC_CONCURRENCY).
+    """
+    async with db.execute("SELECT user_id FROM admins") as cursor:
+        admin_ids = {row[0] for row in await cursor.fetchall()}
+    admin_ids.add(SUPER_ADMIN_ID)
+    admin_ids.discard(0)  # 0 — SUPER_ADMIN_ID не задан, а chat_id = 0 занят общим меню
+    # Чаты, где когда-то стояло админское меню, а админа уже сняли (пока бот был выключен)
+    async with db.execute("SELECT chat_id FROM command_sync WHERE chat_id != 0") as cursor:
+        former_ids = {row[0] for row in await cursor.fetchall()} - admin_ids
+
+    semaphore = asyncio.Semaphore(COMMAND_SYNC_CONCURRENCY)
+
+    async def sync_one(chat_id, commands, scope):
+        async with semaphore:
+            try:
+                return await apply_commands(chat_id, commands, scope)
+            except Exception as e:
+                print(f"Ошибка обновления меню для {chat_id}: {e}")
+                return None
+
+    jobs = [sync_one(0, get_default_commands(), BotCommandScopeDefault())]
+    jobs += [sync_one(uid, get_chat_commands(True), types.BotCommandScopeChat(chat_id=uid)) for uid in admin_ids]
+    jobs += [sync_one(uid, get_chat_commands(False), types.BotCommandScopeChat(chat_id=uid)) for uid in former_ids]
+    results = await asyncio.gather(*jobs)
+
+    print(f"Меню команд: обновлено {results.count(True)}, без изменений {results.count(False)}, "
+          f"ошибок {results.count(None)}")
 # --- ЛАЙКИ ---
 
 # 1. ОСНОВНАЯ ЛОГИКА ОТРИСОВКИ (вызываем из других функций)
 async def render_likes_page(callback, movies, page, total_pages):
-    # movies - это список кортежей (movie_id, movie_title)
+    # movies - это список кортежей (rowid, movie_id, movie_title) из get_likes_page
 
-    # Функция для параллельной загрузки постера
-    async def fetch_poster(session, m_id):
-        url = f"https://api.themoviedb.org/3/movie/{m_id}?api_key={TMDB_API_KEY}&language=ru-RU"
-        try:
-            async with session.get(url, timeout=2) as resp:
-                if resp.status == 200:
-                    data = await resp.json()
-                    path = data.get('poster_path')
-                    return f"https://image.tmdb.org/t/p/w200{path}" if path else None
-        except:
-            return None
-        return None
-
-    # Запускаем все запросы одновременно (это ускоряет загрузку в 5 раз)
-    async with aiohttp.ClientSession() as session:
-        tasks = [fetch_poster(session, m[0]) for m in movies]
-        await asyncio.gather(*tasks)  # Прогреваем кеш или проверяем доступность (опционально)
+    # Прогреваем кеш карточек в фоне, чтобы кнопка с фильмом открывалась без ожидания TMDB
+    for m in movies:
+        asyncio.create_task(fetch_movie_details(m[1], TMDB_PRIORITY_PREFETCH))
 
     text = f"❤️ <b>Ваши лайки (Страница {page}/{total_pages}):</b>\n\n"
     text += "<i>Нажмите на кнопку с названием, чтобы открыть описание и трейлер</i>\n\n"
 
+    # Якорь текущей страницы: по нему карточка фильма и удаление возвращают на эту же страницу
+    anchor = f"a{movies[0][0] - 1}"
+
     kb = InlineKeyboardBuilder()
-    for i, (m_id, m_title) in enumerate(movies):
-        num = (page - 1) * 5 + i + 1
+    for i, (_, m_id, m_title) in enumerate(movies):
+        num = (page - 1) * LIKES_PAGE_SIZE + i + 1
         text += f"{num}. 🎬 <b>{m_title}</b>\n"
         # callback_data="info_{m_id}" теперь будет открывать карточку
-        kb.button(text=f"🎥 {m_title}", callback_data=f"info_{m_id}_{page}")
+        kb.button(text=f"🎥 {m_title}", callback_data=f"info_{m_id}_{page}_{anchor}")
 
     nav_btns = []
     if page > 1:
-        nav_btns.append(types.InlineKeyboardButton(text="⬅️", callback_data=f"likes_page_{page - 1}"))
+        nav_btns.append(types.InlineKeyboardButton(text="⬅️", callback_data=f"likes_page_{page - 1}_b{movies[0][0]}"))
     if page < total_pages:
-        nav_btns.append(types.InlineKeyboardButton(text="➡️", callback_data=f"likes_page_{page + 1}"))
+        nav_btns.append(types.InlineKeyboardButton(text="➡️", callback_data=f"likes_page_{page + 1}_a{movies[-1][0]}"))
 
     if nav_btns:
         kb.row(*nav_btns)
@@ -1048,15 +3252,12 @@ async def movie_info_handler(callback: types.CallbackQuery):
     parts = callback.data.split("_")
     movie_id = parts[1]
     from_page = parts[2] if len(parts) > 2 else 1  # Запоминаем страницу, чтобы вернуться
+    anchor = parts[3] if len(parts) > 3 else "a0"
 
-    url = f"https://api.themoviedb.org/3/movie/{movie_id}?api_key={TMDB_API_KEY}&language=ru-RU"
-
-    conn = ProxyConnector.from_url(PROXY_URL)
-    async with aiohttp.ClientSession(connector=conn) as session:
-        async with session.get(url) as resp:
-            if resp.status != 200:
-                return await callback.answer("Ошибка TMDB")
-            movie = await resp.json()
+    # Описание и трейлер приходят одним запросом (append_to_response=videos)
+    movie = await fetch_movie_details(movie_id, language=await get_user_language(callback.from_user.id))
+    if not movie:
+        return await callback.answer("Ошибка TMDB")
 
     m_title = movie.get('title', 'Без названия')
     caption = (
@@ -1067,12 +3268,12 @@ async def movie_info_handler(callback: types.CallbackQuery):
     )
 
     kb = InlineKeyboardBuilder()
-    trailer = await get_trailer_url(movie_id)
+    trailer = pick_trailer(movie)
     if trailer:
         kb.button(text="📺 Смотреть трейлер", url=trailer)
 
-    kb.button(text="🗑 Удалить из лайков", callback_data=f"confirm_del_{movie_id}_{from_page}")
-    kb.button(text="🔙 Назад к списку", callback_data=f"likes_page_{from_page}")
+    kb.button(text="🗑 Удалить из лайков", callback_data=f"confirm_del_{movie_id}_{from_page}_{anchor}")
+    kb.button(text="🔙 Назад к списку", callback_data=f"likes_page_{from_page}_{anchor}")
     kb.adjust(1)
 
     poster_path = movie.get('poster_path')
@@ -1088,25 +3289,47 @@ async def movie_info_handler(callback: types.CallbackQuery):
         await callback.message.edit_text(caption, reply_markup=kb.as_markup(), parse_mode="HTML")
 
 
+async def load_likes_page(uid, page, anchor):
+    """Грузит страницу по якорю из callback_data ("a{rowid}" — после, "b{rowid}" — до).
+    Возвращает (фильмы, номер страницы, всего страниц)"""
+    total = await get_likes_count(uid)
+    total_pages = max(1, (total + LIKES_PAGE_SIZE - 1) // LIKES_PAGE_SIZE)
+
+    if anchor.startswith("b"):
+        movies = await get_likes_page(uid, before=int(anchor[1:]))
+        if len(movies) < LIKES_PAGE_SIZE:
+            # Перед якорем меньше полной страницы (лайки удаляли) — возвращаемся в начало
+            movies, page = await get_likes_page(uid), 1
+    else:
+        after = int(anchor[1:]) if anchor[1:].isdigit() else 0
+        movies = await get_likes_page(uid, after=after)
+        if not movies and after:
+            # Удалили последний фильм на последней странице — показываем предыдущую
+            movies = await get_likes_page(uid, before=after + 1)
+            page -= 1
+            if len(movies) < LIKES_PAGE_SIZE:
+                movies, page = await get_likes_page(uid), 1
+
+    # Якорь "a0" — всегда первая страница, какой бы номер ни пришел в кнопке
+    page = 1 if anchor == "a0" else min(max(page, 1), total_pages)
+    return movies, page, total_pages
+
+
 # 2. ОБРАБОТЧИК КНОПКИ "МОИ ЛАЙКИ" И СТРЕЛОК
 @dp.callback_query(F.data.startswith("show_my_likes"))
 async def show_likes_handler(callback: types.CallbackQuery):
     uid = callback.from_user.id
-    # Получаем все лайки (используем твою существующую функцию)
-    all_likes = await get_full_likes(uid)
+    total = await get_likes_count(uid)
 
-    if not all_likes:
+    if not total:
         return await callback.answer("У вас пока нет лайков!", show_alert=True)
 
-    items_per_page = 5
-    total_pages = (len(all_likes) + items_per_page - 1) // items_per_page
-    current_page = 1 # Всегда начинаем с первой страницы
-
-    # Берем первые 5 фильмов
-    page_movies = all_likes[0:items_per_page]
+    total_pages = (total + LIKES_PAGE_SIZE - 1) // LIKES_PAGE_SIZE
+    # Всегда начинаем с первой страницы: берем первые LIKES_PAGE_SIZE фильмов по индексу
+    page_movies = await get_likes_page(uid)
 
     # Передаем всё в функцию отрисовки
-    await render_likes_page(callback, page_movies, current_page, total_pages)
+    await render_likes_page(callback, page_movies, 1, total_pages)
 
 
 # 3. ОБРАБОТЧИК УДАЛЕНИЯ
@@ -1114,43 +3337,33 @@ async def show_likes_handler(callback: types.CallbackQuery):
 async def delete_like_handler(callback: types.CallbackQuery):
     data = callback.data.split("_")
     movie_id = data[2]
-    current_page = int(data[3])  # Предположим, тут хранится номер страницы
+    current_page = int(data[3])  # Номер страницы, с которой открыли фильм
+    anchor = data[4] if len(data) > 4 else "a0"  # Старые кнопки без якоря ведут на первую страницу
 
     await delete_like(callback.from_user.id, movie_id)
     await callback.answer("Удалено 🗑")
 
-    all_likes = await get_full_likes(callback.from_user.id)
-    if not all_likes:
+    page_movies, current_page, total_pages = await load_likes_page(callback.from_user.id, current_page, anchor)
+    if not page_movies:
         try:
             await callback.message.delete()
         except:
             pass
         return await callback.message.answer("Список лайков теперь пуст!")
 
-    # Пересчитываем страницы
-    items_per_page = 5
-    total_pages = (len(all_likes) + items_per_page - 1) // items_per_page
-
-    if current_page > total_pages:
-        current_page = total_pages
-
-    start_idx = (current_page - 1) * items_per_page
-    page_movies = all_likes[start_idx: start_idx + items_per_page]
-
     # ВЫЗОВ: передаем обновленные данные
     await render_likes_page(callback, page_movies, current_page, total_pages)
 
 @dp.callback_query(F.data.startswith("likes_page_"))
 async def likes_pagination_handler(callback: types.CallbackQuery):
-    page = int(callback.data.split("_")[2])
+    parts = callback.data.split("_")
+    page = int(parts[2])
+    anchor = parts[3] if len(parts) > 3 else "a0"
     uid = callback.from_user.id
-    all_likes = await get_full_likes(uid)
-
-    items_per_page = 5
-    total_pages = (len(all_likes) + items_per_page - 1) // items_per_page
 
-    start_idx = (page - 1) * items_per_page
-    page_movies = all_likes[start_idx: start_idx + items_per_page]
+    page_movies, page, total_pages = await load_likes_page(uid, page, anchor)
+    if not page_movies:
+        return await callback.answer("У вас пока нет лайков!", show_alert=True)
 
     await render_likes_page(callback, page_movies, page, total_pages)
 
@@ -1160,11 +3373,169 @@ async def handle_delete(callback: types.CallbackQuery):
     await callback.message.edit_text("🗑 Удалено")
 
 
+# --- ЭКСПОРТ ГОЛОСОВ ---
+
+EXPORT_FIELDS = ["movie_id", "title", "vote", "added_at", "release_date", "rating", "genres"]
+exports_in_progress = set()  # user_id, для которых сейчас собирается файл
+
+
+def export_row(movie_id, title, is_like, added_at, release_date, rating, genre_ids):
+    genres = [GENRES[str(g)].split(" ", 1)[1] if str(g) in GENRES else str(g)
+              for g in json.loads(genre_ids or "[]")]
+    return {
+        "movie_id": movie_id,
+        "title": title,
+        "vote": "like" if is_like else "dislike",
+        "added_at": added_at,
+        "release_date": release_date,
+        "rating": rating,
+        "genres": ", ".join(genres),
+    }
+
+
+def read_archived_votes(path, user_id):
+    """Голоса пользователя из одного файла архива (новые выше)"""
+    if not os.path.exists(path):
+        return []
+    conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        return conn.execute(
+            "SELECT movie_id, movie_title, is_like, added_at FROM user_votes WHERE user_id = ? ORDER BY id DESC",
+            (user_id,)
+        ).fetchall()
+    finally:
+        conn.close()
+
+
+async def iter_archived_vote_rows(user_id):
+    """Голоса пользователя, перенесенные архиватором в archive/votes_YYYY_MM.db (новые месяцы выше)"""
+    async with db.execute("SELECT dislikes, months FROM user_vote_archive WHERE user_id = ?", (user_id,)) as c:
+        row = await c.fetchone()
+    if not row or not row[0]:
+        return
+    if row[1] is not None:
+        months = row[1].split(",")
+    else:
+        names = await asyncio.to_thread(os.listdir, VOTE_ARCHIVE_DIR) if os.path.isdir(VOTE_ARCHIVE_DIR) else []
+        months = [n[6:-3] for n in names if n.startswith("votes_") and n.endswith(".db")]
+
+    for month in sorted(months, reverse=True):
+        rows = await asyncio.to_thread(read_archived_votes, os.path.join(VOTE_ARCHIVE_DIR, f"votes_{month}.db"), user_id)
+        for i in range(0, len(rows), EXPORT_CHUNK_ROWS):
+            chunk = rows[i:i + EXPORT_CHUNK_ROWS]
+            ids = list({r[0] for r in chunk})
+            async with db.execute(
+                f"""SELECT movie_id, title, release_date, vote_average, genre_ids FROM movie_catalog
+                    WHERE movie_id IN ({",".join("?" * len(ids))})""", ids
+            ) as c:
+                catalog = {r[0]: r[1:] for r in await c.fetchall()}
+            for movie_id, title, is_like, added_at in chunk:
+                c_title, release_date, rating, genre_ids = catalog.get(movie_id, (None, None, None, None))
+                yield export_row(movie_id, title or c_title, is_like, added_at, release_date, rating, genre_ids)
+
+
+async def iter_vote_rows(user_id):
+    """Голоса пользователя по одному (сначала лайки, новые выше), с данными из локального каталога.
+    Порядок совпадает с idx_user_votes_user_likes, поэтому SQLite не сортирует выборку в памяти,
+    а курсор читается пачками — память не зависит от числа голосов. В конце — голоса из архива"""
+    query = """
+        SELECT v.movie_id, COALESCE(NULLIF(v.movie_title, ''), c.title), v.is_like, v.added_at,
+               c.release_date, c.vote_average, c.genre_ids
+        FROM user_votes v
+        LEFT JOIN movie_catalog c ON c.movie_id = v.movie_id
+        WHERE v.user_id = ?
+        ORDER BY v.is_like DESC, v.rowid DESC
+    """
+    async with db.execute(query, (user_id,)) as cursor:
+        while True:
+            rows = await cursor.fetchmany(EXPORT_CHUNK_ROWS)
+            if not rows:
+                break
+            for row in rows:
+                yield export_row(*row)
+    async for row in iter_archived_vote_rows(user_id):
+        yield row
+
+
+async def write_votes_export(user_id, fmt, f):
+    """Пишет выгрузку в открытый текстовый файл кусками по EXPORT_CHUNK_ROWS строк (запись — в потоке,
+    чтобы диск не держал event loop). Возвращает число строк"""
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=EXPORT_FIELDS)
+    if fmt == "csv":
+        writer.writeheader()
+    else:
+        buffer.write("[")
+
+    count = 0
+    async for row in iter_vote_rows(user_id):
+        if fmt == "csv":
+            writer.writerow(row)
+        else:
+            buffer.write(("," if count else "") + "\n  " + json.dumps(row, ensure_ascii=False))
+        count += 1
+        if count % EXPORT_CHUNK_ROWS == 0:
+            await asyncio.to_thread(f.write, buffer.getvalue())
+            buffer.seek(0)
+            buffer.truncate()
+
+    if fmt == "json":
+        buffer.write("\n]\n")
+    await asyncio.to_thread(f.write, buffer.getvalue())
+    return count
+
+
+@dp.message(Command("export"), flags={"long_running": True})
+async def export_votes(message: types.Message):
+    # /export [csv|json] [user_id — только для админов]
+    args = message.text.split()[1:]
+    fmt = "csv"
+    target_id = message.from_user.id
+    for arg in args:
+        if arg.lower() in ("csv", "json"):
+            fmt = arg.lower()
+        elif arg.isdigit() and await is_admin(message.from_user.id):
+            target_id = int(arg)
+        else:
+            return await message.answer(
+                "Использование: <code>/export</code> или <code>/export json</code>", parse_mode="HTML"
+            )
+
+    if message.from_user.id in exports_in_progress:
+        return await message.answer("⏳ Предыдущая выгрузка еще готовится.")
+    exports_in_progress.add(message.from_user.id)
+
+    path = None
+    try:
+        # BOM в CSV нужен, чтобы Excel правильно открыл кириллицу
+        with tempfile.NamedTemporaryFile("w", suffix=f".{fmt}", delete=False, newline="",
+                                         encoding="utf-8-sig" if fmt == "csv" else "utf-8") as f:
+            path = f.name
+            count = await write_votes_export(target_id, fmt, f)
+
+        if not count:
+            if target_id != message.from_user.id:
+                return await message.answer(f"У пользователя {target_id} пока нет голосов — выгружать нечего.")
+            return await message.answer("У вас пока нет голосов — выгружать нечего.")
+
+        document = FSInputFile(path, filename=f"moviematch_{target_id}.{fmt}")
+        await tg_call(message.chat.id, lambda: message.answer_document(
+            document, caption=f"📤 Голосов в выгрузке: {count}"
+        ))
+    except Exception as e:
+        await log_error(f"Ошибка экспорта для {target_id}: {e}")
+        await message.answer("❌ Не удалось собрать выгрузку, попробуйте позже.")
+    finally:
+        exports_in_progress.discard(message.from_user.id)
+        if path and os.path.exists(path):
+            os.remove(path)
+
+
 @dp.callback_query(F.data == "show_top_10")
 async def show_top(callback: types.CallbackQuery):
     top = await get_global_top()
     if not top: return await callback.answer("Топ пуст!")
-    text = "🔥 Топ-10:\n\n" + "\n".join([f"{i + 1}. {t} ({c})" for i, (t, c) in enumerate(top)])
+    text = "🔥 Топ-10:\n\n" + "\n".join([f"{i + 1}. {html.quote(t)} ({c})" for i, (t, c) in enumerate(top)])
     await callback.message.answer(text)
 
 
@@ -1181,6 +3552,12 @@ async def handle_vote(callback: types.CallbackQuery):
 
     room = rooms[rid]
 
+    # Голос принимаем только за карточку, которая сейчас на экране: повторное нажатие
+    # (❤️ и ❌ подряд, старая карточка) после обработки первого уже указывает на прошлый фильм
+    idx = room["users"][uid]["idx"]
+    if idx >= len(room["movies"]) or str(room["movies"][idx]['id']) != mid:
+        return await callback.answer()
+
     # --- ОБНОВЛЯЕМ ВРЕМЯ АКТИВНОСТИ (ДЛЯ ТАЙМЕРА 10 МИНУТ) ---
     room["last_action"] = datetime.datetime.now()
 
@@ -1198,9 +3575,12 @@ async def handle_vote(callback: types.CallbackQuery):
                             (o_uid, mid)
                     ) as c:
                         if await c.fetchone():
+                            pending_matches[datetime.date.today().isoformat()] += 1
                             # Уведомляем обоих участников
                             for u in room["users"]:
-                                await bot.send_message(u, f"🥳 <b>МЭТЧ: {movie['title']}!</b>", parse_mode="HTML")
+                                await tg_call(u, lambda: bot.send_message(
+                                    u, f"🥳 <b>МЭТЧ: {movie['title']}!</b>", parse_mode="HTML"
+                                ), PRIORITY_NOTIFY)
 
         # Переходим к следующему фильму
         room["users"][uid]["idx"] += 1
@@ -1213,6 +3593,8 @@ async def handle_vote(callback: types.CallbackQuery):
             new_movies = await fetch_movies_page(next_page, room.get("genre_id"))
 
             if new_movies:
+                if room["is_solo"]:
+                    new_movies = await rank_deck(uid, new_movies)
                 # Собираем ID фильмов, которые УЖЕ есть в этой комнате, чтобы не было дублей
                 existing_ids = {str(m['id']) for m in room["movies"]}
                 # Добавляем в общий список только уникальные новые фильмы
@@ -1223,12 +3605,8 @@ async def handle_vote(callback: types.CallbackQuery):
                 room["last_page"] = next_page
         # ---------------------------------------
 
-        try:
-            await callback.message.delete()
-        except:
-            pass
-
-        await send_next_movie(uid)
+        # Старую карточку не удаляем: send_next_movie отредактирует её на месте
+        await send_next_movie(uid, callback.message)
 
 
 # --- АДМИН ПАНЕЛЬ ---
@@ -1290,9 +3668,11 @@ async def ad_team_add_proc(message: types.Message, state: FSMContext):
         await refresh_admin_commands(tid, is_adding=True)
 
         try:
-            await bot.send_message(tid,
-                                   "👑 <b>Вам выданы права администратора!</b>\nИспользуйте команду /admin для доступа к панели.",
-                                   parse_mode="HTML")
+            await tg_call(tid, lambda: bot.send_message(
+                tid,
+                "👑 <b>Вам выданы права администратора!</b>\nИспользуйте команду /admin для доступа к панели.",
+                parse_mode="HTML"
+            ), PRIORITY_NOTIFY)
         except:
             pass
 
@@ -1359,9 +3739,10 @@ async def ad_bl_proc(message: types.Message, state: FSMContext):
         # --- УВЕДОМЛЕНИЕ ПОЛЬЗОВАТЕЛЯ ---
         try:
             if new_s == 1:
-                await bot.send_message(tid, "🚫 <b>Администрация ограничила вам доступ к боту.</b>", parse_mode="HTML")
+                notice = "🚫 <b>Администрация ограничила вам доступ к боту.</b>"
             else:
-                await bot.send_message(tid, "✅ <b>Ваш доступ к боту восстановлен!</b>", parse_mode="HTML")
+                notice = "✅ <b>Ваш доступ к боту восстановлен!</b>"
+            await tg_call(tid, lambda: bot.send_message(tid, notice, parse_mode="HTML"), PRIORITY_NOTIFY)
         except:
             pass
 
@@ -1373,44 +3754,111 @@ async def ad_bl_proc(message: types.Message, state: FSMContext):
 
 # --- ДЕТАЛЬНАЯ СТАТИСТИКА / ПРОФИЛЬ ---
 
+async def render_users_page(text, before=None):
+    """Текст и клавиатура страницы пользователей (все или результаты поиска)"""
+    users = await search_users(text, before, USERS_PAGE_SIZE + 1)
+    has_next = len(users) > USERS_PAGE_SIZE
+    users = users[:USERS_PAGE_SIZE]
+
+    if text:
+        title = f"🔎 Поиск «{html.quote(text)}»:" if users else f"🔎 По запросу «{html.quote(text)}» никого не нашли."
+    else:
+        title = "👤 Последние пользователи:"
+    body = "\n".join(
+        f"• <code>{u[0]}</code> - {html.quote(u[2] or '')}" + (f" (@{html.quote(u[1])})" if u[1] else "")
+        for u in users
+    )
+    hint = "Введите ID, @username или имя для поиска:"
+
+    kb = InlineKeyboardBuilder()
+    for u in users:
+        kb.button(text=f"👤 {u[2] or u[0]}", callback_data=f"adm_user_{u[0]}")
+    nav_btns = []
+    if before is not None:
+        nav_btns.append(types.InlineKeyboardButton(text="⏮ В начало", callback_data="adm_users_page_0"))
+    if has_next:
+        nav_btns.append(types.InlineKeyboardButton(text="➡️", callback_data=f"adm_users_page_{users[-1][0]}"))
+    kb.adjust(2)
+    if nav_btns:
+        kb.row(*nav_btns)
+    kb.row(types.InlineKeyboardButton(text="🔙", callback_data="back_to_admin"))
+
+    return f"{title}\n\n{body}\n\n{hint}" if body else f"{title}\n\n{hint}", kb.as_markup()
+
+
+async def render_user_profile(uid):
+    """Карточка пользователя для админа: профиль и сводка голосов одним запросом"""
+    async with db.execute(
+        """SELECT u.user_id, u.username, u.first_name, u.joined_date, u.last_active, u.is_blocked, s.votes, s.likes
+           FROM users u LEFT JOIN user_stats s ON s.user_id = u.user_id WHERE u.user_id = ?""",
+        (uid,)
+    ) as c:
+        user = await c.fetchone()
+    if not user:
+        return None
+
+    total_v, likes_v = (user[6], user[7]) if user[6] is not None else await get_vote_counts(uid)
+    recent = await get_full_likes(uid, 10)
+    likes_str = "\n".join([f"  └ {html.quote(l[1])}" for l in recent]) if recent else "  (нет)"
+
+    return (f"👤 <b>Профиль:</b> {html.quote(user[2] or '')}" + (f" (@{html.quote(user[1])})" if user[1] else "") + "\n"
+            f"🆔 ID: <code>{user[0]}</code>\n"
+            f"📅 Регистрация: {user[3]}\n"
+            f"🕒 Активность: {user[4]}\n"
+            f"{'🚫 Заблокирован' if user[5] else '✅ Активен'}\n\n"
+            f"📊 <b>Действия:</b>\n"
+            f"├ Свайпов: {total_v}\n"
+            f"└ Лайков: {likes_v}\n\n"
+            f"❤️ <b>Лайкнутые фильмы (последние 10):</b>\n{likes_str}")
+
+
 @dp.callback_query(F.data == "admin_list_users")
 async def list_users_admin(callback: types.CallbackQuery, state: FSMContext):
-    async with db.execute(
-            "SELECT user_id, first_name FROM users ORDER BY rowid DESC LIMIT 10") as c: users = await c.fetchall()
-    text = "👤 Последние пользователи:\n\n" + "\n".join([f"• <code>{u[0]}</code> - {u[1]}" for u in users])
-    text += "\n\nВведите ID для детальной статистики:"
     await state.set_state(AdminStates.waiting_for_profile_view)
-    await callback.message.edit_text(text, parse_mode="HTML", reply_markup=InlineKeyboardBuilder().button(text="🔙",
-                                                                                                          callback_data="back_to_admin").as_markup())
+    await state.update_data(user_query=None)
+    text, markup = await render_users_page(None)
+    await callback.message.edit_text(text, parse_mode="HTML", reply_markup=markup)
+
+
+@dp.callback_query(F.data.startswith("adm_users_page_"))
+async def users_admin_page(callback: types.CallbackQuery, state: FSMContext):
+    if not await is_admin(callback.from_user.id):
+        return await callback.answer("Доступ запрещен", show_alert=True)
+    before = int(callback.data.split("_")[3])
+    query = (await state.get_data()).get("user_query")
+    await state.set_state(AdminStates.waiting_for_profile_view)
+    text, markup = await render_users_page(query, before or None)
+    await callback.message.edit_text(text, parse_mode="HTML", reply_markup=markup)
+
+
+@dp.callback_query(F.data.startswith("adm_user_"))
+async def open_user_profile(callback: types.CallbackQuery):
+    if not await is_admin(callback.from_user.id):
+        return await callback.answer("Доступ запрещен", show_alert=True)
+    text = await render_user_profile(int(callback.data.split("_")[2]))
+    if not text:
+        return await callback.answer("Пользователь не найден.", show_alert=True)
+    kb = InlineKeyboardBuilder()
+    kb.button(text="🔙 К списку", callback_data="adm_users_page_0")
+    await callback.message.edit_text(text, parse_mode="HTML", reply_markup=kb.as_markup())
 
 
 @dp.message(AdminStates.waiting_for_profile_view)
 async def view_profile(message: types.Message, state: FSMContext):
+    # Остаемся в режиме поиска: можно сразу уточнить запрос, выход — кнопкой «Назад»
+    query = (message.text or "").strip()
     try:
-        uid = int(message.text.strip())
-
-        async with db.execute("SELECT * FROM users WHERE user_id = ?", (uid,)) as c: user = await c.fetchone()
-        if not user: return await message.answer("Пользователь не найден.")
-
-        async with db.execute("SELECT COUNT(*), SUM(is_like) FROM user_votes WHERE user_id = ?", (uid,)) as c:
-            res = await c.fetchone()
-            total_v, likes_v = res[0], res[1] or 0
-
-        recent = await get_full_likes(uid, 10)
-        likes_str = "\n".join([f"  └ {l[1]}" for l in recent]) if recent else "  (нет)"
-
-        text = (f"👤 <b>Профиль:</b> {user[1]}\n"
-                f"🆔 ID: <code>{user[0]}</code>\n"
-                f"📅 Регистрация: {user[3]}\n"
-                f"🕒 Активность: {user[4]}\n\n"
-                f"📊 <b>Действия:</b>\n"
-                f"├ Свайпов: {total_v}\n"
-                f"└ Лайков: {likes_v}\n\n"
-                f"❤️ <b>Лайкнутые фильмы (последние 10):</b>\n{likes_str}")
-        await message.answer(text, parse_mode="HTML")
+        if query.isdigit():
+            text = await render_user_profile(int(query))
+            if not text:
+                return await message.answer("Пользователь не найден.")
+            return await message.answer(text, parse_mode="HTML")
+
+        await state.update_data(user_query=query)
+        text, markup = await render_users_page(query)
+        await message.answer(text, parse_mode="HTML", reply_markup=markup)
     except:
         await message.answer("Ошибка.")
-    await state.clear()
 
 
 # --- ЛОГИ ---
@@ -1519,11 +3967,12 @@ async def br_preview(callback: types.CallbackQuery, state: FSMContext):
 
     await callback.message.answer(f"👀 Предпросмотр (Цель: {target}, Время: {data['br_time']}):")
     # Копируем сообщение, чтобы админ видел, ЧТО он отправляет
-    await bot.copy_message(callback.message.chat.id, data['cid'], data['mid'], reply_markup=kb.as_markup())
+    chat_id = callback.message.chat.id
+    await tg_call(chat_id, lambda: bot.copy_message(chat_id, data['cid'], data['mid'], reply_markup=kb.as_markup()))
     await state.set_state(AdminStates.confirm_broadcast)
 
 
-@dp.callback_query(F.data == "br_confirm", AdminStates.confirm_broadcast)
+@dp.callback_query(F.data == "br_confirm", AdminStates.confirm_broadcast, flags={"long_running": True})
 async def br_exec(callback: types.CallbackQuery, state: FSMContext):
     data = await state.get_data()
     await state.clear()
@@ -1566,15 +4015,24 @@ async def run_delayed_broadcast(task_id, delay, data, admin_id, from_chat, msg_i
 
     uids = await get_targeted_user_ids(data['target'])
     s, f = 0, 0
-    for u in uids:
-        try:
-            await bot.copy_message(u, from_chat, msg_id)
-            s += 1
-            await asyncio.sleep(0.05)
-        except:
-            f += 1
+    uids_iter = iter(uids)
+
+    # Темп задает очередь исходящих (приоритет ниже интерактивных ответов),
+    # поэтому несколько отправителей просто разбирают общий список
+    async def sender():
+        nonlocal s, f
+        for u in uids_iter:
+            try:
+                await tg_call(u, lambda: bot.copy_message(u, from_chat, msg_id), PRIORITY_BROADCAST)
+                s += 1
+            except:
+                f += 1
+
+    await asyncio.gather(*(sender() for _ in range(BROADCAST_CONCURRENCY)))
 
-    await bot.send_message(admin_id, f"📢 Рассылка {task_id or ''} завершена!\n✅ Успешно: {s}\n❌ Ошибок: {f}")
+    await tg_call(admin_id, lambda: bot.send_message(
+        admin_id, f"📢 Рассылка {task_id or ''} завершена!\n✅ Успешно: {s}\n❌ Ошибок: {f}"
+    ), PRIORITY_NOTIFY)
     if task_id in active_broadcasts:
         del active_broadcasts[task_id]
 
@@ -1631,9 +4089,10 @@ async def admin_stats_pro(callback: types.CallbackQuery):
     (await c.fetchone())[0]
 
     # 2. Хит дня (фильм с наибольшим кол-вом лайков сегодня)
+    # За сегодня строк мало, поэтому явно идем по индексу added_at, а не по is_like
     async with db.execute("""
         SELECT movie_title, COUNT(*) as count 
-        FROM user_votes 
+        FROM user_votes INDEXED BY idx_user_votes_added_at
         WHERE is_like = 1 
           AND movie_title IS NOT NULL 
           AND movie_title != ''
@@ -1647,15 +4106,6 @@ async def admin_stats_pro(callback: types.CallbackQuery):
     current_duo = len([r for r in rooms.values() if r.get('is_solo') is False])
 
     # 4. ТОП ЖАНРОВ СЕГОДНЯ (на основе активных сессий)
-    # Маппинг ID жанров TMDB в читаемые названия
-    genre_mapping = {
-        '28': 'Боевик', '12': 'Приключения', '16': 'Мультфильм', '35': 'Комедия',
-        '80': 'Криминал', '99': 'Документальный', '18': 'Драма', '10751': 'Семейный',
-        '14': 'Фэнтези', '36': 'История', '27': 'Ужасы', '10402': 'Музыка',
-        '9648': 'Детектив', '10749': 'Мелодрама', '878': 'Фантастика', '10770': 'ТВ фильм',
-        '53': 'Триллер', '10752': 'Военный', '37': 'Вестерн', None: 'Все жанры'
-    }
-
     from collections import Counter
     # Собираем все genre_id из всех активных комнат
     all_active_genres = [str(r.get('genre_id')) if r.get('genre_id') else None for r in rooms.values()]
@@ -1663,7 +4113,7 @@ async def admin_stats_pro(callback: types.CallbackQuery):
 
     genres_top_text = ""
     for g_id, count in genre_counts:
-        g_name = genre_mapping.get(g_id, "Неизвестно")
+        g_name = TMDB_GENRE_NAMES.get(g_id, "Неизвестно")
         genres_top_text += f"   • {g_name}: <b>{count}</b> сессий\n"
 
     # 5. Уникальные свайперы за сегодня
@@ -1679,9 +4129,8 @@ async def admin_stats_pro(callback: types.CallbackQuery):
         ORDER BY cnt DESC LIMIT 3
     """) as c: top_fans = await c.fetchall()
 
-    # 7. Тикеты
-    async with db.execute("SELECT COUNT(*) FROM tickets WHERE status = 'open'") as c: open_tickets = \
-    (await c.fetchone())[0]
+    # 7. Тикеты (кешированный счетчик, общий с очередью поддержки)
+    open_tickets = await get_open_tickets_count()
 
     fans_text = ""
     for i, (fid, fcnt) in enumerate(top_fans, 1):
@@ -1715,6 +4164,8 @@ async def admin_stats_pro(callback: types.CallbackQuery):
     kb = InlineKeyboardBuilder()
     if open_tickets > 0:
         kb.button(text="📩 К тикетам", callback_data="admin_tickets")
+    kb.button(text="📈 Тренд 7 дней", callback_data="admin_trend_7")
+    kb.button(text="📈 Тренд 30 дней", callback_data="admin_trend_30")
     kb.button(text="🔄 Обновить", callback_data="admin_stats")
     kb.button(text="🔙 Назад", callback_data="back_to_admin")
 
@@ -1725,6 +4176,145 @@ async def admin_stats_pro(callback: types.CallbackQuery):
             await callback.answer("❌ Ошибка обновления")
 
 
+def sparkline(values):
+    bars = "▁▂▃▄▅▆▇█"
+    top = max(values, default=0)
+    return "".join(bars[min(int(v / top * (len(bars) - 1)), len(bars) - 1)] if top else bars[0] for v in values)
+
+
+@dp.callback_query(F.data.startswith("admin_trend_"))
+async def admin_trend(callback: types.CallbackQuery):
+    if not await is_admin(callback.from_user.id):
+        return await callback.answer("Доступ запрещен", show_alert=True)
+    days = 30 if callback.data == "admin_trend_30" else 7
+
+    # Только дневные сводки: несколько десятков строк, user_votes не читаем
+    rows, genres = await get_daily_trend(days)
+    by_day = {r[0]: r for r in rows}
+    dates = [(datetime.date.today() - datetime.timedelta(days=i)).isoformat() for i in range(days - 1, -1, -1)]
+    series = [by_day.get(d, (d, 0, 0, 0, 0, 0)) for d in dates]
+    totals = [sum(r[i] for r in series) for i in range(1, 6)]
+
+    lines = "\n".join(
+        f"<code>{d[8:10]}.{d[5:7]}</code> 👤+{r[1]} 🟢{r[2]} 🗳{r[3]} ❤️{r[4]} 🥳{r[5]}"
+        for d, r in zip(dates, series)
+    )
+    genres_text = "\n".join(
+        f"   • {TMDB_GENRE_NAMES.get(g_id, g_id)}: <b>{n}</b>" for g_id, n in genres
+    ) or "   (данных пока нет)"
+
+    text = (
+        f"📈 <b>ТРЕНД ЗА {days} ДНЕЙ</b>\n"
+        f"━━━━━━━━━━━━━━\n"
+        f"🗳 Свайпы: {sparkline([r[3] for r in series])}\n"
+        f"🟢 Активные: {sparkline([r[2] for r in series])}\n\n"
+        f"{lines}\n\n"
+        f"Σ <b>Итого:</b> новых {totals[0]}, свайпов {totals[2]}, лайков {totals[3]}, мэтчей {totals[4]}\n"
+        f"🎭 <b>Лайки по жанрам:</b>\n{genres_text}\n"
+        f"━━━━━━━━━━━━━━\n"
+        f"<i>👤 новые · 🟢 свайпали · 🗳 свайпы · ❤️ лайки · 🥳 мэтчи. "
+        f"Сводки обновляются раз в {ROLLUP_INTERVAL_MIN} мин</i>"
+    )
+
+    kb = InlineKeyboardBuilder()
+    kb.button(text="📈 30 дней" if days == 7 else "📈 7 дней", callback_data="admin_trend_30" if days == 7 else "admin_trend_7")
+    kb.button(text="🔙 К аналитике", callback_data="admin_stats")
+    kb.adjust(1)
+
+    try:
+        await callback.message.edit_text(text, reply_markup=kb.as_markup(), parse_mode="HTML")
+    except TelegramBadRequest as e:
+        if "message is not modified" not in str(e):
+            raise e
+        await callback.answer()
+
+
+@dp.callback_query(F.data == "admin_health")
+async def admin_health(callback: types.CallbackQuery):
+    if not await is_admin(callback.from_user.id):
+        return await callback.answer("Доступ запрещен", show_alert=True)
+
+    h = get_health_snapshot()
+    lag_icon = "🟢" if h["loop_lag_max_ms"] < 100 else ("🟡" if h["loop_lag_max_ms"] < 500 else "🔴")
+    tmdb_icon = "🔴 Предохранитель разомкнут" if h["tmdb_breaker_open"] else "🟢 Работает"
+
+    text = (
+        f"🩺 <b>ЗДОРОВЬЕ СИСТЕМЫ</b>\n"
+        f"━━━━━━━━━━━━━━\n"
+        f"⚙️ <b>Процесс:</b>\n"
+        f"├ {lag_icon} Задержка event loop: <code>{h['loop_lag_ms']:.0f}</code> мс (макс. <code>{h['loop_lag_max_ms']:.0f}</code>)\n"
+        f"├ Задач asyncio: <code>{h['tasks']}</code>\n"
+        f"├ Таймеров комнат: <code>{h['room_watchers']}</code> | Рассылок: <code>{h['broadcasts']}</code>\n"
+        f"├ Память (RSS): <code>{h['rss_mb']:.0f}</code> МБ\n"
+        f"└ Аптайм: <code>{h['uptime_h']:.1f}</code> ч\n\n"
+        f"🏠 <b>Память бота:</b>\n"
+        f"├ rooms: <code>{h['rooms']}</code>\n"
+        f"└ user_to_room: <code>{h['users_in_rooms']}</code>\n\n"
+        f"🎬 <b>TMDB:</b> {tmdb_icon}\n"
+        f"├ Попаданий в кеш: <code>{h['tmdb_hit_rate']:.1f}%</code> (записей: {h['tmdb_cache_size']})\n"
+        f"└ Ошибок: <code>{h['tmdb_error_rate']:.1f}%</code>\n\n"
+        f"📥 <b>Очереди:</b>\n"
+        f"├ БД: <code>{h['db_queue']}</code>\n"
+        f"├ Telegram: <code>{h['tg_queue']}</code>\n"
+        f"├ TMDB: <code>{h['tmdb_queue']}</code>\n"
+        f"└ Логи: <code>{h['log_queue']}</code> (потеряно: {h['logs_dropped']})\n\n"
+        f"💾 <b>Последний бэкап:</b> {backup_state['last_at'] or 'в этом запуске не было'}"
+        f"{' ⚠️ ' + html.quote(backup_state['last_error']) if backup_state['last_error'] else ''}\n"
+        f"━━━━━━━━━━━━━━\n"
+        f"🕒 <i>Обновлено: {datetime.datetime.now().strftime('%H:%M:%S')}</i>"
+    )
+
+    kb = InlineKeyboardBuilder()
+    kb.button(text="🔄 Обновить", callback_data="admin_health")
+    kb.button(text="🔙 Назад", callback_data="back_to_admin")
+
+    try:
+        await callback.message.edit_text(text, reply_markup=kb.adjust(1).as_markup(), parse_mode="HTML")
+    except TelegramBadRequest as e:
+        if "message is not modified" in str(e):
+            await callback.answer("Данные актуальны")
+        else:
+            raise e
+
+
+@dp.callback_query(F.data == "admin_backup", flags={"long_running": True})
+async def admin_backup(callback: types.CallbackQuery):
+    if not await is_admin(callback.from_user.id):
+        return await callback.answer("Доступ запрещен", show_alert=True)
+    if backup_state["running"]:
+        return await callback.answer("Бэкап уже выполняется", show_alert=True)
+    await callback.answer()
+
+    kb = InlineKeyboardBuilder()
+    kb.button(text="🔙 Назад", callback_data="back_to_admin")
+    chat_id = callback.message.chat.id
+
+    task = asyncio.create_task(backup_database())
+    shown = None
+    while not task.done():
+        percent = int(backup_state["progress"] * 100)
+        if percent != shown:
+            shown = percent
+            try:
+                await tg_call(chat_id, lambda: callback.message.edit_text(
+                    f"💾 <b>Бэкап базы</b>\n\nПрогресс: <code>{percent}%</code>", parse_mode="HTML"
+                ))
+            except TelegramBadRequest:
+                pass
+        # Обновляем сообщение не чаще раза в секунду (лимит Telegram на чат)
+        await asyncio.wait({task}, timeout=1)
+
+    try:
+        path = task.result()
+        text = (f"✅ <b>Бэкап готов</b>\n\n"
+                f"📁 <code>{os.path.basename(path)}</code>\n"
+                f"📦 {os.path.getsize(path) / 1024 / 1024:.1f} МБ")
+        await log_admin_action(callback.from_user.id, "Бэкап", os.path.basename(path))
+    except Exception as e:
+        text = f"❌ <b>Бэкап не удался:</b> {html.quote(str(e))}"
+    await tg_call(chat_id, lambda: callback.message.edit_text(text, reply_markup=kb.as_markup(), parse_mode="HTML"))
+
+
 @dp.callback_query(F.data == "admin_content")
 async def admin_content(callback: types.CallbackQuery):
     builder = InlineKeyboardBuilder()
@@ -1745,32 +4335,70 @@ async def toggle_genre(callback: types.CallbackQuery):
     await admin_content(callback)
 
 
-@dp.callback_query(F.data == "admin_tickets")
-async def view_tickets_list(callback: types.CallbackQuery):
-    async with db.execute(
-            "SELECT id, user_id, message FROM tickets WHERE status = 'open' ORDER BY created_at DESC"
-    ) as c:
-        tickets = await c.fetchall()
+async def render_tickets_page(callback, status, page=1, before=None):
+    """Страница открытых или закрытых тикетов. Кнопки листания несут keyset-якорь (id и created_at)"""
+    # Проверка здесь закрывает все входы: список, архив и листание (callback_data можно подделать)
+    if not await is_admin(callback.from_user.id):
+        return await callback.answer("Доступ запрещен", show_alert=True)
+    tickets = await get_tickets_page(status, before, TICKETS_PAGE_SIZE + 1)
+    has_next = len(tickets) > TICKETS_PAGE_SIZE
+    tickets = tickets[:TICKETS_PAGE_SIZE]
 
     kb = InlineKeyboardBuilder()
 
-    if not tickets:
-        text = "📩 <b>Новых обращений нет.</b>\nВы можете проверить архив закрытых тикетов:"
+    if status == "open":
+        open_count = await get_open_tickets_count()
+        if not tickets:
+            text = "📩 <b>Новых обращений нет.</b>\nВы можете проверить архив закрытых тикетов:"
+        else:
+            text = (f"📩 <b>Список открытых обращений ({open_count}), страница {page}:</b>\n"
+                    f"Выберите тикет для работы:")
+    elif not tickets:
+        text = "📜 <b>Архив пуст.</b>\nЗакрытых обращений пока нет."
     else:
-        text = f"📩 <b>Список открытых обращений ({len(tickets)}):</b>\nВыберите тикет для работы:"
-        for t_id, u_id, t_message in tickets:
-            # ИСПРАВЛЕНИЕ: если в базе по какой-то причине None, подменяем на строку
-            safe_msg = t_message if t_message is not None else "[Медиа-файл]"
+        text = f"📜 <b>Закрытые тикеты, страница {page}:</b>\nНажмите, чтобы прочитать полностью:"
+
+    for t_id, u_id, t_message, t_time in tickets:
+        # ИСПРАВЛЕНИЕ: если в базе по какой-то причине None, подменяем на строку
+        safe_msg = t_message if t_message is not None else "[Медиа-файл]"
+        short_msg = (safe_msg[:20] + '..') if len(safe_msg) > 20 else safe_msg
+        mark = "№" if status == "open" else "✅ №"
+        kb.button(text=f"{mark}{t_id} | {short_msg}", callback_data=f"open_ticket_{t_id}")
+
+    nav_btns = []
+    first_page = "admin_tickets" if status == "open" else "admin_tickets_history"
+    if page > 1:
+        nav_btns.append(types.InlineKeyboardButton(text="⏮ В начало", callback_data=first_page))
+    if has_next:
+        last_id, last_time = tickets[-1][0], tickets[-1][3]
+        nav_btns.append(types.InlineKeyboardButton(
+            text="➡️", callback_data=f"tickets_page_{status}_{page + 1}_{last_id}_{last_time}"
+        ))
 
-            # Теперь len() не вызовет ошибку
-            short_msg = (safe_msg[:20] + '..') if len(safe_msg) > 20 else safe_msg
-            kb.button(text=f"№{t_id} | {short_msg}", callback_data=f"open_ticket_{t_id}")
+    kb.adjust(1)
+    if nav_btns:
+        kb.row(*nav_btns)
 
     # Кнопки управления (вне цикла!)
-    kb.button(text="📜 Архив (закрытые)", callback_data="admin_tickets_history")
-    kb.button(text="🔙 Назад в админку", callback_data="back_to_admin")
+    if status == "open":
+        kb.row(types.InlineKeyboardButton(text="📜 Архив (закрытые)", callback_data="admin_tickets_history"))
+        kb.row(types.InlineKeyboardButton(text="🔙 Назад в админку", callback_data="back_to_admin"))
+    else:
+        kb.row(types.InlineKeyboardButton(text="🔙 Назад к активным", callback_data="admin_tickets"))
 
-    await callback.message.edit_text(text, reply_markup=kb.adjust(1).as_markup(), parse_mode="HTML")
+    await callback.message.edit_text(text, reply_markup=kb.as_markup(), parse_mode="HTML")
+
+
+@dp.callback_query(F.data == "admin_tickets")
+async def view_tickets_list(callback: types.CallbackQuery):
+    await render_tickets_page(callback, "open")
+
+
+@dp.callback_query(F.data.startswith("tickets_page_"))
+async def tickets_pagination_handler(callback: types.CallbackQuery):
+    # tickets_page_{status}_{page}_{id}_{created_at}; created_at может содержать что угодно, кроме переноса
+    _, _, status, page, last_id, last_time = callback.data.split("_", 5)
+    await render_tickets_page(callback, status, int(page), (last_time, int(last_id)))
 
 
 # ЭТА ФУНКЦИЯ ДОЛЖНА БЫТЬ СНАРУЖИ (на одном уровне с остальными)
@@ -1793,7 +4421,7 @@ async def show_specific_ticket(callback: types.CallbackQuery):
     text = (
         f"📋 <b>Тикет №{t_id}</b> ({status_emoji})\n"
         f"👤 От пользователя: <code>{u_id}</code>\n"
-        f"⏰ Создан: <code>{t_time}</code>\n"
+        f"⏰ Создан: <code>{t_time or '—'}</code>\n"
         f"━━━━━━━━━━━━━━\n"
         f"💬 Сообщение:\n{t_msg or '[Без текста]'}"
     )
@@ -1817,21 +4445,11 @@ async def close_ticket_no_reply(callback: types.CallbackQuery):
     # Извлекаем ID тикета из callback_data (close_ticket_ID)
     ticket_id = int(callback.data.split("_")[2])
 
-    # Проверяем, существует ли тикет
-    async with db.execute("SELECT user_id FROM tickets WHERE id = ?", (ticket_id,)) as c:
-        ticket = await c.fetchone()
-
-    if not ticket:
-        await callback.answer("Ошибка: Тикет не найден в базе.")
+    # Обновляем статус на 'closed' (только если тикет есть и еще открыт)
+    if not await close_ticket(ticket_id):
+        await callback.answer("Ошибка: Тикет не найден или уже закрыт.")
         return
 
-    # Обновляем статус на 'closed'
-    await db.execute(
-        "UPDATE tickets SET status = 'closed' WHERE id = ?",
-        (ticket_id,)
-    )
-    await db.commit()
-
     # Логируем действие админа
     await log_admin_action(callback.from_user.id, "CLOSE_TICKET", f"Ticket #{ticket_id} closed without reply")
 
@@ -1844,29 +4462,7 @@ async def close_ticket_no_reply(callback: types.CallbackQuery):
 # И хендлер истории тоже должен быть здесь
 @dp.callback_query(F.data == "admin_tickets_history")
 async def view_tickets_history(callback: types.CallbackQuery):
-
-    # Берем последние 15 закрытых тикетов
-    async with db.execute(
-            "SELECT id, user_id, message FROM tickets WHERE status = 'closed' ORDER BY created_at DESC LIMIT 15"
-    ) as c:
-        tickets = await c.fetchall()
-
-    kb = InlineKeyboardBuilder()
-
-    if not tickets:
-        text = "📜 <b>Архив пуст.</b>\nЗакрытых обращений пока нет."
-    else:
-        text = "📜 <b>Последние 15 закрытых тикетов:</b>\nНажмите, чтобы прочитать полностью:"
-        for t_id, u_id, t_message in tickets:
-            # Наша "безопасная" проверка текста (чтобы не было ошибки None)
-            safe_msg = t_message if t_message is not None else "[Медиа/Фото]"
-            short_msg = (safe_msg[:20] + '..') if len(safe_msg) > 20 else safe_msg
-            kb.button(text=f"✅ №{t_id} | {short_msg}", callback_data=f"open_ticket_{t_id}")
-
-    kb.button(text="🔙 Назад к активным", callback_data="admin_tickets")
-    kb.adjust(1)
-
-    await callback.message.edit_text(text, reply_markup=kb.as_markup(), parse_mode="HTML")
+    await render_tickets_page(callback, "closed")
 
 
 @dp.callback_query(F.data == "admin_active_rooms")
@@ -1998,10 +4594,10 @@ async def solo_filters(callback: types.CallbackQuery):
             other_users = [u for u in rooms[rid]["users"] if u != uid]
             for other_id in other_users:
                 try:
-                    await bot.send_message(
+                    await tg_call(other_id, lambda: bot.send_message(
                         other_id,
                         "🚪 Ваш партнер ушел в соло-режим. Комната закрыта."
-                    )
+                    ), PRIORITY_NOTIFY)
                     # Убираем связь с комнатой для партнера
                     if other_id in user_to_room:
                         del user_to_room[other_id]
@@ -2110,7 +4706,8 @@ async def start_solo(callback: types.CallbackQuery):
     gid = None if gid == "all" else gid
 
     # ВАЖНО: Добавляем await перед вызовом функции
-    movies_list = await fetch_movies_page(1, gid)
+    language = await get_user_language(uid)
+    movies_list = await rank_deck(uid, await fetch_movies_page(1, gid))
 
     # Создаем новую соло-комнату
     rooms[f"s_{uid}"] = {
@@ -2118,7 +4715,8 @@ async def start_solo(callback: types.CallbackQuery):
         "users": {uid: {"idx": 0}},
         "is_solo": True,
         "last_page": 1,
-        "genre_id": gid
+        "genre_id": gid,
+        "language": language
     }
     user_to_room[uid] = f"s_{uid}"
 
@@ -2130,12 +4728,14 @@ async def start_solo(callback: types.CallbackQuery):
 
 
 async def main():
-    global bot, http_client, db  # db теперь инициализируется один раз здесь
+    global bot, http_client, db, outbound_queue, tmdb_queue  # db теперь инициализируется один раз здесь
 
     # 1. Инициализируем соединение с БД (открываем "трубу")
-    db = await aiosqlite.connect(DB_PATH)
+    db = await aiosqlite.connect(DB_PATH, timeout=DB_BUSY_TIMEOUT)
     # Это позволит доставать данные по именам колонок: row["user_id"]
     db.row_factory = aiosqlite.Row
+    # Все запросы к БД попадают в метрики
+    db = TimedConnection(db)
 
     # Настройка прокси для aiohttp
     connector = ProxyConnector.from_url(PROXY_URL)
@@ -2153,41 +4753,68 @@ async def main():
 
     # ХАК для SOCKS5 в aiogram 3.x:
     bot.session._connector = connector
+    # Первая зарегистрированная миддлварь — внешняя: лимиты снаружи, замер — только самого запроса
+    bot.session.middleware(telegram_budget_middleware)
+    bot.session.middleware(telegram_timing_middleware)
 
-    # Передаем управление в init_db (она теперь должна использовать глобальную db)
-    await init_db()
-
-    # Установка общих команд меню для всех пользователей
-    await bot.set_my_commands(
-        [BotCommand(command='/start', description='🏠 Главное меню')],
-        scope=BotCommandScopeDefault()
-    )
+    # Очередь исходящих запросов к Telegram (лимиты на чат и на весь бот)
+    outbound_queue = asyncio.PriorityQueue()
+    outbound_task = asyncio.create_task(rate_limit_worker(outbound_queue, global_bucket))
 
-    # --- СИНХРОНИЗАЦИЯ АДМИН-КОМАНД ---
-    # Обновляем меню для создателя
-    await refresh_admin_commands(SUPER_ADMIN_ID, is_adding=True)
+    # Очередь запросов к TMDB (интерактивные запросы вперед фоновой подгрузки)
+    tmdb_queue = asyncio.PriorityQueue()
+    tmdb_task = asyncio.create_task(rate_limit_worker(tmdb_queue, tmdb_bucket))
 
-    # Теперь используем уже открытое соединение db вместо async with aiosqlite.connect
-    async with db.execute("SELECT user_id FROM admins") as cursor:
-        rows = await cursor.fetchall()
-        for row in rows:
-            try:
-                # row[0] сработает, так как fetchall вернет список строк
-                if row[0] != SUPER_ADMIN_ID:
-                    await refresh_admin_commands(row[0], is_adding=True)
-            except Exception as e:
-                print(f"Ошибка обновления меню для админа {row[0]}: {e}")
-    # -------------------------------------------------------
+    # Передаем управление в init_db (она теперь должна использовать глобальную db)
+    await init_db()
+    if VOTE_ARCHIVE_DAYS:
+        # Разовая перестройка базы — до polling, пока никто не пишет голоса
+        await asyncio.to_thread(enable_incremental_vacuum)
+
+    # Теплый кеш TMDB из прошлого запуска + фоновый прогрев каталога
+    await load_tmdb_cache()
+    crawler_task = asyncio.create_task(catalog_crawler())
+
+    metrics_runner = await start_metrics_server()
+    webapp_runner = await start_webapp_server()
+    lag_task = asyncio.create_task(loop_lag_monitor())
+    log_task = asyncio.create_task(log_flusher())
+    archive_task = asyncio.create_task(vote_archiver()) if VOTE_ARCHIVE_DAYS else None
+    backup_task = asyncio.create_task(backup_scheduler()) if BACKUP_HOURS else None
+    rollup_task = asyncio.create_task(rollup_worker())
+    recs_task = asyncio.create_task(recommender_worker()) if RECS_UPDATE_MIN else None
+
+    # --- СИНХРОНИЗАЦИЯ КОМАНД МЕНЮ ---
+    # Общее меню и меню админов обновляются в фоне, polling стартует сразу
+    command_sync_task = asyncio.create_task(sync_startup_commands())
 
     try:
         print("Бот запущен через прокси...")
         await dp.start_polling(bot, skip_updates=True)
     finally:
         # ЗАКРЫВАЕМ ВСЕ РЕСУРСЫ
+        outbound_task.cancel()
+        tmdb_task.cancel()
+        crawler_task.cancel()
+        lag_task.cancel()
+        log_task.cancel()
+        command_sync_task.cancel()
+        for task in (archive_task, backup_task, rollup_task, recs_task):
+            if task:
+                task.cancel()
+        for runner in (metrics_runner, webapp_runner):
+            if runner:
+                await runner.cleanup()
         await bot.session.close()
         if http_client:
             await http_client.close()
         if db:
+            await fsm_storage.close()  # Несохраненные изменения FSM
+            await flush_logs()
+            await update_rollups()  # Чтобы не потерять мэтчи, накопленные с последнего пересчета
+            await save_tmdb_cache()
+            # Обновляет статистику планировщика по запросам этой сессии (дешево, если менять нечего)
+            await db.execute("PRAGMA optimize")
             await db.close()  # Закрываем соединение с БД только при выключении
         print("Все сессии и база данных закрыты.")
 